@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, send_file
 from flask_cors import CORS
 from flask_bcrypt import Bcrypt
 from pymongo import MongoClient
@@ -6,20 +6,76 @@ from bson.objectid import ObjectId
 from bson.errors import InvalidId
 import os
 import json
+import itertools
+import time
+import threading
 from datetime import datetime, timedelta
 import base64
 from PIL import Image
 import io
 import zipfile
+import mimetypes
 import jwt
 from functools import wraps
 import cv2
 import numpy as np
+from export_engine import (
+    build_export_plan, set_plan_splits, image_annotations, plan_annotations,
+    yolo_label_task, render_yolo_label, pascal_xml_task, render_pascal_xml,
+    serialize_json, render_files, write_images_to_zip, filter_plan_images
+)
+from export_cache import (
+    touch_dataset, export_cache_key, get_cached_export, store_export, evict_export_cache,
+    build_export_manifest, record_export, load_export_record, delete_export_records,
+    delta_options_match, diff_manifests, add_delta_manifest
+)
+from split_engine import split_dataset
+from import_engine import (
+    create_import_context, find_image, find_image_by_stem, get_or_create_category,
+    category_color, add_annotation, finish_import, YOLO_IMAGE_EXTENSIONS
+)
+from db_indexes import ensure_indexes, ensure_indexes_in_background, index_report, explain_queries
+from image_probe import probe_image, save_image_stream, file_base64, probe_fields
+from image_dedup import (
+    split_duplicates, insert_image_docs, insert_image_doc, find_images_by_hash, duplicate_info,
+    remove_duplicate_file, link_shared_file, unshare_changed_file, release_image_blobs,
+    update_image_content, image_data_base64, dataset_duplicate_groups
+)
+from near_duplicates import (
+    near_duplicate_exclusions, find_dataset_clusters, start_hash_job, hash_job_status,
+    DEFAULT_NEAR_DUPLICATE_THRESHOLD
+)
+from file_index import (
+    scan_dataset_folder, load_file_index, diff_file_index, find_registered_images,
+    update_file_index, dataset_sync_lock, pause_dataset_watch,
+    resume_dataset_watch, start_dataset_watcher, DATASET_WATCH
+)
+from chunked_upload import (
+    create_upload, get_upload, write_chunk, upload_status, missing_chunks, upload_path,
+    assembled_file, file_sha256, claim_upload, release_upload, finish_upload, abort_upload,
+    cleanup_stale_uploads
+)
+from realtime import (
+    init_realtime, request_job_id, progress_callback, publish_progress, publish_dataset_change
+)
+from metrics import init_metrics, timed, render_metrics, metrics_authorized
+from inference_client import inference_backend
+from onnx_backend import export_onnx, load_session, class_names, onnx_path_for
+from quantization import (
+    quantize, evaluate, accuracy_delta, quantized_path_for, QUANTIZATION_METHODS, INT8_VARIANT,
+    CALIBRATION_IMAGES, EVALUATION_IMAGES
+)
+from coco_stream import (
+    validate_coco_file, extract_coco_json_files, coco_file_source, merge_coco_streams
+)
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Export-Id', 'Server-Timing', 'X-Mongo-Commands'])
 bcrypt = Bcrypt(app)
 
+# Latencia por endpoint, comandos de Mongo y etapas costosas (ver metrics)
+init_metrics(app)
+
 SECRET_KEY = os.getenv('SECRET_KEY')
 if not SECRET_KEY:
     raise ValueError("SECRET_KEY no encontrada...")
@@ -88,6 +144,23 @@ def token_required(f):
     
     return decorated
 
+def socket_user_id(token):
+    """user_id de un token válido de un usuario existente (conexiones Socket.IO) o None"""
+    try:
+        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+        user_id = data['user_id']
+        if get_db().users.find_one({'_id': ObjectId(user_id)}, {'_id': 1}):
+            return user_id
+    except (jwt.InvalidTokenError, KeyError, InvalidId):
+        pass
+    return None
+
+def user_owns_dataset(user_id, dataset_id):
+    """Comprobar que el dataset pertenece al usuario"""
+    if not ObjectId.is_valid(dataset_id):
+        return False
+    return get_db().datasets.find_one({'_id': ObjectId(dataset_id), 'user_id': user_id}, {'_id': 1}) is not None
+
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     """Registrar un nuevo usuario"""
@@ -242,14 +315,11 @@ def find_images_in_directory(directory_path, max_depth=5):
             file_ext = os.path.splitext(filename)[1].lower()
             if file_ext in supported_formats:
                 file_path = os.path.join(root, filename)
-                print(f"Procesando imagen: {filename} (extensión: {file_ext})")
                 
-                # Validar que es una imagen real
+                # Validar que es una imagen real (solo se lee la cabecera)
                 try:
-                    with Image.open(file_path) as img:
-                        # Verificar que no es un archivo corrupto
-                        img.verify()
-                        
+                    probe_image(file_path, compute_hash=False)
+                    
                     # Calcular ruta relativa desde el directorio base
                     relative_path = os.path.relpath(file_path, directory_path)
                     found_images.append({
@@ -338,7 +408,7 @@ def is_video_file(filename):
     file_ext = os.path.splitext(filename)[1].lower()
     return file_ext in video_extensions
 
-def extract_video_frames(video_path, output_folder, fps=1):
+def extract_video_frames(video_path, output_folder, fps=1, progress=None):
     """
     Extraer frames de un video a una tasa específica
     
@@ -346,6 +416,7 @@ def extract_video_frames(video_path, output_folder, fps=1):
         video_path: Ruta del archivo de video
         output_folder: Carpeta donde guardar los frames
         fps: Frames por segundo a extraer (por defecto 1 frame/segundo)
+        progress: Función opcional (frames leídos, frames totales) tras cada frame extraído
     
     Returns:
         Lista de información de frames extraídos
@@ -406,6 +477,8 @@ def extract_video_frames(video_path, output_folder, fps=1):
                 })
                 
                 extracted_count += 1
+                if progress:
+                    progress(frame_count + 1, total_frames)
             
             frame_count += 1
         
@@ -463,16 +536,19 @@ os.makedirs(IMAGE_FOLDER, exist_ok=True)
 @token_required
 def upload_image(current_user_id):
     """Subir una nueva imagen o video y procesarlo según corresponda"""
-    if 'image' not in request.files:
+    return upload_image_file(current_user_id, request.files.get('image'), request.form)
+
+def upload_image_file(current_user_id, file, form):
+    """Guardar una imagen (o video) recibida en un formulario o en una subida por fragmentos"""
+    if file is None:
         return jsonify({'error': 'No se encontró ningún archivo'}), 400
 
-    file = request.files['image']
     if file.filename == '':
         return jsonify({'error': 'Nombre de archivo vacío'}), 400
 
     try:
         db = get_db()
-        dataset_id = request.form.get('dataset_id')
+        dataset_id = form.get('dataset_id')
         
         # Verificar si es un video
         if is_video_file(file.filename):
@@ -489,20 +565,34 @@ def upload_image(current_user_id):
             else:
                 return jsonify({'error': 'Dataset no encontrado o no autorizado'}), 403
         
-        # Leer la imagen como bytes
-        image_data = file.read()
-        
-        # Guardar también una copia física (backup) en la carpeta correcta
+        # Copiar la subida a disco por bloques obteniendo cabecera y hash en la misma pasada
+        import tempfile
         save_path = os.path.join(dataset_folder_path, file.filename)
-        with open(save_path, 'wb') as f:
-            f.write(image_data)
-        
-        # Obtener información de la imagen
-        pil_image = Image.open(io.BytesIO(image_data))
-        width, height = pil_image.size
+        temp_fd, temp_path = tempfile.mkstemp(dir=dataset_folder_path, suffix='.upload')
+        os.close(temp_fd)
+        try:
+            probe = save_image_stream(file.stream, temp_path)
+            width, height = probe['width'], probe['height']
+            
+            # Si el dataset ya tiene una imagen con el mismo contenido, no se guarda otra vez
+            existing = find_images_by_hash(db, dataset_id, [probe['sha256']]).get(probe['sha256'])
+            if existing:
+                return jsonify({
+                    'message': 'La imagen ya existe en el dataset',
+                    'duplicate': True,
+                    'image': serialize_doc(existing)
+                })
+            
+            # Guardar la copia física en la carpeta correcta
+            # (clon del archivo de otro dataset si se comparte el contenido)
+            if not link_shared_file(db, probe['sha256'], dataset_id, save_path, IMAGE_FOLDER):
+                os.replace(temp_path, save_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
         
-        # Convertir imagen a base64 para MongoDB
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
+        # Convertir imagen a base64 para MongoDB (leída del disco sin copiarla entera)
+        image_base64 = file_base64(save_path)
         
         # Guardar ruta relativa para facilitar la organización
         relative_path = os.path.relpath(save_path, IMAGE_FOLDER) if dataset_id else file.filename
@@ -514,19 +604,33 @@ def upload_image(current_user_id):
             'file_path': relative_path,  # Ruta relativa desde IMAGE_FOLDER
             'data': image_base64,
             'content_type': file.content_type,
-            'size': len(image_data),
+            'size': probe['size'],
             'width': width,
             'height': height,
+            **probe_fields(probe),
             'upload_date': datetime.utcnow(),
             'dataset_id': dataset_id,
-            'project_id': request.form.get('project_id', 'default'),  # Mantener para compatibilidad
+            'project_id': form.get('project_id', 'default'),  # Mantener para compatibilidad
             'user_id': current_user_id,  # Asociar imagen al usuario
             'type': 'image'
         }
         
-        # Insertar en MongoDB
-        result = db.images.insert_one(image_doc)
-        image_doc['_id'] = str(result.inserted_id)
+        # Insertar en MongoDB (el índice único detecta una subida simultánea de la misma imagen)
+        inserted_id = insert_image_doc(db, image_doc)
+        if inserted_id is None:
+            existing = find_images_by_hash(db, dataset_id, [probe['sha256']]).get(probe['sha256'])
+            if existing and existing.get('file_path') != relative_path:
+                os.remove(save_path)
+            return jsonify({
+                'message': 'La imagen ya existe en el dataset',
+                'duplicate': True,
+                'image': serialize_doc(existing) if existing else None
+            })
+        image_doc['_id'] = str(inserted_id)
+        touch_dataset(db, dataset_id)
+        publish_dataset_change(dataset_id, 'images_added', count=1,
+                               images=[{key: value for key, value in image_doc.items() if key != 'data'}])
+        image_doc['data'] = image_base64
         
         return jsonify({
             'message': 'Imagen subida correctamente',
@@ -587,6 +691,7 @@ def process_video_upload(video_file, current_user_id, dataset_id, db):
         result = db.videos.insert_one(video_doc)
         video_id = str(result.inserted_id)
         video_doc['_id'] = video_id
+        publish_dataset_change(dataset_id, 'video_added', video=video_doc)
         
         return jsonify({
             'message': 'Video subido correctamente',
@@ -697,25 +802,27 @@ def get_image_data(image_id):
         if not image_doc:
             return jsonify({'error': 'Imagen no encontrada'}), 404
             
-        # Decodificar base64
-        image_data = base64.b64decode(image_doc['data'])
+        # Decodificar base64 (del documento o del contenido compartido)
+        with timed('image_decode'):
+            image_data = base64.b64decode(image_data_base64(db, image_doc) or '')
         content_type = image_doc.get('content_type', 'image/jpeg')
         filename = image_doc["filename"]
         
         # Convertir TIFF a PNG para navegadores (TIFF no es soportado nativamente)
         if content_type in ['image/tiff', 'image/tif'] or filename.lower().endswith(('.tif', '.tiff')):
             try:
-                # Abrir imagen TIFF desde bytes
-                tiff_image = Image.open(io.BytesIO(image_data))
-                
-                # Convertir a RGB si es necesario (algunos TIFF pueden estar en otros modos)
-                if tiff_image.mode not in ('RGB', 'L'):
-                    tiff_image = tiff_image.convert('RGB')
-                
-                # Guardar como PNG en memoria
-                png_buffer = io.BytesIO()
-                tiff_image.save(png_buffer, format='PNG')
-                png_buffer.seek(0)
+                with timed('image_decode'):
+                    # Abrir imagen TIFF desde bytes
+                    tiff_image = Image.open(io.BytesIO(image_data))
+                    
+                    # Convertir a RGB si es necesario (algunos TIFF pueden estar en otros modos)
+                    if tiff_image.mode not in ('RGB', 'L'):
+                        tiff_image = tiff_image.convert('RGB')
+                    
+                    # Guardar como PNG en memoria
+                    png_buffer = io.BytesIO()
+                    tiff_image.save(png_buffer, format='PNG')
+                    png_buffer.seek(0)
                 
                 image_data = png_buffer.getvalue()
                 content_type = 'image/png'
@@ -751,7 +858,8 @@ def delete_image(current_user_id, image_id):
         if not image_doc:
             return jsonify({'error': 'Imagen no encontrada o no autorizada'}), 403
             
-        # Eliminar imagen de MongoDB
+        # Eliminar imagen de MongoDB (y su referencia al contenido compartido)
+        release_image_blobs(db, {'_id': ObjectId(image_id)})
         result = db.images.delete_one({'_id': ObjectId(image_id)})
         
         if result.deleted_count == 0:
@@ -779,6 +887,9 @@ def delete_image(current_user_id, image_id):
         # Eliminar anotaciones asociadas
         annotations_result = db.annotations.delete_many({'image_id': image_id})
         print(f"Eliminadas {annotations_result.deleted_count} anotaciones asociadas")
+        db.dataset_files.delete_many({'image_id': image_id})
+        touch_dataset(db, image_doc.get('dataset_id'))
+        publish_dataset_change(image_doc.get('dataset_id'), 'image_deleted', image_id=image_id)
         
         return jsonify({
             'message': 'Imagen eliminada correctamente',
@@ -986,6 +1097,8 @@ def check_annotation_duplicate_advanced(db, image_id, category_id, category_name
 @token_required
 def process_video_with_fps(current_user_id):
     """Procesar un video ya subido con un FPS personalizado"""
+    dataset_id = None
+    job_id = request_job_id()
     try:
         data = request.get_json()
         
@@ -1004,6 +1117,10 @@ def process_video_with_fps(current_user_id):
         if not video_doc:
             return jsonify({'error': 'Video no encontrado o no autorizado'}), 403
         
+        # Los frames se registran aquí; el observador de la carpeta no debe procesarlos
+        dataset_id = video_doc.get('dataset_id')
+        pause_dataset_watch(dataset_id)
+        
         video_path = os.path.join(IMAGE_FOLDER, video_doc['file_path'])
         
         if not os.path.exists(video_path):
@@ -1016,7 +1133,8 @@ def process_video_with_fps(current_user_id):
         os.makedirs(frames_folder, exist_ok=True)
         
         # Extraer frames
-        frames_info = extract_video_frames(video_path, frames_folder, fps=fps)
+        frames_info = extract_video_frames(video_path, frames_folder, fps=fps,
+                                           progress=progress_callback(current_user_id, job_id, 'video_frames'))
         
         if not frames_info:
             return jsonify({'error': 'No se pudieron extraer frames del video'}), 500
@@ -1058,30 +1176,44 @@ def process_video_with_fps(current_user_id):
             result = db.images.insert_one(frame_doc)
             frame_ids.append(str(result.inserted_id))
         
+        touch_dataset(db, video_doc.get('dataset_id'))
+        publish_dataset_change(video_doc.get('dataset_id'), 'images_added', count=len(frame_ids), video_id=video_id)
+        publish_progress(current_user_id, job_id, 'video_frames', len(frame_ids), len(frame_ids),
+                         state='done', result={'video_id': video_id, 'frames_count': len(frame_ids)})
+        
         return jsonify({
             'message': f'Video procesado correctamente. Se extrajeron {len(frames_info)} frames.',
             'video_id': video_id,
             'frames_count': len(frames_info),
-            'frame_ids': frame_ids
+            'frame_ids': frame_ids,
+            'job_id': job_id
         })
         
     except Exception as e:
+        publish_progress(current_user_id, job_id, 'video_frames', state='error', message=str(e))
         return jsonify({'error': f'Error al procesar video: {str(e)}'}), 500
+    finally:
+        resume_dataset_watch(dataset_id)
 
 @app.route('/api/videos', methods=['POST'])
 @token_required
 def upload_video(current_user_id):
     """Subir un nuevo video y extraer frames para anotación"""
-    if 'video' not in request.files:
+    return upload_video_file(current_user_id, request.files.get('video'), request.form)
+
+def upload_video_file(current_user_id, video_file, form):
+    """Guardar un video recibido en un formulario o en una subida por fragmentos y extraer sus frames"""
+    if video_file is None:
         return jsonify({'error': 'No se encontró ningún video'}), 400
 
-    video_file = request.files['video']
     if video_file.filename == '':
         return jsonify({'error': 'Nombre de archivo vacío'}), 400
 
+    paused_dataset_id = None
+    job_id = request_job_id(form)
     try:
         db = get_db()
-        dataset_id = request.form.get('dataset_id')
+        dataset_id = form.get('dataset_id')
         
         # Verificar que es un video
         if not is_video_file(video_file.filename):
@@ -1094,6 +1226,9 @@ def upload_video(current_user_id):
             if dataset:
                 dataset_folder_path = os.path.join(IMAGE_FOLDER, str(dataset['_id']))
                 os.makedirs(dataset_folder_path, exist_ok=True)
+                # Los frames se registran aquí; el observador de la carpeta no debe procesarlos
+                paused_dataset_id = dataset_id
+                pause_dataset_watch(paused_dataset_id)
             else:
                 return jsonify({'error': 'Dataset no encontrado o no autorizado'}), 403
         
@@ -1108,8 +1243,9 @@ def upload_video(current_user_id):
         os.makedirs(frames_folder, exist_ok=True)
         
         # Extraer frames (1 fps por defecto)
-        fps = float(request.form.get('fps', 1))
-        frames_info = extract_video_frames(video_path, frames_folder, fps=fps)
+        fps = float(form.get('fps', 1))
+        frames_info = extract_video_frames(video_path, frames_folder, fps=fps,
+                                           progress=progress_callback(current_user_id, job_id, 'video_frames'))
         
         if not frames_info:
             return jsonify({'error': 'No se pudieron extraer frames del video'}), 500
@@ -1174,16 +1310,25 @@ def upload_video(current_user_id):
             frame_result = db.images.insert_one(frame_doc)
             frame_ids.append(str(frame_result.inserted_id))
         
+        touch_dataset(db, dataset_id)
+        publish_dataset_change(dataset_id, 'video_added', video=video_doc, frames_count=len(frame_ids))
+        publish_progress(current_user_id, job_id, 'video_frames', len(frame_ids), len(frame_ids),
+                         state='done', result={'video_id': video_id, 'frames_count': len(frame_ids)})
+        
         return jsonify({
             'message': 'Video subido y procesado correctamente',
             'video': serialize_doc(video_doc),
             'frames_count': len(frame_ids),
-            'frame_ids': frame_ids
+            'frame_ids': frame_ids,
+            'job_id': job_id
         })
         
     except Exception as e:
         print(f"Error al subir video: {str(e)}")
+        publish_progress(current_user_id, job_id, 'video_frames', state='error', message=str(e))
         return jsonify({'error': f'Error al subir video: {str(e)}'}), 500
+    finally:
+        resume_dataset_watch(paused_dataset_id)
 
 @app.route('/api/videos', methods=['GET'])
 @token_required
@@ -1323,6 +1468,9 @@ def delete_video(current_user_id, video_id):
         
         # Eliminar documento del video
         db.videos.delete_one({'_id': ObjectId(video_id)})
+        touch_dataset(db, video_doc.get('dataset_id'))
+        publish_dataset_change(video_doc.get('dataset_id'), 'video_deleted', video_id=video_id,
+                               deleted_frames=frames_result.deleted_count)
         
         return jsonify({
             'message': 'Video eliminado correctamente',
@@ -1422,6 +1570,8 @@ def create_annotation(current_user_id):
         # Insertar en MongoDB
         result = db.annotations.insert_one(annotation_doc)
         annotation_doc['_id'] = str(result.inserted_id)
+        touch_dataset(db, dataset_id)
+        publish_dataset_change(dataset_id, 'annotation_created', annotation=annotation_doc)
         
         return jsonify({
             'message': 'Anotación creada correctamente',
@@ -1517,9 +1667,12 @@ def update_annotation(current_user_id, annotation_id):
         
         if result.matched_count == 0:
             return jsonify({'error': 'Anotación no encontrada'}), 404
+        touch_dataset(db, image.get('dataset_id'))
             
         # Obtener anotación actualizada
         updated_annotation = db.annotations.find_one({'_id': ObjectId(annotation_id)})
+        publish_dataset_change(image.get('dataset_id'), 'annotation_updated',
+                               annotation=updated_annotation)
         
         return jsonify({
             'message': 'Anotación actualizada correctamente',
@@ -1554,6 +1707,9 @@ def delete_annotation(current_user_id, annotation_id):
         
         if result.deleted_count == 0:
             return jsonify({'error': 'Error al eliminar anotación'}), 500
+        touch_dataset(db, image.get('dataset_id'))
+        publish_dataset_change(image.get('dataset_id'), 'annotation_deleted',
+                               annotation_id=annotation_id, image_id=str(annotation['image_id']))
             
         return jsonify({'message': 'Anotación eliminada correctamente'})
         
@@ -1579,6 +1735,9 @@ def delete_annotations_bulk(current_user_id):
         
         # Eliminar anotaciones de la imagen
         result = db.annotations.delete_many({'image_id': data['image_id']})
+        touch_dataset(db, image.get('dataset_id'))
+        publish_dataset_change(image.get('dataset_id'), 'annotations_deleted',
+                               image_id=data['image_id'], deleted_count=result.deleted_count)
         
         return jsonify({
             'message': f'{result.deleted_count} anotaciones eliminadas correctamente',
@@ -1660,6 +1819,8 @@ def create_category(current_user_id):
         # Insertar en MongoDB
         result = db.categories.insert_one(category_doc)
         category_doc['_id'] = str(result.inserted_id)
+        touch_dataset(db, data['dataset_id'])
+        publish_dataset_change(data['dataset_id'], 'category_created', category=category_doc)
         
         return jsonify({
             'message': 'Categoría creada correctamente',
@@ -1726,9 +1887,12 @@ def update_category(current_user_id, category_id):
         
         if result.matched_count == 0:
             return jsonify({'error': 'Error al actualizar categoría'}), 500
+        touch_dataset(db, existing_category.get('dataset_id'))
         
         # Obtener categoría actualizada
         updated_category = db.categories.find_one({'_id': ObjectId(category_id), 'user_id': current_user_id})
+        publish_dataset_change(existing_category.get('dataset_id'), 'category_updated',
+                               category=updated_category)
         
         return jsonify({
             'message': 'Categoría actualizada correctamente',
@@ -1808,6 +1972,9 @@ def delete_category(current_user_id, category_id):
         
         if result.deleted_count == 0:
             return jsonify({'error': 'Error al eliminar categoría'}), 500
+        touch_dataset(db, category.get('dataset_id') or dataset_id)
+        publish_dataset_change(category.get('dataset_id') or dataset_id, 'category_deleted',
+                               category_id=category_id, deleted_annotations=annotation_count)
         
         return jsonify({
             'message': 'Categoría eliminada correctamente',
@@ -2109,6 +2276,7 @@ def delete_dataset(current_user_id, dataset_id):
         categories_result = db.categories.delete_many({'dataset_id': dataset_id})
         
         # Eliminar todas las imágenes del dataset de la base de datos
+        release_image_blobs(db, {'dataset_id': dataset_id})
         images_result = db.images.delete_many({'dataset_id': dataset_id})
         
         # Eliminar carpeta física completa del dataset usando el ID
@@ -2125,8 +2293,12 @@ def delete_dataset(current_user_id, dataset_id):
             print(f"Error al eliminar carpeta del dataset {dataset_folder}: {str(folder_error)}")
             # No fallar la operación completa si solo falla la eliminación de la carpeta
         
-        # Eliminar el dataset de la base de datos
+        # Eliminar el dataset de la base de datos, sus exportaciones y divisiones guardadas
         dataset_result = db.datasets.delete_one({'_id': ObjectId(dataset_id)})
+        delete_export_records(db, dataset_id)
+        db.dataset_splits.delete_many({'dataset_id': dataset_id})
+        db.dataset_files.delete_many({'dataset_id': dataset_id})
+        evict_export_cache(dataset_id=dataset_id)
         
         return jsonify({
             'message': 'Dataset eliminado correctamente',
@@ -2143,18 +2315,23 @@ def delete_dataset(current_user_id, dataset_id):
 @token_required
 def import_dataset_zip(current_user_id):
     """Importar un dataset desde un archivo ZIP"""
+    return import_dataset_zip_file(current_user_id, request.files.get('file'), request.form)
+
+def import_dataset_zip_file(current_user_id, file, form):
+    """Crear un dataset a partir de un ZIP recibido en un formulario o en una subida por fragmentos"""
+    dataset_id = None
+    job_id = request_job_id(form)
     try:
-        if 'file' not in request.files:
+        if file is None:
             return jsonify({'error': 'No se encontró ningún archivo'}), 400
 
-        file = request.files['file']
         if file.filename == '':
             return jsonify({'error': 'Nombre de archivo vacío'}), 400
         
         if not file.filename.lower().endswith('.zip'):
             return jsonify({'error': 'Solo se permiten archivos ZIP'}), 400
 
-        dataset_name = request.form.get('name') or file.filename.replace('.zip', '')
+        dataset_name = form.get('name') or file.filename.replace('.zip', '')
         
         db = get_db()
         
@@ -2177,6 +2354,7 @@ def import_dataset_zip(current_user_id):
         
         result = db.datasets.insert_one(dataset_doc)
         dataset_id = str(result.inserted_id)
+        pause_dataset_watch(dataset_id)
         
         # Crear directorio usando el ID del dataset
         dataset_folder = os.path.join(IMAGE_FOLDER, dataset_id)
@@ -2200,6 +2378,7 @@ def import_dataset_zip(current_user_id):
         image_count = 0
         processed_images = []
         failed_images = []
+        duplicate_images = []
         
         for i in range(0, total_images, batch_size):
             batch = found_images[i:i + batch_size]
@@ -2217,23 +2396,19 @@ def import_dataset_zip(current_user_id):
                 original_path = image_info['original_path']
                 
                 try:
-                    # Leer y procesar imagen
-                    with open(file_path, 'rb') as img_file:
-                        image_data = img_file.read()
-                    
-                    # Verificar tamaño de imagen (limitar a 10MB)
-                    if len(image_data) > 10 * 1024 * 1024:  # 10MB
-                        print(f"Imagen {filename} demasiado grande ({len(image_data)} bytes), omitiendo")
+                    # Verificar tamaño de imagen antes de leerla (limitar a 10MB)
+                    file_size = os.path.getsize(file_path)
+                    if file_size > 10 * 1024 * 1024:  # 10MB
+                        print(f"Imagen {filename} demasiado grande ({file_size} bytes), omitiendo")
                         failed_images.append({'filename': filename, 'reason': 'Tamaño excesivo'})
                         continue
                     
-                    # Reabrir para obtener dimensiones (verify() cierra la imagen)
-                    pil_image = Image.open(file_path)
-                    width, height = pil_image.size
-                    pil_image.close()
+                    # Leer la imagen una sola vez: dimensiones, formato, orientación, hash y base64
+                    probe = probe_image(file_path, with_base64=True)
+                    width, height = probe['width'], probe['height']
                     
-                    # Convertir a base64 para MongoDB
-                    image_base64 = base64.b64encode(image_data).decode('utf-8')
+                    # Base64 para MongoDB (calculado por bloques sobre el archivo proyectado)
+                    image_base64 = probe['base64']
                     
                     # Calcular ruta relativa desde IMAGE_FOLDER
                     relative_path = os.path.relpath(file_path, IMAGE_FOLDER)
@@ -2246,9 +2421,10 @@ def import_dataset_zip(current_user_id):
                         'original_zip_path': original_path,  # Ruta original dentro del ZIP
                         'data': image_base64,
                         'content_type': f'image/{filename.split(".")[-1].lower()}',
-                        'size': len(image_data),
+                        'size': probe['size'],
                         'width': width,
                         'height': height,
+                        **probe_fields(probe),
                         'upload_date': datetime.utcnow(),
                         'dataset_id': dataset_id,
                         'user_id': current_user_id  # Asociar imagen al usuario
@@ -2261,29 +2437,32 @@ def import_dataset_zip(current_user_id):
                     failed_images.append({'filename': filename, 'reason': str(e)})
                     continue
             
-            # Insertar lote completo en MongoDB
+            # Omitir las imágenes repetidas (mismo contenido) e insertar el resto del lote
+            batch_docs, batch_duplicates = split_duplicates(db, dataset_id, batch_docs)
             if batch_docs:
-                try:
-                    result = db.images.insert_many(batch_docs)
-                    image_count += len(result.inserted_ids)
-                    print(f"Lote {batch_number} insertado: {len(result.inserted_ids)} imágenes")
-                except Exception as e:
-                    print(f"Error insertando lote {batch_number}: {e}")
-                    # Intentar insertar una por una como fallback
-                    for doc in batch_docs:
-                        try:
-                            db.images.insert_one(doc)
-                            image_count += 1
-                        except Exception as single_error:
-                            print(f"Error insertando imagen individual {doc['filename']}: {single_error}")
-                            failed_images.append({'filename': doc['filename'], 'reason': str(single_error)})
+                inserted, race_duplicates, insert_failures = insert_image_docs(db, batch_docs)
+                image_count += len(inserted)
+                print(f"Lote {batch_number} insertado: {len(inserted)} imágenes")
+                for doc, _ in inserted:
+                    link_shared_file(db, doc.get('sha256'), dataset_id,
+                                     os.path.join(IMAGE_FOLDER, doc['file_path']), IMAGE_FOLDER)
+                for doc, reason in insert_failures:
+                    print(f"Error insertando imagen individual {doc['filename']}: {reason}")
+                    failed_images.append({'filename': doc['filename'], 'reason': reason})
+                batch_duplicates += [(doc, {}) for doc in race_duplicates]
+            
+            for doc, original in batch_duplicates:
+                remove_duplicate_file(doc, original, IMAGE_FOLDER)
+                duplicate_images.append(duplicate_info(doc, original))
             
             # Limpiar memoria del lote
             del batch_docs
             
             print(f"Progreso: {image_count}/{total_images} imágenes procesadas")
+            publish_progress(current_user_id, job_id, 'dataset_import', image_count, total_images)
         
-        print(f"Procesamiento completado: {image_count} imágenes exitosas, {len(failed_images)} fallos")
+        print(f"Procesamiento completado: {image_count} imágenes exitosas, "
+              f"{len(duplicate_images)} duplicadas, {len(failed_images)} fallos")
         
         # Actualizar contador de imágenes
         db.datasets.update_one(
@@ -2298,6 +2477,7 @@ def import_dataset_zip(current_user_id):
             'total_found': total_images,
             'successfully_imported': image_count,
             'failed_imports': len(failed_images),
+            'duplicate_images': len(duplicate_images),
             'success_rate': round((image_count / total_images * 100), 2) if total_images > 0 else 0
         }
         
@@ -2306,22 +2486,35 @@ def import_dataset_zip(current_user_id):
             response_data['sample_failures'] = failed_images[:10]
             if len(failed_images) > 10:
                 response_data['additional_failures'] = len(failed_images) - 10
+        if duplicate_images:
+            response_data['sample_duplicates'] = duplicate_images[:10]
         
+        response_data['job_id'] = job_id
+        publish_progress(current_user_id, job_id, 'dataset_import', image_count, total_images,
+                         state='done', result=response_data)
         return jsonify(response_data)
         
     except Exception as e:
+        publish_progress(current_user_id, job_id, 'dataset_import', state='error', message=str(e))
         return jsonify({'error': f'Error al importar dataset: {str(e)}'}), 500
+    finally:
+        resume_dataset_watch(dataset_id)
 
 @app.route('/api/datasets/import-images', methods=['POST'])
 @token_required
 def import_images_to_dataset(current_user_id):
     """Importar imágenes desde un archivo ZIP a un dataset existente"""
+    return import_images_zip_file(current_user_id, request.files.get('file'), request.form)
+
+def import_images_zip_file(current_user_id, file, form):
+    """Añadir a un dataset las imágenes de un ZIP recibido en un formulario o en una subida por fragmentos"""
+    job_id = request_job_id(form)
+    paused_dataset_id = None
     try:
-        if 'file' not in request.files:
+        if file is None:
             return jsonify({'error': 'No se encontró ningún archivo'}), 400
 
-        file = request.files['file']
-        dataset_id = request.form.get('dataset_id')
+        dataset_id = form.get('dataset_id')
         
         if file.filename == '':
             return jsonify({'error': 'Nombre de archivo vacío'}), 400
@@ -2331,6 +2524,8 @@ def import_images_to_dataset(current_user_id):
             
         if not dataset_id:
             return jsonify({'error': 'Se requiere dataset_id'}), 400
+        if not ObjectId.is_valid(dataset_id):
+            return jsonify({'error': 'Dataset no encontrado'}), 404
 
         db = get_db()
         
@@ -2338,6 +2533,10 @@ def import_images_to_dataset(current_user_id):
         dataset = db.datasets.find_one({'_id': ObjectId(dataset_id), 'user_id': current_user_id})
         if not dataset:
             return jsonify({'error': 'Dataset no encontrado'}), 404
+
+        # Las imágenes se registran aquí; el observador de la carpeta no debe procesarlas
+        paused_dataset_id = dataset_id
+        pause_dataset_watch(paused_dataset_id)
         
         # Usar el ID del dataset para la carpeta
         dataset_folder = os.path.join(IMAGE_FOLDER, str(dataset_id))
@@ -2360,6 +2559,7 @@ def import_images_to_dataset(current_user_id):
         image_count = 0
         processed_images = []
         failed_images = []
+        duplicate_images = []
         
         for i in range(0, total_images, batch_size):
             batch = found_images[i:i + batch_size]
@@ -2377,23 +2577,19 @@ def import_images_to_dataset(current_user_id):
                 original_path = image_info['original_path']
                 
                 try:
-                    # Leer y procesar imagen
-                    with open(file_path, 'rb') as img_file:
-                        image_data = img_file.read()
-                    
-                    # Verificar tamaño de imagen (limitar a 10MB)
-                    if len(image_data) > 10 * 1024 * 1024:  # 10MB
-                        print(f"Imagen {filename} demasiado grande ({len(image_data)} bytes), omitiendo")
+                    # Verificar tamaño de imagen antes de leerla (limitar a 10MB)
+                    file_size = os.path.getsize(file_path)
+                    if file_size > 10 * 1024 * 1024:  # 10MB
+                        print(f"Imagen {filename} demasiado grande ({file_size} bytes), omitiendo")
                         failed_images.append({'filename': filename, 'reason': 'Tamaño excesivo'})
                         continue
                     
-                    # Reabrir para obtener dimensiones (verify() cierra la imagen)
-                    pil_image = Image.open(file_path)
-                    width, height = pil_image.size
-                    pil_image.close()
+                    # Leer la imagen una sola vez: dimensiones, formato, orientación, hash y base64
+                    probe = probe_image(file_path, with_base64=True)
+                    width, height = probe['width'], probe['height']
                     
-                    # Convertir a base64 para MongoDB
-                    image_base64 = base64.b64encode(image_data).decode('utf-8')
+                    # Base64 para MongoDB (calculado por bloques sobre el archivo proyectado)
+                    image_base64 = probe['base64']
                     
                     # Calcular ruta relativa desde IMAGE_FOLDER
                     relative_path = os.path.relpath(file_path, IMAGE_FOLDER)
@@ -2406,9 +2602,10 @@ def import_images_to_dataset(current_user_id):
                         'original_zip_path': original_path,  # Ruta original dentro del ZIP
                         'data': image_base64,
                         'content_type': f'image/{filename.split(".")[-1].lower()}',
-                        'size': len(image_data),
+                        'size': probe['size'],
                         'width': width,
                         'height': height,
+                        **probe_fields(probe),
                         'upload_date': datetime.utcnow(),
                         'dataset_id': dataset_id,
                         'user_id': current_user_id  # Asociar imagen al usuario
@@ -2421,37 +2618,36 @@ def import_images_to_dataset(current_user_id):
                     failed_images.append({'filename': filename, 'reason': str(e)})
                     continue
             
-            # Insertar lote completo en MongoDB
+            # Omitir las imágenes repetidas (mismo contenido) e insertar el resto del lote
+            batch_docs, batch_duplicates = split_duplicates(db, dataset_id, batch_docs)
             if batch_docs:
-                try:
-                    result = db.images.insert_many(batch_docs)
-                    image_count += len(result.inserted_ids)
-                    print(f"Lote {batch_number} insertado: {len(result.inserted_ids)} imágenes")
-                    
-                    # Agregar IDs a processed_images para compatibilidad
-                    for i, doc in enumerate(batch_docs):
-                        doc['_id'] = str(result.inserted_ids[i])
-                        processed_images.append(serialize_doc(doc))
-                        
-                except Exception as e:
-                    print(f"Error insertando lote {batch_number}: {e}")
-                    # Intentar insertar una por una como fallback
-                    for doc in batch_docs:
-                        try:
-                            result = db.images.insert_one(doc)
-                            doc['_id'] = str(result.inserted_id)
-                            processed_images.append(serialize_doc(doc))
-                            image_count += 1
-                        except Exception as single_error:
-                            print(f"Error insertando imagen individual {doc['filename']}: {single_error}")
-                            failed_images.append({'filename': doc['filename'], 'reason': str(single_error)})
+                inserted, race_duplicates, insert_failures = insert_image_docs(db, batch_docs)
+                image_count += len(inserted)
+                print(f"Lote {batch_number} insertado: {len(inserted)} imágenes")
+                
+                # Agregar IDs a processed_images para compatibilidad
+                for doc, inserted_id in inserted:
+                    link_shared_file(db, doc.get('sha256'), dataset_id,
+                                     os.path.join(IMAGE_FOLDER, doc['file_path']), IMAGE_FOLDER)
+                    doc['_id'] = str(inserted_id)
+                    processed_images.append(serialize_doc(doc))
+                for doc, reason in insert_failures:
+                    print(f"Error insertando imagen individual {doc['filename']}: {reason}")
+                    failed_images.append({'filename': doc['filename'], 'reason': reason})
+                batch_duplicates += [(doc, {}) for doc in race_duplicates]
+            
+            for doc, original in batch_duplicates:
+                remove_duplicate_file(doc, original, IMAGE_FOLDER)
+                duplicate_images.append(duplicate_info(doc, original))
             
             # Limpiar memoria del lote
             del batch_docs
             
             print(f"Progreso: {image_count}/{total_images} imágenes procesadas")
+            publish_progress(current_user_id, job_id, 'images_import', image_count, total_images)
         
-        print(f"Procesamiento completado: {image_count} imágenes exitosas, {len(failed_images)} fallos")
+        print(f"Procesamiento completado: {image_count} imágenes exitosas, "
+              f"{len(duplicate_images)} duplicadas, {len(failed_images)} fallos")
         
         # Actualizar contador de imágenes del dataset
         current_count = db.images.count_documents({'dataset_id': dataset_id})
@@ -2459,6 +2655,8 @@ def import_images_to_dataset(current_user_id):
             {'_id': ObjectId(dataset_id)},
             {'$set': {'image_count': current_count}}
         )
+        touch_dataset(db, dataset_id)
+        publish_dataset_change(dataset_id, 'images_added', count=image_count)
         
         # Preparar respuesta con estadísticas detalladas
         response_data = {
@@ -2466,6 +2664,7 @@ def import_images_to_dataset(current_user_id):
             'total_found': total_images,
             'successfully_imported': image_count,
             'failed_imports': len(failed_images),
+            'duplicate_images': len(duplicate_images),
             'success_rate': round((image_count / total_images * 100), 2) if total_images > 0 else 0,
             'images': processed_images[:10]  # Solo primeras 10 para no sobrecargar la respuesta
         }
@@ -2475,99 +2674,189 @@ def import_images_to_dataset(current_user_id):
             response_data['sample_failures'] = failed_images[:10]
             if len(failed_images) > 10:
                 response_data['additional_failures'] = len(failed_images) - 10
+        if duplicate_images:
+            response_data['sample_duplicates'] = duplicate_images[:10]
         
         if len(processed_images) > 10:
             response_data['additional_images'] = len(processed_images) - 10
             
+        response_data['job_id'] = job_id
+        publish_progress(current_user_id, job_id, 'images_import', image_count, total_images,
+                         state='done', result=response_data)
         return jsonify(response_data)
         
     except Exception as e:
+        publish_progress(current_user_id, job_id, 'images_import', state='error', message=str(e))
         return jsonify({'error': f'Error al importar imágenes: {str(e)}'}), 500
+    finally:
+        resume_dataset_watch(paused_dataset_id)
 
-@app.route('/api/datasets/<dataset_id>/reprocess-images', methods=['POST'])
+@app.route('/api/datasets/<dataset_id>/duplicates', methods=['GET'])
 @token_required
-def reprocess_images_from_folder(current_user_id, dataset_id):
-    """Reprocesar imágenes que están en carpeta pero no en base de datos"""
+def get_dataset_duplicates(current_user_id, dataset_id):
+    """Listar grupos de imágenes con el mismo contenido (SHA-256) en un dataset"""
     try:
         db = get_db()
+        dataset = db.datasets.find_one({'_id': ObjectId(dataset_id), 'user_id': current_user_id})
+        if not dataset:
+            return jsonify({'error': 'Dataset no encontrado o no autorizado'}), 403
         
-        # Verificar que el dataset existe y pertenece al usuario
-        dataset = db.datasets.find_one({
-            '_id': ObjectId(dataset_id),
+        groups = dataset_duplicate_groups(db, dataset_id)
+        return jsonify({
+            'dataset_id': dataset_id,
+            'duplicate_groups': groups,
+            'redundant_images': sum(group['count'] - 1 for group in groups)
         })
+        
+    except Exception as e:
+        return jsonify({'error': f'Error al buscar duplicados: {str(e)}'}), 500
+
+@app.route('/api/datasets/<dataset_id>/near-duplicates/compute', methods=['POST'])
+@token_required
+def compute_near_duplicates(current_user_id, dataset_id):
+    """Lanzar el cálculo de hashes perceptuales de las imágenes del dataset que no los tienen"""
+    try:
+        db = get_db()
+        dataset = db.datasets.find_one({'_id': ObjectId(dataset_id), 'user_id': current_user_id})
         if not dataset:
             return jsonify({'error': 'Dataset no encontrado o no autorizado'}), 403
         
-        # Usar el ID del dataset para la carpeta
-        dataset_folder = os.path.join(IMAGE_FOLDER, str(dataset_id))
+        def on_finish(job_db, job_dataset_id, result):
+            # La exclusión de casi duplicadas en exportaciones depende de los hashes
+            if result['hashed']:
+                touch_dataset(job_db, job_dataset_id)
         
-        if not os.path.exists(dataset_folder):
-            return jsonify({'error': 'Carpeta del dataset no encontrada'}), 404
+        # Un único trabajo por dataset: su identificador en las notificaciones es fijo
+        job_id = f'near_duplicates:{dataset_id}'
         
-        # Buscar imágenes en la carpeta que no estén en la base de datos
-        found_images = find_images_in_directory(dataset_folder)
+        def on_update(status):
+            publish_progress(current_user_id, job_id, 'near_duplicates', status['processed'], status['total'],
+                             state=status['state'], message=status['error'], result=status['result'])
         
-        # Filtrar solo las que NO están en la base de datos
-        existing_files = set()
-        existing_images = db.images.find({'dataset_id': dataset_id}, {'filename': 1})
-        for img in existing_images:
-            existing_files.add(img['filename'])
+        job = start_hash_job(get_db, dataset_id, IMAGE_FOLDER, on_finish=on_finish, on_update=on_update)
+        return jsonify({'message': 'Cálculo de hashes perceptuales iniciado', 'job': job, 'job_id': job_id}), 202
         
-        new_images = []
-        for img_info in found_images:
-            if img_info['filename'] not in existing_files:
-                new_images.append(img_info)
+    except Exception as e:
+        return jsonify({'error': f'Error al iniciar el cálculo de hashes: {str(e)}'}), 500
+
+@app.route('/api/datasets/<dataset_id>/near-duplicates', methods=['GET'])
+@token_required
+def get_near_duplicates(current_user_id, dataset_id):
+    """Grupos de imágenes casi duplicadas (hash perceptual) del dataset"""
+    try:
+        db = get_db()
+        dataset = db.datasets.find_one({'_id': ObjectId(dataset_id), 'user_id': current_user_id})
+        if not dataset:
+            return jsonify({'error': 'Dataset no encontrado o no autorizado'}), 403
         
-        total_images = len(new_images)
-        print(f"Encontradas {total_images} imágenes nuevas para procesar")
+        threshold = int(request.args.get('threshold', DEFAULT_NEAR_DUPLICATE_THRESHOLD))
+        if threshold < 0 or threshold > 32:
+            return jsonify({'error': 'threshold debe estar entre 0 y 32'}), 400
         
-        if total_images == 0:
-            return jsonify({
-                'message': 'No se encontraron imágenes nuevas para procesar',
-                'total_found': 0,
-                'successfully_imported': 0
-            })
+        clusters, hashed_count, missing_count = find_dataset_clusters(db, dataset_id, threshold)
+        return jsonify({
+            'dataset_id': dataset_id,
+            'threshold': threshold,
+            'hashed_images': hashed_count,
+            'missing_hashes': missing_count,
+            'job': hash_job_status(dataset_id),
+            'clusters': clusters,
+            'redundant_images': sum(cluster['size'] - 1 for cluster in clusters)
+        })
         
+    except Exception as e:
+        return jsonify({'error': f'Error al buscar imágenes casi duplicadas: {str(e)}'}), 500
+
+def sync_dataset_folder(db, dataset_id, user_id, remove_missing=False, progress=None):
+    """
+    Sincronizar la carpeta de un dataset con la base de datos usando el índice
+    de archivos: solo se leen los archivos nuevos o modificados desde el último
+    recorrido y los que ya no existen se detectan sin consultar las imágenes.
+
+    Args:
+        db: Base de datos
+        dataset_id: ID del dataset
+        user_id: Usuario al que se asocian las imágenes nuevas
+        remove_missing: Eliminar las imágenes (y sus anotaciones) cuyo archivo ya no existe
+        progress: Función opcional (procesadas, total) tras cada lote
+
+    Returns:
+        Dict con las estadísticas de la sincronización
+    """
+    dataset_folder = os.path.join(IMAGE_FOLDER, str(dataset_id))
+
+    with dataset_sync_lock(dataset_id):
+        ensure_indexes(db, ['dataset_files'])
+        scanned = scan_dataset_folder(dataset_folder)
+        index = load_file_index(db, dataset_id)
+        diff = diff_file_index(index, scanned)
+
+        # Archivos sin indexar que ya tienen imagen (subidas e importaciones)
+        registered = find_registered_images(db, dataset_id, diff['new'])
+        index_entries = [(path, *scanned[path], image_id, None) for path, image_id in registered.items()]
+
+        to_process = [path for path in diff['new'] if path not in registered] + diff['changed']
+        total_images = len(to_process)
+        print(f"Dataset {dataset_id}: {len(diff['new'])} archivos nuevos ({len(registered)} ya registrados), "
+              f"{len(diff['changed'])} modificados, {len(diff['removed'])} eliminados, "
+              f"{diff['unchanged']} sin cambios")
+
         # Procesar imágenes por lotes
         batch_size = 50
         image_count = 0
+        updated_count = 0
         failed_images = []
-        
+        duplicate_images = []
+
         for i in range(0, total_images, batch_size):
-            batch = new_images[i:i + batch_size]
+            batch = to_process[i:i + batch_size]
             batch_number = (i // batch_size) + 1
             total_batches = (total_images + batch_size - 1) // batch_size
-            
+
             print(f"Reprocesando lote {batch_number}/{total_batches} ({len(batch)} imágenes)")
-            
+
             batch_docs = []
-            
-            for image_info in batch:
-                file_path = image_info['file_path']
-                filename = image_info['filename']
-                
+            batch_paths = []
+
+            for path in batch:
+                file_path = os.path.join(dataset_folder, *path.split('/'))
+                filename = os.path.basename(file_path)
+                size, mtime = scanned[path]
+                existing_image_id = index.get(path, {}).get('image_id')
+
                 try:
-                    # Leer y procesar imagen
-                    with open(file_path, 'rb') as img_file:
-                        image_data = img_file.read()
-                    
-                    # Verificar tamaño de imagen (limitar a 10MB)
-                    if len(image_data) > 10 * 1024 * 1024:  # 10MB
-                        print(f"Imagen {filename} demasiado grande ({len(image_data)} bytes), omitiendo")
+                    # Verificar tamaño de imagen antes de leerla (limitar a 10MB)
+                    if size > 10 * 1024 * 1024:  # 10MB
+                        print(f"Imagen {filename} demasiado grande ({size} bytes), omitiendo")
                         failed_images.append({'filename': filename, 'reason': 'Tamaño excesivo'})
+                        index_entries.append((path, size, mtime, existing_image_id, 'Tamaño excesivo'))
                         continue
-                    
-                    # Obtener dimensiones
-                    pil_image = Image.open(file_path)
-                    width, height = pil_image.size
-                    pil_image.close()
-                    
-                    # Convertir a base64 para MongoDB
-                    image_base64 = base64.b64encode(image_data).decode('utf-8')
-                    
+
+                    # Leer la imagen una sola vez: dimensiones, formato, orientación, hash y base64
+                    probe = probe_image(file_path, with_base64=True)
+                    width, height = probe['width'], probe['height']
+
+                    # Base64 para MongoDB (calculado por bloques sobre el archivo proyectado)
+                    image_base64 = probe['base64']
+
+                    if existing_image_id:
+                        # Archivo modificado: si era un enlace duro de otro dataset, separarlo
+                        unshare_changed_file(db, existing_image_id, file_path, IMAGE_FOLDER)
+                        # y actualizar la imagen existente
+                        update_image_content(db, ObjectId(existing_image_id), probe['sha256'], image_base64, {
+                            'size': probe['size'],
+                            'width': width,
+                            'height': height,
+                            **probe_fields(probe),
+                            'modified_date': datetime.utcnow()
+                        })
+                        updated_count += 1
+                        index_entries.append((path, size, mtime, existing_image_id, None))
+                        continue
+
                     # Calcular ruta relativa desde IMAGE_FOLDER
                     relative_path = os.path.relpath(file_path, IMAGE_FOLDER)
-                    
+
                     # Crear documento de imagen
                     image_doc = {
                         'filename': filename,
@@ -2575,60 +2864,259 @@ def reprocess_images_from_folder(current_user_id, dataset_id):
                         'file_path': relative_path,
                         'data': image_base64,
                         'content_type': f'image/{filename.split(".")[-1].lower()}',
-                        'size': len(image_data),
+                        'size': probe['size'],
                         'width': width,
                         'height': height,
+                        **probe_fields(probe),
                         'upload_date': datetime.utcnow(),
                         'dataset_id': dataset_id,
-                        'user_id': ObjectId(current_user_id)
+                        'user_id': ObjectId(user_id)
                     }
-                    
+
                     batch_docs.append(image_doc)
-                    
+                    batch_paths.append(path)
+
                 except Exception as e:
                     print(f"Error procesando imagen {filename}: {e}")
                     failed_images.append({'filename': filename, 'reason': str(e)})
+                    index_entries.append((path, size, mtime, existing_image_id, str(e)))
                     continue
-            
-            # Insertar lote completo en MongoDB
+
+            # Las imágenes repetidas (mismo contenido) se enlazan a la existente en el índice
+            path_of_doc = {id(doc): path for path, doc in zip(batch_paths, batch_docs)}
+            batch_docs, batch_duplicates = split_duplicates(db, dataset_id, batch_docs)
             if batch_docs:
-                try:
-                    result = db.images.insert_many(batch_docs)
-                    image_count += len(result.inserted_ids)
-                    print(f"Lote {batch_number} insertado: {len(result.inserted_ids)} imágenes")
-                except Exception as e:
-                    print(f"Error insertando lote {batch_number}: {e}")
-                    # Intentar insertar una por una como fallback
-                    for doc in batch_docs:
-                        try:
-                            db.images.insert_one(doc)
-                            image_count += 1
-                        except Exception as single_error:
-                            print(f"Error insertando imagen individual {doc['filename']}: {single_error}")
-                            failed_images.append({'filename': doc['filename'], 'reason': str(single_error)})
+                inserted, race_duplicates, insert_failures = insert_image_docs(db, batch_docs)
+                image_count += len(inserted)
+                for doc, inserted_id in inserted:
+                    path = path_of_doc[id(doc)]
+                    index_entries.append((path, *scanned[path], str(inserted_id), None))
+                print(f"Lote {batch_number} insertado: {len(inserted)} imágenes")
+                for doc, reason in insert_failures:
+                    print(f"Error insertando imagen individual {doc['filename']}: {reason}")
+                    failed_images.append({'filename': doc['filename'], 'reason': reason})
+                batch_duplicates += [(doc, {}) for doc in race_duplicates]
             
+            for doc, original in batch_duplicates:
+                path = path_of_doc[id(doc)]
+                original_id = str(original['_id']) if original.get('_id') else None
+                index_entries.append((path, *scanned[path], original_id, None))
+                duplicate_images.append(duplicate_info(doc, original))
+
             del batch_docs
-            print(f"Progreso: {image_count}/{total_images} imágenes reprocesadas")
+            print(f"Progreso: {image_count + updated_count}/{total_images} imágenes reprocesadas")
+            if progress:
+                progress(image_count + updated_count, total_images)
+
+        # Archivos eliminados de la carpeta
+        removed_count = 0
+        if remove_missing:
+            removed_ids = [index[path]['image_id'] for path in diff['removed'] if index[path].get('image_id')]
+            if removed_ids:
+                release_image_blobs(db, {'_id': {'$in': [ObjectId(image_id) for image_id in removed_ids]}})
+                removed_count = db.images.delete_many(
+                    {'_id': {'$in': [ObjectId(image_id) for image_id in removed_ids]}}
+                ).deleted_count
+                db.annotations.delete_many({'image_id': {'$in': removed_ids}})
+
+        update_file_index(db, dataset_id, index_entries, diff['removed'])
+
+        if image_count or updated_count or removed_count:
+            # Actualizar contador de imágenes del dataset
+            current_count = db.images.count_documents({'dataset_id': dataset_id})
+            db.datasets.update_one(
+                {'_id': ObjectId(dataset_id)},
+                {'$set': {'image_count': current_count}}
+            )
+            touch_dataset(db, dataset_id)
+            publish_dataset_change(dataset_id, 'dataset_synced', added=image_count,
+                                   updated=updated_count, removed=removed_count)
+
+    return {
+        'total_found': total_images,
+        'successfully_imported': image_count,
+        'updated': updated_count,
+        'removed': len(diff['removed']),
+        'removed_images': removed_count,
+        'unchanged': diff['unchanged'],
+        'already_registered': len(registered),
+        'duplicate_images': len(duplicate_images),
+        'sample_duplicates': duplicate_images[:10],
+        'failed_imports': len(failed_images),
+        'sample_failures': failed_images[:10]
+    }
+
+@app.route('/api/datasets/<dataset_id>/reprocess-images', methods=['POST'])
+@token_required
+def reprocess_images_from_folder(current_user_id, dataset_id):
+    """Reprocesar imágenes nuevas o modificadas de la carpeta del dataset"""
+    try:
+        db = get_db()
         
-        # Actualizar contador de imágenes del dataset
-        current_count = db.images.count_documents({'dataset_id': dataset_id})
-        db.datasets.update_one(
-            {'_id': ObjectId(dataset_id)},
-            {'$set': {'image_count': current_count}}
-        )
+        # Verificar que el dataset existe y pertenece al usuario
+        dataset = db.datasets.find_one({
+            '_id': ObjectId(dataset_id),
+        })
+        if not dataset:
+            return jsonify({'error': 'Dataset no encontrado o no autorizado'}), 403
+        
+        # Usar el ID del dataset para la carpeta
+        dataset_folder = os.path.join(IMAGE_FOLDER, str(dataset_id))
+        
+        if not os.path.exists(dataset_folder):
+            return jsonify({'error': 'Carpeta del dataset no encontrada'}), 404
+        
+        # remove_missing=true elimina las imágenes cuyo archivo ya no está en la carpeta
+        data = request.get_json(silent=True) or {}
+        remove_missing = str(data.get('remove_missing', request.args.get('remove_missing', 'false'))).lower() == 'true'
+        
+        job_id = request_job_id(data)
+        stats = sync_dataset_folder(db, dataset_id, current_user_id, remove_missing=remove_missing,
+                                    progress=progress_callback(current_user_id, job_id, 'dataset_sync'))
+        stats['job_id'] = job_id
+        total_images = stats['total_found']
+        image_count = stats['successfully_imported'] + stats['updated']
+        publish_progress(current_user_id, job_id, 'dataset_sync', image_count, total_images,
+                         state='done', result=stats)
+        
+        if total_images == 0:
+            return jsonify({
+                'message': 'No se encontraron imágenes nuevas para procesar',
+                **stats
+            })
         
         return jsonify({
             'message': f'Reprocesamiento completado: {image_count} de {total_images} imágenes añadidas',
-            'total_found': total_images,
-            'successfully_imported': image_count,
-            'failed_imports': len(failed_images),
-            'success_rate': round((image_count / total_images * 100), 2) if total_images > 0 else 0,
-            'sample_failures': failed_images[:10] if failed_images else []
+            **stats,
+            'success_rate': round((image_count / total_images * 100), 2) if total_images > 0 else 0
         })
         
     except Exception as e:
         return jsonify({'error': f'Error al reprocesar imágenes: {str(e)}'}), 500
 
+# ==================== SUBIDAS POR FRAGMENTOS ====================
+
+# Función que procesa el archivo completo de cada destino
+UPLOAD_HANDLERS = {
+    'image': upload_image_file,
+    'video': upload_video_file,
+    'dataset_zip': import_dataset_zip_file,
+    'images_zip': import_images_zip_file
+}
+
+# Opciones del formulario original que se guardan con la subida
+UPLOAD_FORM_OPTIONS = ('dataset_id', 'project_id', 'name', 'fps', 'job_id')
+
+@app.route('/api/uploads', methods=['POST'])
+@token_required
+def start_chunked_upload(current_user_id):
+    """
+    Iniciar una subida por fragmentos.
+    Body JSON: filename, size, target (image, video, dataset_zip, images_zip),
+    chunk_size opcional y las opciones del formulario equivalente (dataset_id, name, fps...)
+    """
+    try:
+        data = request.get_json() or {}
+        db = get_db()
+        cleanup_stale_uploads(db)
+        options = {key: str(data[key]) for key in UPLOAD_FORM_OPTIONS if data.get(key) is not None}
+        upload = create_upload(db, current_user_id, data.get('filename'), data.get('size') or 0,
+                               data.get('target'), data.get('chunk_size'), options)
+        return jsonify(upload_status(upload)), 201
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Error al iniciar la subida: {str(e)}'}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@token_required
+def get_chunked_upload(current_user_id, upload_id):
+    """Estado de una subida: fragmentos recibidos y pendientes (para reanudarla)"""
+    upload = get_upload(get_db(), upload_id, current_user_id)
+    if not upload:
+        return jsonify({'error': 'Subida no encontrada'}), 404
+    return jsonify(upload_status(upload))
+
+@app.route('/api/uploads/<upload_id>/chunks', methods=['PUT'])
+@token_required
+def put_upload_chunk(current_user_id, upload_id):
+    """
+    Recibir un fragmento (cuerpo binario) en el desplazamiento ?offset=N.
+    La cabecera X-Chunk-Checksum lleva el SHA-256 del fragmento.
+    """
+    try:
+        db = get_db()
+        upload = get_upload(db, upload_id, current_user_id)
+        if not upload:
+            return jsonify({'error': 'Subida no encontrada'}), 404
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({'error': 'Se requiere offset'}), 400
+        status = write_chunk(db, upload, offset, request.stream, request.headers.get('X-Chunk-Checksum'))
+        return jsonify(status)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Error al guardar el fragmento: {str(e)}'}), 500
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@token_required
+def complete_chunked_upload(current_user_id, upload_id):
+    """
+    Procesar el archivo completo como la ruta de subida o importación equivalente.
+    Body JSON opcional: sha256 del archivo completo.
+    """
+    db = get_db()
+    upload = get_upload(db, upload_id, current_user_id)
+    if not upload:
+        return jsonify({'error': 'Subida no encontrada'}), 404
+    if upload['status'] == 'completed':
+        return jsonify(upload['result']['body']), upload['result']['status_code']
+
+    missing = missing_chunks(upload)
+    if missing:
+        return jsonify({'error': f'Faltan {len(missing)} fragmentos', **upload_status(upload)}), 409
+
+    expected_sha256 = (request.get_json(silent=True) or {}).get('sha256')
+    if expected_sha256 and expected_sha256.lower() != file_sha256(upload_path(upload)):
+        return jsonify({'error': 'El checksum del archivo no coincide'}), 400
+
+    if not claim_upload(db, upload):
+        return jsonify({'error': 'La subida ya se está procesando'}), 409
+
+    file = assembled_file(upload, mimetypes.guess_type(upload['filename'])[0])
+    try:
+        response = app.make_response(UPLOAD_HANDLERS[upload['target']](
+            current_user_id, file, dict(upload.get('options', {}))
+        ))
+    except Exception as e:
+        release_upload(db, upload)
+        return jsonify({'error': f'Error al procesar la subida: {str(e)}'}), 500
+    finally:
+        file.close()
+
+    if response.status_code >= 400 and os.path.exists(upload_path(upload)):
+        # El archivo no se ha consumido: se puede corregir y volver a completar
+        release_upload(db, upload)
+    else:
+        body = response.get_json() or {}
+        if isinstance(body.get('image'), dict):
+            # No guardar el contenido de la imagen en el registro de la subida
+            body['image'] = {key: value for key, value in body['image'].items() if key != 'data'}
+        finish_upload(db, upload, {'status_code': response.status_code, 'body': body})
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@token_required
+def cancel_chunked_upload(current_user_id, upload_id):
+    """Cancelar una subida y borrar los fragmentos recibidos"""
+    db = get_db()
+    upload = get_upload(db, upload_id, current_user_id)
+    if not upload:
+        return jsonify({'error': 'Subida no encontrada'}), 404
+    abort_upload(db, upload)
+    return jsonify({'message': 'Subida cancelada'})
+
 # ==================== IMPORTAR ANOTACIONES ====================
 
 @app.route('/api/annotations/import', methods=['POST'])
@@ -2674,6 +3162,9 @@ def import_annotations(current_user_id):
         else:
             return jsonify({'error': f'Formato no soportado: {annotation_format}'}), 400
         
+        touch_dataset(db, dataset_id)
+        publish_dataset_change(dataset_id, 'annotations_imported', format=annotation_format, stats=stats)
+        
         return jsonify({
             'message': f'Anotaciones importadas exitosamente desde formato {annotation_format.upper()}',
             'stats': stats
@@ -2682,86 +3173,17 @@ def import_annotations(current_user_id):
     except Exception as e:
         return jsonify({'error': f'Error al importar anotaciones: {str(e)}'}), 500
 
-def merge_coco_json_files(json_files_data):
+def process_coco_format(db, annotations_file, images_file, dataset_id, user_id):
     """
-    Combina múltiples archivos JSON de formato COCO en uno solo.
-    Soporta: instances_*.json, captions_*.json, person_keypoints_*.json
+    Procesar archivo COCO JSON o ZIP con múltiples JSONs, con búsqueda por nombre de imagen dentro del dataset
     
-    Args:
-        json_files_data: Lista de diccionarios con datos COCO
-    
-    Returns:
-        Diccionario COCO combinado con images, annotations y categories unificadas
+    El JSON se lee como flujo (categorías, imágenes y anotaciones por separado)
+    y las anotaciones pasan directamente a inserciones por lotes, así que la
+    memoria no depende del tamaño del archivo.
     """
-    merged = {
-        'images': [],
-        'annotations': [],
-        'categories': []
-    }
-    
-    image_ids_seen = set()
-    category_ids_seen = {}  # {original_id: new_id}
-    annotation_id_counter = 1
-    
-    for coco_data in json_files_data:
-        # Combinar imágenes (evitar duplicados por image_id y file_name)
-        if 'images' in coco_data:
-            for img in coco_data['images']:
-                img_identifier = (img['id'], img.get('file_name', ''))
-                if img_identifier not in image_ids_seen:
-                    image_ids_seen.add(img_identifier)
-                    merged['images'].append(img)
-        
-        # Combinar categorías (evitar duplicados por nombre)
-        if 'categories' in coco_data:
-            for cat in coco_data['categories']:
-                # Buscar si ya existe una categoría con el mismo nombre
-                existing_cat = next(
-                    (c for c in merged['categories'] if c['name'] == cat['name']), 
-                    None
-                )
-                
-                if existing_cat:
-                    # Mapear el ID antiguo al ID existente
-                    category_ids_seen[cat['id']] = existing_cat['id']
-                else:
-                    # Agregar nueva categoría
-                    merged['categories'].append(cat)
-                    category_ids_seen[cat['id']] = cat['id']
-        
-        # Combinar anotaciones
-        if 'annotations' in coco_data:
-            for ann in coco_data['annotations']:
-                # Crear copia para no modificar original
-                new_ann = ann.copy()
-                
-                # Asignar nuevo ID de anotación
-                new_ann['id'] = annotation_id_counter
-                annotation_id_counter += 1
-                
-                # Actualizar category_id si fue remapeado
-                if ann['category_id'] in category_ids_seen:
-                    new_ann['category_id'] = category_ids_seen[ann['category_id']]
-                
-                merged['annotations'].append(new_ann)
-    
-    # Agregar metadata
-    merged['info'] = {
-        'description': 'Merged COCO dataset',
-        'date_created': datetime.utcnow().isoformat(),
-        'merged_files': len(json_files_data)
-    }
-    
-    return merged
-
-
-def process_coco_format(db, annotations_file, images_file, dataset_id, user_id):
-    """Procesar archivo COCO JSON o ZIP con múltiples JSONs, con búsqueda por nombre de imagen dentro del dataset"""
-    import json
     import zipfile
     import tempfile
     import random
-    from bson import ObjectId
     from datetime import datetime
     import os
 
@@ -2769,177 +3191,116 @@ def process_coco_format(db, annotations_file, images_file, dataset_id, user_id):
         """Generar un color aleatorio en formato hex"""
         return f"#{random.randint(0, 0xFFFFFF):06x}"
 
-    coco_data = None
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Guardar la subida en disco para leerla por flujo (JSON o ZIP)
+        upload_path = os.path.join(temp_dir, 'upload')
+        annotations_file.save(upload_path)
+
+        json_errors = []
+        if zipfile.is_zipfile(upload_path):
+            json_paths = []
+            for member_name, path in extract_coco_json_files(upload_path, temp_dir):
+                try:
+                    validate_coco_file(path)
+                    json_paths.append(path)
+                except ValueError as e:
+                    json_errors.append(f"{member_name}: {e}")
+            if not json_paths:
+                raise ValueError("No se encontraron archivos JSON válidos")
+        else:
+            try:
+                validate_coco_file(upload_path)
+            except ValueError:
+                raise ValueError("El archivo no es un JSON válido ni un ZIP válido")
+            json_paths = [upload_path]
 
-    # Intentar cargar JSON o ZIP
-    try:
-        annotations_file.seek(0)
-        coco_data = json.load(annotations_file)
-    except json.JSONDecodeError:
-        annotations_file.seek(0)
-        try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                with zipfile.ZipFile(annotations_file, 'r') as zip_ref:
-                    zip_ref.extractall(temp_dir)
-                json_files = []
-                for root, _, files in os.walk(temp_dir):
-                    for file in files:
-                        if file.endswith('.json'):
-                            with open(os.path.join(root, file), 'r') as f:
-                                try:
-                                    json_files.append(json.load(f))
-                                except Exception:
-                                    continue
-                if len(json_files) == 1:
-                    coco_data = json_files[0]
-                elif len(json_files) > 1:
-                    coco_data = merge_coco_json_files(json_files)
-                else:
-                    raise ValueError("No se encontraron archivos JSON válidos")
-        except zipfile.BadZipFile:
-            raise ValueError("El archivo no es un JSON válido ni un ZIP válido")
+        ctx = create_import_context(db, dataset_id, user_id)
+        stats = ctx['stats']
+        stats['errors'].extend(json_errors)
 
-    if not coco_data:
-        raise ValueError("Archivo COCO inválido")
+        # Varios JSON (p. ej. train/val) se combinan en un único flujo con ids
+        # remapeados; las categorías y las imágenes se resuelven en cuanto aparecen
+        category_map = {}
+        image_map = {}
+        for section, item in merge_coco_streams([coco_file_source(path) for path in json_paths]):
+            if section == 'categories':
+                # ================================
+                # CREAR / MAPEAR CATEGORÍAS
+                # ================================
+                color = item.get('color', generate_random_color())
+                if not color.startswith('#') or len(color) != 7:
+                    color = generate_random_color()
+
+                # Buscar por nombre en las categorías del dataset actual (o crearla)
+                category_id, created = get_or_create_category(ctx, item['name'], color,
+                                                              extra_fields={'annotation_count': 0})
+                category_map[item['id']] = category_id
+                if created:
+                    print(f"🆕 Categoría creada: {item['name']} ({color})")
+
+            elif section == 'images':
+                # =====================================
+                # MAPEAR IMÁGENES POR NOMBRE DENTRO DEL DATASET
+                # =====================================
+                filename = item['file_name']
+                existing_img = find_image(ctx, filename)
 
-    stats = {'images': 0, 'annotations': 0, 'categories': 0, 'errors': []}
+                if existing_img:
+                    image_map[item['id']] = str(existing_img['_id'])
+                    stats['images'] += 1
+                else:
+                    stats['errors'].append(f"No se encontró la imagen {filename} en el dataset actual")
 
-    # ================================
-    # CREAR / MAPEAR CATEGORÍAS
-    # ================================
-    category_map = {}
-    if 'categories' in coco_data:
-        for cat in coco_data['categories']:
-            cat_name = cat['name']
-            color = cat.get('color', generate_random_color())
-            if not color.startswith('#') or len(color) != 7:
-                color = generate_random_color()
-
-            # Buscar por nombre en las categorías del dataset actual
-            existing = db.categories.find_one({'name': cat_name, 'dataset_id': dataset_id})
-            if existing:
-                category_map[cat['id']] = str(existing['_id'])
-                print(f"OK: Categoría existente: {cat_name}")
             else:
-                # Crear nueva categoría en el dataset actual
-                new_cat = {
-                    'name': cat_name,
-                    'color': color,
-                    'dataset_id': dataset_id,
+                # =====================================
+                # IMPORTAR ANOTACIONES (por flujo y lotes)
+                # =====================================
+                ann = item
+                image_id = image_map.get(ann['image_id'])
+                category_id = category_map.get(ann['category_id'])
+                if not image_id or not category_id:
+                    continue
+
+                bbox = ann.get('bbox', [0, 0, 0, 0])
+                area = ann.get('area', 0) or (bbox[2] * bbox[3] if len(bbox) >= 4 else 0)
+
+                annotation_doc = {
+                    'image_id': image_id,
+                    'category_id': category_id,
+                    'bbox': bbox,
+                    'area': area,
+                    'type': 'bbox',
+                    'stroke': category_color(ctx, category_id),
+                    'strokeWidth': 2,
+                    'fill': 'rgba(0,255,0,0.2)',
+                    'closed': False,
                     'created_date': datetime.utcnow(),
-                    'annotation_count': 0,
-                    'user_id': user_id  # Asociar categoría al usuario
+                    'modified_date': datetime.utcnow(),
+                    'user_id': user_id  # Asociar anotación al usuario
                 }
-                result = db.categories.insert_one(new_cat)
-                category_map[cat['id']] = str(result.inserted_id)
-                stats['categories'] += 1
-                print(f"🆕 Categoría creada: {cat_name} ({color})")
-
-    # =====================================
-    # MAPEAR IMÁGENES POR NOMBRE DENTRO DEL DATASET
-    # =====================================
-    image_map = {}
-    if 'images' in coco_data:
-        for img in coco_data['images']:
-            filename = img['file_name']
-            existing_img = db.images.find_one({
-                'filename': filename,
-                'dataset_id': dataset_id  # <-- Solo dentro del dataset actual
-            })
-
-            if existing_img:
-                image_map[img['id']] = str(existing_img['_id'])
-                stats['images'] += 1
-                print(f"INFO: Imagen encontrada en dataset: {filename}")
-            else:
-                stats['errors'].append(f"No se encontró la imagen {filename} en el dataset actual")
-                print(f"AVISO: Imagen no encontrada en dataset: {filename}")
-
-    # =====================================
-    # IMPORTAR ANOTACIONES
-    # =====================================
-    category_annotation_count = {}
-
-    for ann in coco_data.get('annotations', []):
-        image_id = image_map.get(ann['image_id'])
-        category_id = category_map.get(ann['category_id'])
-        if not image_id or not category_id:
-            continue
 
-        bbox = ann.get('bbox', [0, 0, 0, 0])
-        area = ann.get('area', 0) or (bbox[2] * bbox[3] if len(bbox) >= 4 else 0)
+                # Polígonos (segmentación)
+                if 'segmentation' in ann and ann['segmentation']:
+                    seg = ann['segmentation'][0] if isinstance(ann['segmentation'], list) else []
+                    if seg and isinstance(seg, list) and len(seg) >= 6:  # Al menos 3 puntos (6 valores)
+                        points = [[seg[i], seg[i+1]] for i in range(0, len(seg), 2)]
+                        annotation_doc['points'] = points
+                        annotation_doc['type'] = 'polygon'
+                        annotation_doc['closed'] = True
 
-        # Obtener color de la categoría para el stroke
-        category_color = '#00ff00'  # Color por defecto
-        try:
-            category_doc = db.categories.find_one({'_id': ObjectId(category_id)})
-            if category_doc and 'color' in category_doc:
-                category_color = category_doc['color']
-        except Exception:
-            pass
+                # Se omiten los duplicados (umbral más estricto para importaciones)
+                add_annotation(ctx, annotation_doc, iou_threshold=0.9)
 
-        annotation_doc = {
-            'image_id': image_id,
-            'category_id': category_id,
-            'bbox': bbox,
-            'area': area,
-            'type': 'bbox',
-            'stroke': category_color,
-            'strokeWidth': 2,
-            'fill': 'rgba(0,255,0,0.2)',
-            'closed': False,
-            'created_date': datetime.utcnow(),
-            'modified_date': datetime.utcnow(),
-            'user_id': user_id  # Asociar anotación al usuario
-        }
+        print(f"INFO: {len(json_paths)} archivos COCO, {stats['images']} imágenes encontradas en el dataset")
 
-        # Polígonos (segmentación)
-        if 'segmentation' in ann and ann['segmentation']:
-            seg = ann['segmentation'][0] if isinstance(ann['segmentation'], list) else []
-            if seg and isinstance(seg, list) and len(seg) >= 6:  # Al menos 3 puntos (6 valores)
-                points = [[seg[i], seg[i+1]] for i in range(0, len(seg), 2)]
-                annotation_doc['points'] = points
-                annotation_doc['type'] = 'polygon'
-                annotation_doc['closed'] = True
-
-        # Verificar duplicados antes de crear la anotación
-        duplicate_result = check_annotation_duplicate_advanced(
-            db, 
-            image_id, 
-            category_id, 
-            category_doc.get('name', 'default') if category_doc else 'default', 
-            bbox,
-            iou_threshold=0.9  # Umbral más estricto para importaciones
-        )
-        
-        if duplicate_result['is_duplicate']:
-            print(f"AVISO: Anotación duplicada omitida (IoU: {duplicate_result['iou']:.3f})")
-            continue  # Saltar esta anotación
-        
-        db.annotations.insert_one(annotation_doc)
-        stats['annotations'] += 1
-        category_annotation_count[category_id] = category_annotation_count.get(category_id, 0) + 1
-
-    # =====================================
-    # ACTUALIZAR CONTADOR DE CATEGORÍAS
-    # =====================================
-    for category_id, count in category_annotation_count.items():
-        total = db.annotations.count_documents({'category_id': category_id})
-        db.categories.update_one(
-            {'_id': ObjectId(category_id)},
-            {'$set': {'annotation_count': total}}
-        )
-        print(f"INFO: Categoría {category_id}: {total} anotaciones totales")
-
-    return stats
+    # Escribir el último lote y actualizar el contador de las categorías
+    return finish_import(ctx)
 
 def process_yolo_format(db, annotations_file, images_file, dataset_id, user_id):
     """Procesar formato YOLO (ZIP con archivos .txt)"""
     import zipfile
     import tempfile
     
-    stats = {'images': 0, 'annotations': 0, 'categories': 0, 'errors': []}
-    
     # Extraer ZIP a directorio temporal
     with tempfile.TemporaryDirectory() as temp_dir:
         with zipfile.ZipFile(annotations_file, 'r') as zip_ref:
@@ -2963,28 +3324,19 @@ def process_yolo_format(db, annotations_file, images_file, dataset_id, user_id):
                 print(f"INFO: Archivo classes.txt encontrado en {classes_file}")
                 print(f"INFO: Clases encontradas: {classes}")
                 
+                # Precargar imágenes, categorías y anotaciones existentes del dataset
+                ctx = create_import_context(db, dataset_id, user_id)
+                stats = ctx['stats']
+                
                 # Crear o encontrar categorías en el dataset actual
                 for idx, class_name in enumerate(classes):
-                    existing = db.categories.find_one({
-                        'name': class_name,
-                        'dataset_id': dataset_id
-                    })
-                    
-                    if existing:
-                        category_map[idx] = str(existing['_id'])
-                        print(f"OK: Categoría existente: {class_name} (idx={idx})")
-                    else:
-                        new_cat = {
-                            'name': class_name,
-                            'color': f"#{hash(class_name) & 0xFFFFFF:06x}",
-                            'dataset_id': dataset_id,
-                            'created_date': datetime.utcnow(),
-                            'user_id': user_id  # Asociar categoría al usuario
-                        }
-                        result = db.categories.insert_one(new_cat)
-                        category_map[idx] = str(result.inserted_id)
-                        stats['categories'] += 1
+                    category_map[idx], created = get_or_create_category(
+                        ctx, class_name, f"#{hash(class_name) & 0xFFFFFF:06x}"
+                    )
+                    if created:
                         print(f"OK: Categoría creada: {class_name} (idx={idx})")
+                    else:
+                        print(f"OK: Categoría existente: {class_name} (idx={idx})")
             except Exception as e:
                 print(f"ERROR: Error leyendo classes.txt: {e}")
                 return {'images': 0, 'annotations': 0, 'categories': 0, 'errors': [f'Error leyendo classes.txt: {str(e)}']}
@@ -3009,19 +3361,9 @@ def process_yolo_format(db, annotations_file, images_file, dataset_id, user_id):
         print(f"INFO: Encontrados {len(annotation_files_with_paths)} archivos de anotaciones")
         
         for filename, full_path, parent_dir in annotation_files_with_paths:
-            # Buscar imagen correspondiente en el dataset actual
+            # Buscar imagen correspondiente en el dataset actual (probando extensiones)
             image_name = filename.replace('.txt', '')
-            # Intentar con diferentes extensiones
-            existing_img = None
-            for ext in ['.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG']:
-                img_filename = image_name + ext
-                # Buscar en el dataset especificado
-                existing_img = db.images.find_one({
-                    'filename': img_filename,
-                    'dataset_id': dataset_id
-                })
-                if existing_img:
-                    break
+            existing_img = find_image_by_stem(ctx, image_name, YOLO_IMAGE_EXTENSIONS)
             
             if not existing_img:
                 print(f"AVISO: Imagen no encontrada para anotaciones: {filename} - Ignorando")
@@ -3104,31 +3446,14 @@ def process_yolo_format(db, annotations_file, images_file, dataset_id, user_id):
                         'user_id': user_id  # Asociar anotación al usuario
                     }
                     
-                    # Verificar duplicados antes de crear la anotación
-                    if category_id:
-                        category_doc = db.categories.find_one({'_id': ObjectId(category_id)})
-                        category_name = category_doc.get('name', 'default') if category_doc else 'default'
-                        
-                        duplicate_result = check_annotation_duplicate_advanced(
-                            db, 
-                            image_id, 
-                            category_id, 
-                            category_name, 
-                            bbox,
-                            iou_threshold=0.9  # Umbral más estricto para importaciones
-                        )
-                        
-                        if duplicate_result['is_duplicate']:
-                            print(f"AVISO: Anotación YOLO duplicada omitida (IoU: {duplicate_result['iou']:.3f})")
-                            continue  # Saltar esta anotación
-                    
-                    db.annotations.insert_one(annotation_doc)
-                    stats['annotations'] += 1
+                    # Se omiten los duplicados (umbral más estricto para importaciones)
+                    add_annotation(ctx, annotation_doc, iou_threshold=0.9)
             except Exception as read_error:
                 print(f"AVISO: Error leyendo archivo {filename}: {read_error} - Ignorando")
                 continue
     
-    return stats
+    # Escribir el último lote y actualizar el contador de las categorías
+    return finish_import(ctx)
 
 def process_pascal_format(db, annotations_file, images_file, dataset_id, user_id):
     """Procesar formato PascalVOC (ZIP con archivos .xml)"""
@@ -3136,7 +3461,9 @@ def process_pascal_format(db, annotations_file, images_file, dataset_id, user_id
     import tempfile
     import xml.etree.ElementTree as ET
     
-    stats = {'images': 0, 'annotations': 0, 'categories': 0, 'errors': []}
+    # Precargar imágenes, categorías y anotaciones existentes del dataset
+    ctx = create_import_context(db, dataset_id, user_id)
+    stats = ctx['stats']
     category_map = {}
     
     # Extraer ZIP a directorio temporal
@@ -3152,8 +3479,6 @@ def process_pascal_format(db, annotations_file, images_file, dataset_id, user_id
                     xml_files.append(os.path.join(root_dir, file))
         
         print(f"Archivos XML encontrados: {len(xml_files)}")
-        for xml_file in xml_files:
-            print(f"  - {xml_file}")
         
         # Procesar archivos .xml
         for xml_path in xml_files:
@@ -3179,20 +3504,15 @@ def process_pascal_format(db, annotations_file, images_file, dataset_id, user_id
                 
                 # Obtener nombre de la imagen
                 image_filename = root.find('filename').text if root.find('filename') is not None else filename.replace('.xml', '.jpg')
-                print(f"Buscando imagen: {image_filename} en dataset: {dataset_id}")
                 
                 # Buscar imagen en el dataset actual
-                existing_img = db.images.find_one({
-                    'filename': image_filename,
-                    'dataset_id': dataset_id
-                })
+                existing_img = find_image(ctx, image_filename)
                 if not existing_img:
                     print(f"AVISO: Imagen no encontrada para anotaciones: {image_filename} - Ignorando")
                     continue
                 
                 image_id = str(existing_img['_id'])
                 stats['images'] += 1
-                print(f"  ✓ Imagen encontrada: {image_filename}")
                 
                 # Procesar cada objeto anotado
                 objects = root.findall('object')
@@ -3211,24 +3531,10 @@ def process_pascal_format(db, annotations_file, images_file, dataset_id, user_id
                     
                     # Crear o encontrar categoría en el dataset actual
                     if name not in category_map:
-                        existing_cat = db.categories.find_one({
-                            'name': name,
-                            'dataset_id': dataset_id
-                        })
-                        
-                        if existing_cat:
-                            category_map[name] = str(existing_cat['_id'])
-                        else:
-                            new_cat = {
-                                'name': name,
-                                'color': f"#{hash(name) & 0xFFFFFF:06x}",
-                                'dataset_id': dataset_id,
-                                'created_date': datetime.utcnow(),
-                                'user_id': user_id  # Asociar categoría al usuario
-                            }
-                            result = db.categories.insert_one(new_cat)
-                            category_map[name] = str(result.inserted_id)
-                            stats['categories'] += 1
+                        category_map[name], created = get_or_create_category(
+                            ctx, name, f"#{hash(name) & 0xFFFFFF:06x}"
+                        )
+                        if created:
                             print(f"Categoría creada: {name}")
                     
                     # Obtener coordenadas del bounding box
@@ -3265,27 +3571,14 @@ def process_pascal_format(db, annotations_file, images_file, dataset_id, user_id
                         'user_id': user_id  # Asociar anotación al usuario
                     }
                     
-                    # Verificar duplicados antes de crear la anotación
-                    duplicate_result = check_annotation_duplicate_advanced(
-                        db, 
-                        image_id, 
-                        category_map[name], 
-                        name, 
-                        bbox,
-                        iou_threshold=0.8  # Umbral más estricto para importaciones
-                    )
-                    
-                    if duplicate_result['is_duplicate']:
-                        print(f"AVISO: Anotación Pascal duplicada omitida (IoU: {duplicate_result['iou']:.3f})")
-                        continue  # Saltar esta anotación
-                    
-                    db.annotations.insert_one(annotation_doc)
-                    stats['annotations'] += 1
+                    # Se omiten los duplicados (umbral más estricto para importaciones)
+                    add_annotation(ctx, annotation_doc, iou_threshold=0.8)
                     
             except Exception as e:
                 stats['errors'].append(f"Error procesando {filename}: {str(e)}")
     
-    return stats
+    # Escribir el último lote y actualizar el contador de las categorías
+    return finish_import(ctx)
 
 # ==================== HEALTH CHECK ====================
 
@@ -3300,6 +3593,9 @@ def health_check():
         return jsonify({
             'status': 'healthy',
             'mongodb': 'connected',
+            # Listo cuando ha terminado la carga al arrancar del modelo precargado (si la hay)
+            'ready': _model_preload['status'] != 'loading',
+            'model_preload': dict(_model_preload),
             'timestamp': datetime.utcnow().isoformat()
         })
     except Exception as e:
@@ -3310,34 +3606,38 @@ def health_check():
             'timestamp': datetime.utcnow().isoformat()
         }), 500
 
-# ==================== FUNCIONES AUXILIARES PARA DIVISIÓN DE DATASET ====================
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas en formato Prometheus (latencia por endpoint, Mongo, etapas costosas)"""
+    if not metrics_authorized():
+        return jsonify({'error': 'No autorizado'}), 401
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
-def split_dataset_random(images, train_pct, val_pct, test_pct):
+@app.route('/api/health/indexes', methods=['GET'])
+def indexes_report():
     """
-    Divide una lista de imágenes aleatoriamente en train/val/test
-    según los porcentajes dados.
+    Índices declarados que faltan, índices sin uso ($indexStats) y consultas
+    frecuentes que no usan índice (explain). Muestra detalles de toda la base
+    de datos: solo con METRICS_TOKEN (sin él, usar python db_indexes.py)
     """
-    import random
-    
-    # 1. Barajar la lista de imágenes aleatoriamente
-    random.shuffle(images)
-    
-    # 2. Calcular los puntos de corte
-    total_images = len(images)
-    train_count = int(total_images * (train_pct / 100))
-    val_count = int(total_images * (val_pct / 100))
-    
-    # 3. Cortar la lista en tres partes
-    train_images = images[0:train_count]
-    val_images = images[train_count : train_count + val_count]
-    test_images = images[train_count + val_count:] # El resto va a test
-    
-    print(f"División aleatoria: {len(train_images)} train, {len(val_images)} val, {len(test_images)} test")
-    
-    return train_images, val_images, test_images
+    if not metrics_authorized(required=True):
+        return jsonify({'error': 'No autorizado'}), 401
+    try:
+        db = get_db()
+        report = index_report(db)
+        queries = explain_queries(db)
+        return jsonify({
+            'collections': report,
+            'missing': {name: info['missing'] for name, info in report.items() if info['missing']},
+            'unused': {name: info['unused'] for name, info in report.items() if info['unused']},
+            'queries_without_index': [row for row in queries
+                                      if row.get('error') or row['collscan'] or row['in_memory_sort']],
+            'queries': queries
+        })
+    except Exception as e:
+        return jsonify({'error': f'Error al generar el informe de índices: {str(e)}'}), 500
 
-def export_coco_format_with_split(dataset, train_images, val_images, test_images, 
-                                   annotations, categories, include_images, db):
+def export_coco_format_with_split(dataset, plan, categories, include_images, db, pretty=True):
     """Exportar en formato COCO con división train/val/test"""
     from flask import Response
     import tempfile
@@ -3346,35 +3646,19 @@ def export_coco_format_with_split(dataset, train_images, val_images, test_images
     temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     
     try:
-        with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
-            # Exportar cada conjunto
-            for split_name, split_images in [('train', train_images), 
-                                              ('val', val_images), 
-                                              ('test', test_images)]:
-                if not split_images:
-                    continue
-                
-                # Filtrar anotaciones para este conjunto
-                split_image_ids = [str(img['_id']) for img in split_images]
-                split_annotations = [ann for ann in annotations 
-                                    if ann['image_id'] in split_image_ids]
-                
-                # Crear estructura COCO para este conjunto
+        with timed('zip_build'), zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for split_name, split_images in plan['splits']:
+                # Estructura COCO de este conjunto desde el índice por imagen
+                split_annotations = plan_annotations(plan, split_images)
                 coco_data = create_coco_structure(dataset, split_images, 
                                                  split_annotations, categories)
-                
-                # Guardar JSON
-                zf.writestr(f'{split_name}/annotations.json', 
-                           json.dumps(coco_data, indent=2))
+                # En este proceso: enviar el documento a otro proceso costaría lo mismo que serializarlo
+                zf.writestr(f'{split_name}/annotations.json', serialize_json((coco_data, pretty)))
                 
                 # Si incluye imágenes, agregarlas
                 if include_images:
-                    for img in split_images:
-                        img_doc = db.images.find_one({'_id': ObjectId(img['_id'])})
-                        if img_doc and 'data' in img_doc:
-                            image_data = img_doc['data']
-                            zf.writestr(f"{split_name}/images/{img['filename']}", 
-                                       image_data)
+                    write_images_to_zip(zf, db, split_images, IMAGE_FOLDER,
+                                        prefix=f'{split_name}/')
         
         with open(temp_zip.name, 'rb') as f:
             zip_data = f.read()
@@ -3540,8 +3824,7 @@ def create_coco_structure(dataset, images, annotations, categories):
     
     return coco_data
 
-def export_yolo_format_with_split(dataset, train_images, val_images, test_images,
-                                   annotations, categories, include_images, db):
+def export_yolo_format_with_split(dataset, plan, categories, include_images, db):
     """Exportar en formato YOLO con división train/val/test"""
     from flask import Response
     import tempfile
@@ -3549,7 +3832,7 @@ def export_yolo_format_with_split(dataset, train_images, val_images, test_images
     temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     
     try:
-        with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with timed('zip_build'), zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
             # Crear archivo de clases
             classes_content = '\n'.join([cat['name'] for cat in categories])
             zf.writestr('classes.txt', classes_content)
@@ -3558,48 +3841,19 @@ def export_yolo_format_with_split(dataset, train_images, val_images, test_images
             category_map = {str(cat['_id']): idx for idx, cat in enumerate(categories)}
             
             # Exportar cada conjunto
-            for split_name, split_images in [('train', train_images), 
-                                              ('val', val_images), 
-                                              ('test', test_images)]:
-                if not split_images:
-                    continue
+            for split_name, split_images in plan['splits']:
+                # Renderizar los .txt en paralelo y escribirlos en orden
+                tasks = [yolo_label_task(img, image_annotations(plan, img), category_map)
+                         for img in split_images]
                 
-                for img in split_images:
-                    img_id = str(img['_id'])
-                    img_annotations = [ann for ann in annotations if ann['image_id'] == img_id]
-                    
-                    # Crear archivo YOLO para esta imagen
-                    yolo_lines = []
-                    for ann in img_annotations:
-                        cat_idx = category_map.get(ann['category_id'])
-                        if cat_idx is None:
-                            continue
-                        
-                        bbox = ann.get('bbox', [0, 0, 0, 0])
-                        if len(bbox) < 4:
-                            continue
-                        
-                        # Convertir bbox COCO [x, y, width, height] a YOLO [center_x, center_y, width, height] normalizado
-                        img_width = img.get('width', 1)
-                        img_height = img.get('height', 1)
-                        
-                        center_x = (bbox[0] + bbox[2] / 2) / img_width
-                        center_y = (bbox[1] + bbox[3] / 2) / img_height
-                        width = bbox[2] / img_width
-                        height = bbox[3] / img_height
-                        
-                        yolo_lines.append(f"{cat_idx} {center_x:.6f} {center_y:.6f} {width:.6f} {height:.6f}")
-                    
-                    # Guardar archivo de anotaciones
+                for img, label_content in zip(split_images, render_files(render_yolo_label, tasks)):
                     txt_filename = os.path.splitext(img['filename'])[0] + '.txt'
-                    zf.writestr(f'{split_name}/labels/{txt_filename}', '\n'.join(yolo_lines))
-                    
-                    # Si incluye imágenes, agregarlas
-                    if include_images:
-                        img_doc = db.images.find_one({'_id': ObjectId(img['_id'])})
-                        if img_doc and 'data' in img_doc:
-                            image_data = img_doc['data']
-                            zf.writestr(f"{split_name}/images/{img['filename']}", image_data)
+                    zf.writestr(f'{split_name}/labels/{txt_filename}', label_content)
+                
+                # Si incluye imágenes, agregarlas por lotes
+                if include_images:
+                    write_images_to_zip(zf, db, split_images, IMAGE_FOLDER,
+                                        prefix=f'{split_name}/')
         
         with open(temp_zip.name, 'rb') as f:
             zip_data = f.read()
@@ -3616,80 +3870,33 @@ def export_yolo_format_with_split(dataset, train_images, val_images, test_images
             os.unlink(temp_zip.name)
         raise e
 
-def export_pascal_format_with_split(dataset, train_images, val_images, test_images,
-                                     annotations, categories, include_images, db):
+def export_pascal_format_with_split(dataset, plan, categories, include_images, db, pretty=True):
     """Exportar en formato Pascal VOC con división train/val/test"""
     from flask import Response
     import tempfile
-    from xml.etree.ElementTree import Element, SubElement, tostring
-    from xml.dom import minidom
     
     temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     
     try:
-        with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with timed('zip_build'), zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
             # Mapeo de categorías
             category_map = {str(cat['_id']): cat['name'] for cat in categories}
             
             # Exportar cada conjunto
-            for split_name, split_images in [('train', train_images), 
-                                              ('val', val_images), 
-                                              ('test', test_images)]:
-                if not split_images:
-                    continue
+            for split_name, split_images in plan['splits']:
+                # Construir los XML Pascal VOC en paralelo y escribirlos en orden
+                tasks = [pascal_xml_task(img, image_annotations(plan, img), category_map,
+                                         folder=split_name, pretty=pretty)
+                         for img in split_images]
                 
-                for img in split_images:
-                    img_id = str(img['_id'])
-                    img_annotations = [ann for ann in annotations if ann['image_id'] == img_id]
-                    
-                    # Crear XML Pascal VOC
-                    annotation = Element('annotation')
-                    
-                    folder = SubElement(annotation, 'folder')
-                    folder.text = split_name
-                    
-                    filename = SubElement(annotation, 'filename')
-                    filename.text = img['filename']
-                    
-                    size = SubElement(annotation, 'size')
-                    width = SubElement(size, 'width')
-                    width.text = str(img.get('width', 0))
-                    height = SubElement(size, 'height')
-                    height.text = str(img.get('height', 0))
-                    depth = SubElement(size, 'depth')
-                    depth.text = '3'
-                    
-                    for ann in img_annotations:
-                        cat_name = category_map.get(ann['category_id'], 'unknown')
-                        bbox = ann.get('bbox', [0, 0, 0, 0])
-                        
-                        obj = SubElement(annotation, 'object')
-                        name = SubElement(obj, 'name')
-                        name.text = cat_name
-                        
-                        bndbox = SubElement(obj, 'bndbox')
-                        xmin = SubElement(bndbox, 'xmin')
-                        xmin.text = str(int(bbox[0]))
-                        ymin = SubElement(bndbox, 'ymin')
-                        ymin.text = str(int(bbox[1]))
-                        xmax = SubElement(bndbox, 'xmax')
-                        xmax.text = str(int(bbox[0] + bbox[2]))
-                        ymax = SubElement(bndbox, 'ymax')
-                        ymax.text = str(int(bbox[1] + bbox[3]))
-                    
-                    # Convertir a string XML formateado
-                    xml_str = minidom.parseString(tostring(annotation)).toprettyxml(indent='  ')
-                    
-                    # Guardar XML
+                for img, xml_str in zip(split_images, render_files(render_pascal_xml, tasks)):
                     xml_filename = os.path.splitext(img['filename'])[0] + '.xml'
                     zf.writestr(f'{split_name}/annotations/{xml_filename}', xml_str)
-                    
-                    # Si incluye imágenes, agregarlas
-                    if include_images:
-                        img_doc = db.images.find_one({'_id': ObjectId(img['_id'])})
-                        if img_doc and 'data' in img_doc:
-                            image_data = img_doc['data']
-                            zf.writestr(f"{split_name}/images/{img['filename']}", image_data)
+                
+                # Si incluye imágenes, agregarlas por lotes
+                if include_images:
+                    write_images_to_zip(zf, db, split_images, IMAGE_FOLDER,
+                                        prefix=f'{split_name}/')
         
         with open(temp_zip.name, 'rb') as f:
             zip_data = f.read()
@@ -3711,7 +3918,15 @@ def export_pascal_format_with_split(dataset, train_images, val_images, test_imag
 @app.route('/api/annotations/export/<dataset_id>', methods=['GET'])
 @token_required
 def export_annotations(current_user_id, dataset_id):
-    """Exportar anotaciones en diferentes formatos (COCO, YOLO, PascalVOC)"""
+    """
+    Exportar anotaciones en diferentes formatos (COCO, YOLO, PascalVOC)
+    
+    Las exportaciones se guardan en caché según la versión del dataset y las
+    opciones (cache=false para regenerar). Con since=<export_id> se genera una
+    exportación diferencial con solo las imágenes y etiquetas que cambiaron
+    desde esa exportación, más un 'delta.json' con las rutas eliminadas.
+    El id de cada exportación se devuelve en la cabecera X-Export-Id.
+    """
     try:
         db = get_db()
         
@@ -3731,62 +3946,138 @@ def export_annotations(current_user_id, dataset_id):
         train_percentage = float(request.args.get('train_percentage', 80))
         val_percentage = float(request.args.get('val_percentage', 10))
         test_percentage = float(request.args.get('test_percentage', 10))
+        # División reproducible: semilla, estratificación por categoría y frames de un video juntos
+        split_seed = int(request.args.get('split_seed', 0))
+        stratify = request.args.get('stratify', 'false').lower() == 'true'
+        group_by_video = request.args.get('group_by_video', 'true').lower() == 'true'
+        # pretty=false genera JSON/XML compactos (más rápidos); sin parámetro se
+        # mantiene el formato por defecto de cada exportador
+        pretty_arg = request.args.get('pretty')
+        format_options = {} if pretty_arg is None else {'pretty': pretty_arg.lower() == 'true'}
+        since_export_id = request.args.get('since')
+        use_cache = request.args.get('cache', 'true').lower() == 'true'
+        # Excluir imágenes casi duplicadas (distancia de Hamming máxima; 0 = no excluir)
+        near_duplicate_threshold = int(request.args.get('exclude_near_duplicates', 0))
+        
+        if export_format not in ('coco', 'yolo', 'pascal'):
+            return jsonify({'error': f'Formato no soportado: {export_format}'}), 400
+        
+        # Opciones que determinan el contenido de la exportación
+        export_options = {
+            'format': export_format,
+            'include_images': include_images,
+            'only_annotated': only_annotated,
+            'enable_split': enable_split,
+            'split': [train_percentage, val_percentage, test_percentage,
+                      split_seed, stratify, group_by_video] if enable_split else None,
+            'near_duplicates': near_duplicate_threshold,
+            'pretty': pretty_arg,
+            'since': since_export_id
+        }
         
-        # Obtener dataset
-        dataset = db.datasets.find_one({'_id': ObjectId(dataset_id)})
-        if not dataset:
-            return jsonify({'error': 'Dataset no encontrado'}), 404
-        
-        # Obtener imágenes
+        # Servir desde caché si el dataset no ha cambiado desde una exportación idéntica
+        cache_key = export_cache_key(dataset, export_options)
+        cached = get_cached_export(cache_key) if use_cache else None
+        if cached:
+            cache_path, cache_meta = cached
+            print(f"Exportación servida desde caché: {cache_meta['export_id']}")
+            response = send_file(cache_path, mimetype=cache_meta['mimetype'])
+            response.headers['Content-Disposition'] = cache_meta['content_disposition']
+            response.headers['X-Export-Id'] = cache_meta['export_id']
+            return response
+        
+        # Exportación base para el modo diferencial
+        base_manifest = None
+        if since_export_id:
+            base = load_export_record(db, since_export_id, dataset_id, current_user_id)
+            if not base:
+                return jsonify({'error': 'Exportación base no encontrada'}), 404
+            base_record, base_manifest = base
+            if not delta_options_match(base_record['options'], export_options):
+                return jsonify({'error': 'La exportación diferencial debe usar el mismo formato y opciones que la exportación base'}), 400
+        
+        # Obtener imágenes (sin el contenido: se lee por lotes al escribir el ZIP)
         image_query = {'dataset_id': dataset_id}
-        images = list(db.images.find(image_query))
-        
-        # Si only_annotated está activado, filtrar solo las que tienen anotaciones
-        if only_annotated:
-            image_ids = [str(img['_id']) for img in images]
-            annotated_image_ids = db.annotations.distinct('image_id', {'image_id': {'$in': image_ids}})
-            images = [img for img in images if str(img['_id']) in annotated_image_ids]
+        images = list(db.images.find(image_query, {'data': 0}))
         
-        # Obtener todas las anotaciones del dataset
+        # Obtener todas las anotaciones del dataset en una sola consulta
         image_ids = [str(img['_id']) for img in images]
         annotations = list(db.annotations.find({'image_id': {'$in': image_ids}}))
         
+        # Agrupar anotaciones por imagen una sola vez (y filtrar si only_annotated)
+        plan = build_export_plan(images, annotations, only_annotated=only_annotated)
+        
+        # Conservar solo una imagen (la más anotada) de cada grupo de casi duplicadas
+        if near_duplicate_threshold > 0:
+            annotation_counts = {image_id: len(anns) for image_id, anns in plan['annotations_by_image'].items()}
+            excluded = near_duplicate_exclusions(plan['images'], near_duplicate_threshold, annotation_counts)
+            filter_plan_images(plan, [str(img['_id']) for img in plan['images']
+                                      if str(img['_id']) not in excluded])
+            print(f"Excluidas {len(excluded)} imágenes casi duplicadas")
+        
         # Obtener categorías del dataset
         categories = list(db.categories.find({'dataset_id': dataset_id}))
         
-        print(f"Exportando: {len(images)} imágenes, {len(annotations)} anotaciones, {len(categories)} categorías")
+        print(f"Exportando: {len(plan['images'])} imágenes, {len(annotations)} anotaciones, {len(categories)} categorías")
         
         # Si está habilitada la división, dividir las imágenes
         if enable_split:
-            train_images, val_images, test_images = split_dataset_random(
-                images, train_percentage, val_percentage, test_percentage
+            train_images, val_images, test_images = split_dataset(
+                db, dataset_id, plan['images'], plan['annotations_by_image'],
+                train_percentage, val_percentage, test_percentage,
+                seed=split_seed, stratify=stratify, group_by_video=group_by_video
             )
+            set_plan_splits(plan, train_images, val_images, test_images)
             print(f"División: {len(train_images)} train, {len(val_images)} val, {len(test_images)} test")
-            
+        
+        # Manifiesto de la exportación completa (base de futuras exportaciones diferenciales)
+        manifest = build_export_manifest(plan, categories)
+        
+        delta = None
+        if base_manifest is not None:
+            delta = diff_manifests(base_manifest, manifest)
+            filter_plan_images(plan, delta['changed_ids'])
+            print(f"Exportación diferencial: {len(delta['changed'])} imágenes cambiadas, {len(delta['deleted'])} eliminadas")
+        
+        if enable_split:
             if export_format == 'coco':
-                return export_coco_format_with_split(
-                    dataset, train_images, val_images, test_images, 
-                    annotations, categories, include_images, db
-                )
+                response = export_coco_format_with_split(dataset, plan, categories, include_images, db, **format_options)
             elif export_format == 'yolo':
-                return export_yolo_format_with_split(
-                    dataset, train_images, val_images, test_images,
-                    annotations, categories, include_images, db
-                )
-            elif export_format == 'pascal':
-                return export_pascal_format_with_split(
-                    dataset, train_images, val_images, test_images,
-                    annotations, categories, include_images, db
-                )
+                response = export_yolo_format_with_split(dataset, plan, categories, include_images, db)
+            else:
+                response = export_pascal_format_with_split(dataset, plan, categories, include_images, db, **format_options)
         else:
             if export_format == 'coco':
-                return export_coco_format(dataset, images, annotations, categories, include_images)
+                response = export_coco_format(dataset, plan, categories, include_images, **format_options)
             elif export_format == 'yolo':
-                return export_yolo_format(dataset, images, annotations, categories, include_images, db)
-            elif export_format == 'pascal':
-                return export_pascal_format(dataset, images, annotations, categories, include_images, db)
+                response = export_yolo_format(dataset, plan, categories, include_images, db)
             else:
-                return jsonify({'error': f'Formato no soportado: {export_format}'}), 400
+                response = export_pascal_format(dataset, plan, categories, include_images, db, **format_options)
+        
+        # Registrar la exportación para poder generar diferenciales desde ella
+        export_id = record_export(db, dataset, current_user_id, export_options, manifest,
+                                  base_export_id=since_export_id)
+        
+        if delta is not None:
+            response = add_delta_manifest(response, {
+                'export_id': export_id,
+                'base_export_id': since_export_id,
+                'full_resync': delta['full_resync'],
+                'changed': delta['changed'],
+                'deleted': delta['deleted']
+            })
+        
+        response.headers['X-Export-Id'] = export_id
+        
+        if use_cache:
+            store_export(cache_key, response.get_data(), {
+                'dataset_id': dataset_id,
+                'export_id': export_id,
+                'mimetype': response.mimetype,
+                'content_disposition': response.headers.get('Content-Disposition', '')
+            })
+        
+        return response
             
     except InvalidId:
         return jsonify({'error': 'ID de dataset inválido'}), 400
@@ -3821,12 +4112,12 @@ def get_export_statistics(current_user_id, dataset_id):
         
         # Obtener imágenes
         image_query = {'dataset_id': dataset_id}
-        all_images = list(db.images.find(image_query))
+        all_images = list(db.images.find(image_query, {'data': 0}))
         
         # Filtrar imágenes según parámetros
         if only_annotated:
             image_ids = [str(img['_id']) for img in all_images]
-            annotated_image_ids = db.annotations.distinct('image_id', {'image_id': {'$in': image_ids}})
+            annotated_image_ids = set(db.annotations.distinct('image_id', {'image_id': {'$in': image_ids}}))
             filtered_images = [img for img in all_images if str(img['_id']) in annotated_image_ids]
         else:
             filtered_images = all_images
@@ -3851,11 +4142,14 @@ def get_export_statistics(current_user_id, dataset_id):
         print(f"Error al obtener estadísticas de exportación: {e}")
         return jsonify({'error': str(e)}), 500
 
-def export_coco_format(dataset, images, annotations, categories, include_images):
+def export_coco_format(dataset, plan, categories, include_images, pretty=True):
     """Exportar en formato COCO JSON con soporte para videos"""
     from flask import Response
     import tempfile
     
+    images = plan['images']
+    annotations = plan_annotations(plan, images)
+    
     # Crear estructura COCO extendida con videos
     coco_data = {
         'info': {
@@ -4001,7 +4295,7 @@ def export_coco_format(dataset, images, annotations, categories, include_images)
     
     # Si no se incluyen imágenes, solo devolver JSON
     if not include_images:
-        json_str = json.dumps(coco_data, indent=2)
+        json_str = serialize_json((coco_data, pretty))
         return Response(
             json_str,
             mimetype='application/json',
@@ -4013,16 +4307,12 @@ def export_coco_format(dataset, images, annotations, categories, include_images)
     temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     
     try:
-        with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with timed('zip_build'), zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
             # Agregar JSON de anotaciones
-            zf.writestr('annotations.json', json.dumps(coco_data, indent=2))
+            zf.writestr('annotations.json', serialize_json((coco_data, pretty)))
             
             # Agregar imágenes
-            for img in images:
-                img_doc = db.images.find_one({'_id': ObjectId(img['_id'])})
-                if img_doc and 'data' in img_doc:
-                    image_data = img_doc['data']
-                    zf.writestr(f"images/{img['filename']}", image_data)
+            write_images_to_zip(zf, db, images, IMAGE_FOLDER)
         
         with open(temp_zip.name, 'rb') as f:
             zip_data = f.read()
@@ -4039,15 +4329,16 @@ def export_coco_format(dataset, images, annotations, categories, include_images)
             os.unlink(temp_zip.name)
         raise e
 
-def export_yolo_format(dataset, images, annotations, categories, include_images, db):
+def export_yolo_format(dataset, plan, categories, include_images, db):
     """Exportar en formato YOLO"""
     from flask import Response
     import tempfile
     
+    images = plan['images']
     temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     
     try:
-        with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with timed('zip_build'), zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
             # Crear mapeo de categorías
             category_map = {}
             category_names = []
@@ -4058,45 +4349,19 @@ def export_yolo_format(dataset, images, annotations, categories, include_images,
             # Escribir archivo classes.txt
             zf.writestr('classes.txt', '\n'.join(category_names))
             
-            # Procesar cada imagen
-            for img in images:
-                img_id = str(img['_id'])
-                img_width = img.get('width', 1)
-                img_height = img.get('height', 1)
-                
-                # Obtener anotaciones de esta imagen
-                img_annotations = [ann for ann in annotations if ann['image_id'] == img_id]
-                
-                if not img_annotations and not include_images:
-                    continue
-                
-                # Crear archivo de anotaciones YOLO
-                yolo_lines = []
-                for ann in img_annotations:
-                    category_id = category_map.get(ann['category_id'])
-                    if category_id is None:
-                        continue
-                    
-                    bbox = ann.get('bbox', [0, 0, 0, 0])
-                    x, y, w, h = bbox
-                    
-                    # Convertir a formato YOLO (normalizado)
-                    x_center = (x + w / 2) / img_width
-                    y_center = (y + h / 2) / img_height
-                    width_norm = w / img_width
-                    height_norm = h / img_height
-                    
-                    yolo_lines.append(f"{category_id} {x_center:.6f} {y_center:.6f} {width_norm:.6f} {height_norm:.6f}")
-                
-                # Escribir archivo de anotaciones
+            # Imágenes con archivo de etiquetas (sin anotaciones solo si se incluyen imágenes)
+            label_images = [img for img in images if include_images or image_annotations(plan, img)]
+            tasks = [yolo_label_task(img, image_annotations(plan, img), category_map)
+                     for img in label_images]
+            
+            # Renderizar en paralelo y escribir en orden
+            for img, label_content in zip(label_images, render_files(render_yolo_label, tasks)):
                 txt_filename = os.path.splitext(img['filename'])[0] + '.txt'
-                zf.writestr(f"labels/{txt_filename}", '\n'.join(yolo_lines))
-                
-                # Incluir imagen si se solicita
-                if include_images:
-                    img_doc = db.images.find_one({'_id': ObjectId(img_id)})
-                    if img_doc and 'data' in img_doc:
-                        zf.writestr(f"images/{img['filename']}", img_doc['data'])
+                zf.writestr(f"labels/{txt_filename}", label_content)
+            
+            # Incluir imágenes si se solicita
+            if include_images:
+                write_images_to_zip(zf, db, images, IMAGE_FOLDER)
         
         with open(temp_zip.name, 'rb') as f:
             zip_data = f.read()
@@ -4113,72 +4378,33 @@ def export_yolo_format(dataset, images, annotations, categories, include_images,
             os.unlink(temp_zip.name)
         raise e
 
-def export_pascal_format(dataset, images, annotations, categories, include_images, db):
+def export_pascal_format(dataset, plan, categories, include_images, db, pretty=False):
     """Exportar en formato PascalVOC XML"""
     from flask import Response
     import tempfile
-    import xml.etree.ElementTree as ET
     
+    images = plan['images']
     temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     
     try:
-        with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with timed('zip_build'), zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
             # Crear mapeo de categorías
             category_names = {str(cat['_id']): cat['name'] for cat in categories}
             
-            # Procesar cada imagen
-            for img in images:
-                img_id = str(img['_id'])
-                
-                # Obtener anotaciones de esta imagen
-                img_annotations = [ann for ann in annotations if ann['image_id'] == img_id]
-                
-                if not img_annotations and not include_images:
-                    continue
-                
-                # Crear XML
-                annotation = ET.Element('annotation')
-                
-                # Información de la imagen
-                ET.SubElement(annotation, 'folder').text = dataset.get('name', 'dataset')
-                ET.SubElement(annotation, 'filename').text = img['filename']
-                
-                size = ET.SubElement(annotation, 'size')
-                ET.SubElement(size, 'width').text = str(img.get('width', 0))
-                ET.SubElement(size, 'height').text = str(img.get('height', 0))
-                ET.SubElement(size, 'depth').text = '3'
-                
-                # Agregar objetos
-                for ann in img_annotations:
-                    obj = ET.SubElement(annotation, 'object')
-                    
-                    category_name = category_names.get(ann['category_id'], 'unknown')
-                    ET.SubElement(obj, 'name').text = category_name
-                    ET.SubElement(obj, 'pose').text = 'Unspecified'
-                    ET.SubElement(obj, 'truncated').text = '0'
-                    ET.SubElement(obj, 'difficult').text = '0'
-                    
-                    bbox = ann.get('bbox', [0, 0, 0, 0])
-                    x, y, w, h = bbox
-                    
-                    bndbox = ET.SubElement(obj, 'bndbox')
-                    ET.SubElement(bndbox, 'xmin').text = str(int(x))
-                    ET.SubElement(bndbox, 'ymin').text = str(int(y))
-                    ET.SubElement(bndbox, 'xmax').text = str(int(x + w))
-                    ET.SubElement(bndbox, 'ymax').text = str(int(y + h))
-                
-                # Convertir a string XML
-                xml_str = ET.tostring(annotation, encoding='unicode')
-                
-                # Escribir archivo XML
+            # Imágenes con XML (sin anotaciones solo si se incluyen imágenes)
+            xml_images = [img for img in images if include_images or image_annotations(plan, img)]
+            tasks = [pascal_xml_task(img, image_annotations(plan, img), category_names,
+                                     folder=dataset.get('name', 'dataset'), extended=True, pretty=pretty)
+                     for img in xml_images]
+            
+            # Construir los XML en paralelo y escribirlos en orden
+            for img, xml_str in zip(xml_images, render_files(render_pascal_xml, tasks)):
                 xml_filename = os.path.splitext(img['filename'])[0] + '.xml'
                 zf.writestr(f"annotations/{xml_filename}", xml_str)
-                
-                # Incluir imagen si se solicita
-                if include_images:
-                    img_doc = db.images.find_one({'_id': ObjectId(img_id)})
-                    if img_doc and 'data' in img_doc:
-                        zf.writestr(f"images/{img['filename']}", img_doc['data'])
+            
+            # Incluir imágenes si se solicita
+            if include_images:
+                write_images_to_zip(zf, db, images, IMAGE_FOLDER)
         
         with open(temp_zip.name, 'rb') as f:
             zip_data = f.read()
@@ -4200,11 +4426,8 @@ def export_pascal_format(dataset, images, annotations, categories, include_image
 import yaml
 import shutil
 
-# Variable global para almacenar el modelo cargado
-loaded_model = None
-loaded_model_id = None
-model_name = None
-model_categories = []
+# Modelo activo: en este proceso o en el servicio de inferencia (INFERENCE_URL)
+inference = inference_backend()
 
 # Directorio permanente para modelos guardados
 MODELS_DIR = os.path.join(os.getcwd(), 'ai_models')
@@ -4217,6 +4440,8 @@ def ensure_preloaded_models():
     """
     Asegura que los modelos precargados estén registrados en la base de datos.
     Lee el archivo preloaded_models.json y registra los modelos si existen.
+    Con "load_on_start": true el modelo además se carga al arrancar (ver
+    preload_model_in_background).
     """
     if not os.path.exists(PRELOADED_MODELS_CONFIG):
         return
@@ -4292,7 +4517,8 @@ def ensure_preloaded_models():
                         'is_preloaded': True,
                         'name': name,
                         'description': model_config.get('description', existing_model.get('description', '')),
-                        'categories': categories or existing_model.get('categories', [])
+                        'categories': categories or existing_model.get('categories', []),
+                        'load_on_start': bool(model_config.get('load_on_start'))
                     }}
                 )
             else:
@@ -4310,7 +4536,8 @@ def ensure_preloaded_models():
                     'created_at': model_config.get('created_at', datetime.now().isoformat()),
                     'file_size': os.path.getsize(model_path),
                     'original_filename': os.path.basename(model_path),
-                    'is_preloaded': True
+                    'is_preloaded': True,
+                    'load_on_start': bool(model_config.get('load_on_start'))
                 }
                 
                 db.ai_models.insert_one(model_doc)
@@ -4326,6 +4553,58 @@ try:
 except Exception as e:
     print(f"Error al inicializar modelos precargados: {e}")
 
+def model_variant_paths(model_doc):
+    """{nombre: ruta} de las variantes de un modelo guardado (p. ej. la cuantizada) que existen"""
+    return {name: variant['path'] for name, variant in (model_doc.get('variants') or {}).items()
+            if os.path.exists(variant.get('path', ''))}
+
+# Intentos de la precarga mientras el servicio de inferencia no responde (INFERENCE_URL)
+MODEL_PRELOAD_ATTEMPTS = 12
+MODEL_PRELOAD_RETRY_SECONDS = 5
+
+# Estado de la carga al arrancar del modelo precargado con load_on_start (ver /api/health)
+_model_preload = {'status': 'disabled', 'model_id': None, 'model_name': None, 'seconds': None, 'error': None}
+
+def preload_model_in_background():
+    """
+    Cargar y calentar (ver inference.warmup) el modelo precargado marcado con
+    load_on_start sin retrasar el arranque, para que la primera predicción no
+    pague la carga ni la inicialización del modelo. Con varios workers cada uno
+    lo carga en su proceso; con el servicio de inferencia solo el primero
+    (reuse_loaded).
+    """
+    model_doc = get_db().ai_models.find_one({'is_preloaded': True, 'load_on_start': True})
+    if not model_doc:
+        return
+    if not os.path.exists(model_doc['file_path']):
+        print(f"Modelo precargado no encontrado: {model_doc['file_path']}")
+        return
+    _model_preload.update(status='loading', model_id=str(model_doc['_id']), model_name=model_doc['name'])
+
+    def run():
+        start = time.perf_counter()
+        for attempt in range(MODEL_PRELOAD_ATTEMPTS):
+            try:
+                status = inference.load_model(model_doc['file_path'], str(model_doc['_id']), model_doc['name'],
+                                              model_doc['categories'], model_variant_paths(model_doc),
+                                              reuse_loaded=True)
+            except RuntimeError as e:
+                _model_preload['error'] = str(e)
+                # Sin servicio de inferencia el error no se arregla reintentando
+                if inference.__name__ != 'inference_client' or attempt == MODEL_PRELOAD_ATTEMPTS - 1:
+                    break
+                time.sleep(MODEL_PRELOAD_RETRY_SECONDS)
+                continue
+            warmup = status.get('warmup') or {}
+            _model_preload.update(status='ready', error=warmup.get('error'),
+                                  seconds=round(time.perf_counter() - start, 2))
+            print(f"Modelo precargado cargado al arrancar: {model_doc['name']} ({_model_preload['seconds']}s)")
+            return
+        _model_preload['status'] = 'failed'
+        print(f"Error al cargar el modelo precargado {model_doc['name']}: {_model_preload['error']}")
+
+    threading.Thread(target=run, name='model-preload', daemon=True).start()
+
 def _generate_color_not_in_set(used_colors_set):
     """
     Genera un color único que NO está en el set proporcionado.
@@ -4453,6 +4732,10 @@ def ensure_model_categories_exist(dataset_id, model_categories, user_id=None):
             # para evitar que se cree de nuevo si el nombre está duplicado
             # en la lista `model_categories`
             existing_names_map[category_name] = category_doc
+
+    # Las categorías nuevas cambian las exportaciones del dataset (caché de exportación)
+    if created_categories:
+        touch_dataset(db, dataset_id)
     
     return created_categories
 
@@ -4522,8 +4805,6 @@ def get_saved_models(current_user_id):
 @token_required
 def load_saved_model(current_user_id):
     """Cargar un modelo previamente guardado y crear sus categorías en el dataset"""
-    global loaded_model, loaded_model_id, model_name, model_categories
-    
     try:
         data = request.get_json()
         model_id = data.get('model_id')
@@ -4532,9 +4813,6 @@ def load_saved_model(current_user_id):
         if not model_id:
             return jsonify({'error': 'ID de modelo requerido'}), 400
         
-        # Importar YOLO solo cuando sea necesario
-        from ultralytics import YOLO
-        
         db = get_db()
         
         # Verificar que el modelo pertenece al usuario o es precargado
@@ -4554,23 +4832,15 @@ def load_saved_model(current_user_id):
         if not os.path.exists(model_path):
             return jsonify({'error': 'Archivo de modelo no encontrado'}), 404
         
-        # Detectar si es un archivo TorchScript
-        if model_path.endswith('.torchscript'):
-            import torch
-            try:
-                # Cargar en GPU si está disponible, sino en CPU
-                device = 'cuda' if torch.cuda.is_available() else 'cpu'
-                loaded_model = torch.jit.load(model_path, map_location=device)
-                loaded_model.eval()  # Poner en modo evaluación
-                print(f"Modelo TorchScript cargado en: {device}")
-            except Exception as e:
-                return jsonify({'error': f'Error al cargar modelo TorchScript: {str(e)}'}), 500
-        else:
-            loaded_model = YOLO(model_path)
-        
-        model_name = model_doc['name']
-        model_categories = model_doc['categories']
-        loaded_model_id = str(model_doc['_id'])
+        # YOLO de ultralytics o TorchScript según la extensión (ver inference), con sus
+        # variantes (p. ej. la cuantizada) para que cada predicción elija
+        try:
+            status = inference.load_model(model_path, str(model_doc['_id']), model_doc['name'],
+                                          model_doc['categories'], model_variant_paths(model_doc))
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 500
+        model_name = status['model_name']
+        model_categories = status['categories']
         
         # Crear categorías del modelo en el dataset si se proporciona dataset_id
         created_categories = []
@@ -4581,6 +4851,7 @@ def load_saved_model(current_user_id):
             'success': True,
             'message': f'Modelo "{model_name}" cargado exitosamente',
             'categories': model_categories,
+            'variants': status.get('variants', []),
             'created_categories': [serialize_doc(cat) for cat in created_categories],
             'model_info': {
                 'id': str(model_doc['_id']),
@@ -4599,12 +4870,7 @@ def load_saved_model(current_user_id):
 @token_required
 def load_ai_model(current_user_id):
     """Cargar un modelo YOLO para inferencia y guardarlo en la base de datos"""
-    global loaded_model, loaded_model_id, model_name, model_categories
-    
     try:
-        # Importar YOLO solo cuando sea necesario
-        from ultralytics import YOLO
-        
         # Verificar que se envió un archivo de modelo
         if 'model_file' not in request.files:
             return jsonify({'error': 'No se encontró archivo de modelo'}), 400
@@ -4629,8 +4895,6 @@ def load_ai_model(current_user_id):
         permanent_model_path = os.path.join(model_dir, model_filename)
         model_file.save(permanent_model_path)
         
-        # Cargar el modelo YOLO para obtener información
-        loaded_model = YOLO(permanent_model_path)
         model_name = submitted_name
         
         # Intentar cargar categorías desde archivo YAML si se proporciona
@@ -4653,28 +4917,15 @@ def load_ai_model(current_user_id):
                 print(f"Error al leer archivo YAML: {e}")
                 model_categories = []
         
-        # Si aún no hay categorías, intentar obtenerlas del modelo
-        if not model_categories:
-            try:
-                # Algunos modelos YOLO tienen información de clases
-                if hasattr(loaded_model, 'names'):
-                    model_categories = list(loaded_model.names.values())
-                else:
-                    # Intentar determinar el número de clases del modelo
-                    num_classes = getattr(loaded_model.model, 'nc', None) if hasattr(loaded_model, 'model') else None
-                    if num_classes:
-                        model_categories = [f'Clase_{i}' for i in range(num_classes)]
-                    else:
-                        # Si no se puede determinar, usar una clase genérica
-                        model_categories = ['Objeto_detectado']
-            except Exception as e:
-                print(f"Error al obtener categorías del modelo: {e}")
-                # Fallback genérico sin asumir tipo de modelo
-                model_categories = ['Objeto_detectado']
+        # Cargar el modelo YOLO; sin YAML las categorías son las clases del modelo
+        model_id = ObjectId()
+        status = inference.load_model(permanent_model_path, str(model_id), submitted_name, model_categories)
+        model_categories = status['categories']
         
         # Guardar información del modelo en la base de datos
         db = get_db()
         model_doc = {
+            '_id': model_id,
             'name': submitted_name,
             'description': description,
             'file_path': permanent_model_path,
@@ -4690,7 +4941,6 @@ def load_ai_model(current_user_id):
         
         result = db.ai_models.insert_one(model_doc)
         model_doc['_id'] = str(result.inserted_id)
-        loaded_model_id = str(result.inserted_id)
         
         # Crear categorías del modelo en el dataset si se proporciona dataset_id
         created_categories = []
@@ -4719,22 +4969,20 @@ def load_ai_model(current_user_id):
         except:
             pass
         
-        loaded_model = None
-        model_name = None
-        model_categories = []
+        # No dejar activo un modelo que no se ha podido registrar
+        if 'model_id' in locals():
+            try:
+                inference.unload_model(str(model_id))
+            except Exception:
+                pass
         return jsonify({'error': f'Error al cargar el modelo: {str(e)}'}), 500
 
 @app.route('/api/ai/unload-model', methods=['POST'])
 @token_required
 def unload_ai_model(current_user_id):
     """Descargar el modelo actual"""
-    global loaded_model, loaded_model_id, model_name, model_categories
-    
     try:
-        loaded_model = None
-        loaded_model_id = None
-        model_name = None
-        model_categories = []
+        inference.unload_model()
         
         # Limpiar archivos temporales
         temp_dir = '/tmp/ai_models'
@@ -4751,8 +4999,6 @@ def unload_ai_model(current_user_id):
 @token_required
 def delete_ai_model(current_user_id, model_id):
     """Eliminar un modelo personalizado (no precargado)"""
-    global loaded_model, loaded_model_id, model_name, model_categories
-    
     try:
         if not ObjectId.is_valid(model_id):
             return jsonify({'error': 'ID de modelo inválido'}), 400
@@ -4792,16 +5038,20 @@ def delete_ai_model(current_user_id, model_id):
                 if model_path and os.path.exists(model_path):
                     os.remove(model_path)
                     print(f"Archivo de modelo eliminado: {model_path}")
+                # Conversión a ONNX y variantes guardadas junto al modelo
+                if model_path:
+                    for sibling in (onnx_path_for(model_path), quantized_path_for(model_path)):
+                        if os.path.exists(sibling):
+                            os.remove(sibling)
         except Exception as file_error:
             print(f"Error al eliminar archivos del modelo {model_id}: {file_error}")
             # No fallar la operación si solo hay error al eliminar archivos
         
         # Si el modelo eliminado es el que está cargado, descargarlo
-        if loaded_model_id == str(model_doc['_id']):
-            loaded_model = None
-            loaded_model_id = None
-            model_name = None
-            model_categories = []
+        try:
+            inference.unload_model(str(model_doc['_id']))
+        except Exception as e:
+            print(f"Error al descargar el modelo eliminado {model_id}: {e}")
         
         return jsonify({
             'success': True,
@@ -4812,19 +5062,266 @@ def delete_ai_model(current_user_id, model_id):
         print(f"Error al eliminar modelo: {e}")
         return jsonify({'error': f'Error al eliminar modelo: {str(e)}'}), 500
 
+# Imágenes por consulta de anotaciones al recorrer un dataset para calibrar o evaluar
+MODEL_SAMPLES_BATCH = 64
+
+def dataset_model_samples(db, dataset_id, limit, annotated=False):
+    """
+    Imágenes de un dataset para calibrar o evaluar un modelo, de una en una
+
+    Yields:
+        (imagen PIL en RGB, [(categoría, [x, y, ancho, alto]), ...]) con las
+        anotaciones manuales de caja; con annotated=True se omiten las
+        imágenes sin ninguna
+    """
+    category_names = {str(category['_id']): category['name']
+                      for category in db.categories.find({'dataset_id': dataset_id}, {'name': 1})}
+    produced = 0
+    cursor = db.images.find({'dataset_id': dataset_id}).sort('_id', 1)
+    while produced < limit:
+        batch = list(itertools.islice(cursor, MODEL_SAMPLES_BATCH))
+        if not batch:
+            return
+        # Anotaciones de todo el lote en una sola consulta
+        ground_truth_by_image = {}
+        for annotation in db.annotations.find({'image_id': {'$in': [str(image_doc['_id']) for image_doc in batch]},
+                                               'type': 'bbox', 'source': {'$ne': 'ai_prediction'}},
+                                              {'image_id': 1, 'category_id': 1, 'bbox': 1}):
+            name = category_names.get(annotation.get('category_id'))
+            if annotation.get('bbox') and name:
+                ground_truth_by_image.setdefault(annotation['image_id'], []).append((name, annotation['bbox']))
+
+        for image_doc in batch:
+            if produced >= limit:
+                return
+            ground_truth = ground_truth_by_image.get(str(image_doc['_id']), [])
+            if annotated and not ground_truth:
+                continue
+            try:
+                image = Image.open(io.BytesIO(read_image_bytes(db, image_doc)))
+                image = image.convert('RGB')
+            except Exception as e:
+                print(f"Imagen {image_doc['_id']} omitida: {e}")
+                continue
+            produced += 1
+            yield image, ground_truth
+
+# Cuantización en segundo plano: un trabajo por modelo
+_quantization_jobs = {}
+_quantization_jobs_guard = threading.Lock()
+
+def quantization_job_status(model_id):
+    """Estado del último trabajo de cuantización del modelo (None si no se ha lanzado)"""
+    with _quantization_jobs_guard:
+        job = _quantization_jobs.get(str(model_id))
+        return dict(job) if job else None
+
+def run_quantization(user_id, job_id, model_doc, method, dataset_id, calibration_limit, evaluation_limit,
+                     confidence):
+    """
+    Generar la variante INT8, evaluarla con el dataset y registrarla en ai_models.variants
+
+    Returns:
+        Resultado del trabajo (variante, tamaños y precisión)
+    """
+    db = get_db()
+    model_path = model_doc['file_path']
+    total_steps = 2 if dataset_id else 1
+    publish_progress(user_id, job_id, 'model_quantization', 0, total_steps, message=f'Cuantizando ({method})')
+    calibration = None
+    if method == 'static':
+        calibration = (image for image, _ in dataset_model_samples(db, dataset_id, calibration_limit))
+    variant_path = quantize(model_path, method, calibration)
+
+    # Precisión del original (ONNX en FP32) y de la variante con las mismas imágenes
+    accuracy = None
+    if dataset_id:
+        publish_progress(user_id, job_id, 'model_quantization', 1, total_steps, message='Evaluando la precisión')
+        original_session = load_session(export_onnx(model_path))
+        categories = model_doc.get('categories') or class_names(original_session)
+        original = evaluate(original_session, dataset_model_samples(db, dataset_id, evaluation_limit, True),
+                            categories, confidence)
+        quantized = evaluate(load_session(variant_path),
+                             dataset_model_samples(db, dataset_id, evaluation_limit, True),
+                             categories, confidence)
+        accuracy = {
+            'dataset_id': dataset_id,
+            'confidence': confidence,
+            'original': original,
+            'quantized': quantized,
+            'delta': accuracy_delta(original, quantized)
+        }
+
+    variant = {
+        'path': variant_path,
+        'method': method,
+        'created_at': datetime.now().isoformat(),
+        'file_size': os.path.getsize(variant_path),
+        'accuracy': accuracy
+    }
+    db.ai_models.update_one({'_id': model_doc['_id']}, {'$set': {f'variants.{INT8_VARIANT}': variant}})
+    return {
+        'variant': INT8_VARIANT,
+        'method': method,
+        'file_size': variant['file_size'],
+        'original_file_size': os.path.getsize(model_path),
+        'accuracy': accuracy
+    }
+
+def start_quantization_job(user_id, job_id, model_doc, *args):
+    """Lanzar run_quantization en un hilo (uno por modelo) y devolver el estado del trabajo"""
+    model_id = str(model_doc['_id'])
+    with _quantization_jobs_guard:
+        job = _quantization_jobs.get(model_id)
+        if job and job['state'] == 'running':
+            return dict(job)
+        job = {'state': 'running', 'job_id': job_id, 'started_at': time.time(), 'finished_at': None,
+               'result': None, 'error': None}
+        _quantization_jobs[model_id] = job
+
+    def run():
+        try:
+            result = run_quantization(user_id, job_id, model_doc, *args)
+            with _quantization_jobs_guard:
+                job.update(state='done', result=result, finished_at=time.time())
+            publish_progress(user_id, job_id, 'model_quantization', 1, 1, state='done', result=result)
+            print(f"Variante {INT8_VARIANT} del modelo {model_doc['name']} generada")
+        except Exception as e:
+            print(f"Error al cuantizar modelo {model_doc['name']}: {e}")
+            with _quantization_jobs_guard:
+                job.update(state='error', error=str(e), finished_at=time.time())
+            publish_progress(user_id, job_id, 'model_quantization', state='error', message=str(e))
+
+    threading.Thread(target=run, name='model-quantization', daemon=True).start()
+    return quantization_job_status(model_id)
+
+def find_user_model(db, model_id, user_id):
+    """Modelo guardado del usuario o precargado (None si no existe o no está autorizado)"""
+    if not ObjectId.is_valid(model_id):
+        return None
+    return db.ai_models.find_one({
+        '_id': ObjectId(model_id),
+        '$or': [
+            {'user_id': user_id},
+            {'is_preloaded': True}
+        ]
+    })
+
+@app.route('/api/ai/models/<model_id>/quantize', methods=['POST'])
+@token_required
+def quantize_saved_model(current_user_id, model_id):
+    """
+    Lanzar la generación de la variante INT8 de un modelo guardado y la
+    medida de su precisión (en segundo plano: responde 202 con el job_id)
+
+    Body: {method: 'dynamic' | 'static', dataset_id, calibration_images,
+           evaluation_images, confidence}
+    La cuantización estática se calibra con imágenes del dataset; con
+    dataset_id se comparan original y variante con sus anotaciones manuales.
+    El progreso llega por Socket.IO (job_progress) y con GET en esta misma
+    ruta. Al terminar, la variante queda registrada en ai_models.variants.int8
+    y las predicciones la usan con {variant: 'int8'}.
+    """
+    data = request.get_json(silent=True) or {}
+    job_id = request_job_id(data)
+    try:
+        method = data.get('method', 'dynamic')
+        dataset_id = data.get('dataset_id')
+
+        if method not in QUANTIZATION_METHODS:
+            return jsonify({'error': f'Método no válido, use uno de: {", ".join(QUANTIZATION_METHODS)}'}), 400
+        if not ObjectId.is_valid(model_id):
+            return jsonify({'error': 'ID de modelo inválido'}), 400
+        if method == 'static' and not dataset_id:
+            return jsonify({'error': 'La cuantización estática necesita un dataset_id para calibrar'}), 400
+        try:
+            calibration_limit = int(data.get('calibration_images', CALIBRATION_IMAGES))
+            evaluation_limit = int(data.get('evaluation_images', EVALUATION_IMAGES))
+            confidence = float(data.get('confidence', 0.25))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Parámetros numéricos no válidos'}), 400
+
+        db = get_db()
+        model_doc = find_user_model(db, model_id, current_user_id)
+        if not model_doc:
+            return jsonify({'error': 'Modelo no encontrado o no autorizado'}), 403
+        if not os.path.exists(model_doc['file_path']):
+            return jsonify({'error': 'Archivo de modelo no encontrado'}), 404
+        if dataset_id:
+            if not ObjectId.is_valid(dataset_id) or \
+                    not db.datasets.find_one({'_id': ObjectId(dataset_id), 'user_id': current_user_id}):
+                return jsonify({'error': 'Dataset no encontrado o no autorizado'}), 403
+
+        job = start_quantization_job(current_user_id, job_id, model_doc, method, dataset_id, calibration_limit,
+                                     evaluation_limit, confidence)
+        return jsonify({
+            'message': f'Cuantización del modelo "{model_doc["name"]}" iniciada',
+            # Si ya había un trabajo en curso para el modelo se devuelve el suyo
+            'job_id': job['job_id'],
+            'job': job
+        }), 202
+
+    except Exception as e:
+        print(f"Error al cuantizar modelo: {e}")
+        publish_progress(current_user_id, job_id, 'model_quantization', state='error', message=str(e))
+        return jsonify({'error': f'Error al cuantizar el modelo: {str(e)}'}), 500
+
+@app.route('/api/ai/models/<model_id>/quantize', methods=['GET'])
+@token_required
+def get_quantization_status(current_user_id, model_id):
+    """Estado del último trabajo de cuantización del modelo y variante registrada"""
+    model_doc = find_user_model(get_db(), model_id, current_user_id)
+    if not model_doc:
+        return jsonify({'error': 'Modelo no encontrado o no autorizado'}), 403
+    return jsonify({
+        'job': quantization_job_status(model_id),
+        'variant': (model_doc.get('variants') or {}).get(INT8_VARIANT)
+    })
+
+def read_image_bytes(db, image_doc):
+    """
+    Bytes de una imagen guardada: base64 en el documento, contenido compartido
+    entre datasets o archivo en /app/images
+
+    Raises:
+        ValueError si los datos guardados no son válidos
+        FileNotFoundError si el archivo no existe
+    """
+    if 'data' not in image_doc and image_doc.get('blob_id'):
+        # Contenido compartido entre datasets
+        image_doc['data'] = image_data_base64(db, image_doc)
+    if 'data' in image_doc:
+        # Los datos pueden estar en formato base64 o como bytes
+        data = image_doc['data']
+        if isinstance(data, str):
+            # Si es string, podría ser base64
+            try:
+                return base64.b64decode(data)
+            except Exception:
+                raise ValueError('Formato de imagen inválido en base de datos')
+        # Si ya son bytes
+        return data
+    # Si la imagen está en el sistema de archivos
+    image_path = os.path.join('/app/images', image_doc.get('path', ''))
+    if not os.path.exists(image_path):
+        raise FileNotFoundError('Archivo de imagen no encontrado')
+    with open(image_path, 'rb') as f:
+        return f.read()
+
 @app.route('/api/ai/predict', methods=['POST'])
 @token_required
 def predict_image(current_user_id):
     """Realizar predicción en una imagen usando el modelo cargado"""
-    global loaded_model, model_categories
-    
     try:
-        if loaded_model is None:
-            return jsonify({'error': 'No hay modelo cargado'}), 400
-        
         data = request.get_json()
         image_id = data.get('image_id')
         confidence = data.get('confidence', 0.5)
+        variant = data.get('variant')  # p. ej. 'int8' (ver /api/ai/models/<id>/quantize)
+        # Por teselas para imágenes muy grandes (ver tiling); sin 'tiled' decide el tamaño
+        tiled = data.get('tiled')
+        tile_size = data.get('tile_size')
+        tile_overlap = data.get('tile_overlap')
+        job_id = request_job_id(data)
         
         if not image_id:
             return jsonify({'error': 'ID de imagen requerido'}), 400
@@ -4841,332 +5338,146 @@ def predict_image(current_user_id):
         if not dataset_id:
             return jsonify({'error': 'La imagen debe pertenecer a un dataset para realizar predicciones'}), 400
         
+        # Obtener los bytes de la imagen
+        try:
+            image_data = read_image_bytes(db, image_doc)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except FileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
+        
+        if image_data is None:
+            return jsonify({'error': 'No se pudieron obtener los datos de la imagen'}), 400
+        
+        # Realizar predicción (en este proceso o en el servicio de inferencia)
+        try:
+            print(f"Realizando predicción con confianza: {confidence}")
+            prediction = inference.predict(image_data, confidence, variant, tiled, tile_size, tile_overlap)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 500
+        
+        # Categorías y nombre del modelo que ha hecho la predicción
+        model_name = prediction['model_name']
+        model_categories = prediction['categories']
+        print(f"Predicción completada, {len(prediction['detections'])} detecciones")
+        
         # Crear automáticamente las categorías del modelo si no existen
         created_categories = ensure_model_categories_exist(dataset_id, model_categories, current_user_id)
         
         # Obtener el mapeo de categorías del modelo a IDs de base de datos
         category_mapping = get_category_mapping(dataset_id, model_categories)
         
-        # Crear imagen PIL desde los datos
-        image_data = None
-        if 'data' in image_doc:
-            # Los datos pueden estar en formato base64 o como bytes
-            data = image_doc['data']
-            if isinstance(data, str):
-                # Si es string, podría ser base64
-                try:
-                    image_data = base64.b64decode(data)
-                except:
-                    return jsonify({'error': 'Formato de imagen inválido en base de datos'}), 400
-            else:
-                # Si ya son bytes
-                image_data = data
-        else:
-            # Si la imagen está en el sistema de archivos
-            image_path = os.path.join('/app/images', image_doc.get('path', ''))
-            if not os.path.exists(image_path):
-                return jsonify({'error': 'Archivo de imagen no encontrado'}), 404
-            
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-        
-        if image_data is None:
-            return jsonify({'error': 'No se pudieron obtener los datos de la imagen'}), 400
-        
-        # Convertir a imagen PIL
-        try:
-            image = Image.open(io.BytesIO(image_data))
-            # Asegurar que la imagen esté en modo RGB
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-        except Exception as e:
-            return jsonify({'error': f'Error al procesar la imagen: {str(e)}'}), 400
+        # Procesar resultados y guardar como anotaciones
+        detections = []
+        created_annotations = []
         
-        # Realizar predicción
-        try:
-            print(f"Realizando predicción con confianza: {confidence}")
-            
-            # Verificar si es un modelo TorchScript
-            import torch
-            is_torchscript = isinstance(loaded_model, torch.jit.ScriptModule)
-            
-            if is_torchscript:
-                # Procesar modelo TorchScript
-                import torchvision.transforms as transforms
-                
-                # Preparar imagen para TorchScript
-                transform = transforms.Compose([
-                    transforms.Resize((640, 640)),
-                    transforms.ToTensor(),
-                ])
+        for i, raw in enumerate(prediction['detections']):
+            try:
+                bbox = raw['bbox']
+                conf = raw['confidence']
+                cls = raw['class']
                 
-                img_tensor = transform(image).unsqueeze(0)  # Añadir dimensión de batch
+                # Validar que la clase esté en el rango válido
+                if cls >= len(model_categories):
+                    print(f"Clase {cls} fuera de rango (total: {len(model_categories)}), saltando")
+                    continue
                 
-                # Mover tensor al mismo dispositivo que el modelo
-                device = next(loaded_model.parameters()).device if hasattr(loaded_model, 'parameters') else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-                img_tensor = img_tensor.to(device)
+                # Obtener el ID de categoría correspondiente
+                category_id = category_mapping.get(cls)
+                category_name = model_categories[cls]
                 
-                print(f"Realizando predicción en dispositivo: {device}")
+                if not category_id:
+                    print(f"No se encontró categoría para clase {cls} ({category_name}), saltando detección")
+                    continue
                 
-                # Realizar predicción
-                with torch.no_grad():
-                    predictions = loaded_model(img_tensor)
+                detection = {
+                    'bbox': bbox,
+                    'confidence': conf,
+                    'class': cls,
+                    'category_id': category_id,
+                    'category_name': category_name
+                }
                 
-                # TorchScript YOLO devuelve [batch, detections, 6] donde 6 = [x1, y1, x2, y2, conf, class]
-                # Necesitamos procesar esto manualmente
-                print(f"Predicción TorchScript completada, shape: {predictions.shape if hasattr(predictions, 'shape') else 'N/A'}")
+                # Crear anotación en la base de datos
+                annotation_doc = {
+                    'image_id': image_id,
+                    'type': 'bbox',
+                    'category': category_name,
+                    'category_id': category_id,
+                    'bbox': bbox,
+                    'original_bbox': bbox,  # Guardar bbox original para detectar duplicados después de escalado
+                    'area': bbox[2] * bbox[3],  # width * height
+                    'stroke': '#00ff00',  # Color por defecto para predicciones
+                    'strokeWidth': 2,
+                    'fill': 'rgba(0,255,0,0.2)',
+                    'confidence': conf,
+                    'source': 'ai_prediction',  # Marcar como predicción de IA
+                    'model_name': model_name,
+                    'created_date': datetime.utcnow(),
+                    'modified_date': datetime.utcnow(),
+                    'user_id': current_user_id  # Asociar anotación al usuario
+                }
                 
-            else:
-                # Modelo Ultralytics YOLO normal
-                results = loaded_model(image, conf=confidence)
-                print(f"Predicción completada, {len(results)} resultados obtenidos")
+                # Verificar duplicados antes de crear la anotación
+                duplicate_result = check_annotation_duplicate_advanced(
+                    db, 
+                    image_id, 
+                    category_id, 
+                    category_name, 
+                    bbox,
+                    iou_threshold=0.90  # 90% de solapamiento
+                )
                 
-        except Exception as e:
-            print(f"Error durante la predicción: {e}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({'error': f'Error durante la predicción: {str(e)}'}), 500
-        
-        # Procesar resultados y guardar como anotaciones
-        detections = []
-        created_annotations = []
-        
-        if is_torchscript:
-            # Procesar resultados de TorchScript
-            print(f"Procesando resultados TorchScript")
-            
-            # El formato puede variar según el modelo, intentar procesar
-            try:
-                if isinstance(predictions, torch.Tensor):
-                    # Formato típico de YOLO v8 TorchScript: [batch, num_classes + 4, num_anchors]
-                    # Ejemplo: [1, 20, 8400] donde 20 = 16 clases + 4 coordenadas bbox
-                    pred = predictions[0]  # Primera imagen del batch [num_classes + 4, num_anchors]
-                    
-                    # Transponer para tener [num_anchors, num_classes + 4]
-                    pred = pred.transpose(0, 1)  # Ahora es [8400, 20]
-                    
-                    # Las primeras 4 columnas son las coordenadas (x_center, y_center, width, height)
-                    # Las siguientes columnas son las probabilidades de clase
-                    boxes_xywh = pred[:, :4]  # [num_anchors, 4]
-                    class_probs = pred[:, 4:]  # [num_anchors, num_classes]
-                    
-                    # Obtener la clase y confianza máxima para cada detección
-                    max_probs, class_ids = torch.max(class_probs, dim=1)
-                    
-                    # Filtrar por umbral de confianza
-                    mask = max_probs >= confidence
-                    filtered_boxes = boxes_xywh[mask]
-                    filtered_scores = max_probs[mask]
-                    filtered_classes = class_ids[mask]
-                    
-                    print(f"Después de filtrar por confianza {confidence}: {len(filtered_boxes)} detecciones")
-                    
-                    if len(filtered_boxes) > 0:
-                        # Convertir de xywh (centro) a xyxy (esquinas)
-                        boxes_xyxy = torch.zeros_like(filtered_boxes)
-                        boxes_xyxy[:, 0] = filtered_boxes[:, 0] - filtered_boxes[:, 2] / 2  # x1
-                        boxes_xyxy[:, 1] = filtered_boxes[:, 1] - filtered_boxes[:, 3] / 2  # y1
-                        boxes_xyxy[:, 2] = filtered_boxes[:, 0] + filtered_boxes[:, 2] / 2  # x2
-                        boxes_xyxy[:, 3] = filtered_boxes[:, 1] + filtered_boxes[:, 3] / 2  # y2
-                        
-                        # Aplicar NMS (Non-Maximum Suppression)
-                        try:
-                            from torchvision.ops import nms
-                            keep_indices = nms(boxes_xyxy, filtered_scores, iou_threshold=0.45)
-                            
-                            boxes_xyxy = boxes_xyxy[keep_indices]
-                            filtered_scores = filtered_scores[keep_indices]
-                            filtered_classes = filtered_classes[keep_indices]
-                            
-                            print(f"Después de NMS: {len(boxes_xyxy)} detecciones")
-                        except Exception as nms_error:
-                            print(f"Error aplicando NMS: {nms_error}, continuando sin NMS")
-                        
-                        # Escalar de vuelta al tamaño original de la imagen
-                        img_w, img_h = image.size
-                        
-                        for i in range(len(boxes_xyxy)):
-                            box = boxes_xyxy[i].cpu()
-                            conf = float(filtered_scores[i].cpu())
-                            cls = int(filtered_classes[i].cpu())
-                            
-                            # Escalar coordenadas desde 640x640 al tamaño original
-                            x1 = float(box[0]) * img_w / 640
-                            y1 = float(box[1]) * img_h / 640
-                            x2 = float(box[2]) * img_w / 640
-                            y2 = float(box[3]) * img_h / 640
-                            
-                            # Convertir a formato [x, y, width, height]
-                            bbox = [x1, y1, x2 - x1, y2 - y1]
-                            
-                            # Validar que la clase esté en el rango válido
-                            if cls >= len(model_categories):
-                                print(f"Clase {cls} fuera de rango (total: {len(model_categories)}), saltando")
-                                continue
-                            
-                            # Obtener el ID de categoría correspondiente
-                            category_id = category_mapping.get(cls)
-                            category_name = model_categories[cls]
-                            
-                            if not category_id:
-                                print(f"No se encontró categoría para clase {cls} ({category_name}), saltando detección")
-                                continue
-                            
-                            detection = {
-                                'bbox': bbox,
-                                'confidence': conf,
-                                'class': cls,
-                                'category_id': category_id,
-                                'category_name': category_name
-                            }
-                            
-                            # Crear anotación en la base de datos
-                            annotation_doc = {
-                                'image_id': image_id,
-                                'type': 'bbox',
-                                'category': category_name,
-                                'category_id': category_id,
-                                'bbox': bbox,
-                                'original_bbox': bbox,
-                                'area': bbox[2] * bbox[3],
-                                'stroke': '#00ff00',
-                                'strokeWidth': 2,
-                                'fill': 'rgba(0,255,0,0.2)',
-                                'confidence': conf,
-                                'source': 'ai_prediction',
-                                'model_name': model_name,
-                                'created_date': datetime.utcnow(),
-                                'modified_date': datetime.utcnow(),
-                                'user_id': current_user_id
-                            }
-                            
-                            # Verificar duplicados
-                            duplicate_result = check_annotation_duplicate_advanced(
-                                db, image_id, category_id, category_name, bbox, iou_threshold=0.90
-                            )
-                            
-                            if duplicate_result['is_duplicate']:
-                                print(f"Detección {i}: duplicado (IoU: {duplicate_result['iou']:.3f}), saltando...")
-                                detection['is_duplicate'] = True
-                                detection['existing_annotation_id'] = duplicate_result['existing_annotation']['_id']
-                                detections.append(detection)
-                                continue
-                            
-                            # Insertar anotación
-                            annotation_result = db.annotations.insert_one(annotation_doc)
-                            annotation_doc['_id'] = str(annotation_result.inserted_id)
-                            created_annotations.append(serialize_doc(annotation_doc))
-                            detection['is_duplicate'] = False
-                            detections.append(detection)
-                            
-                            print(f"Detección {i}: clase={cls} ({category_name}), confianza={conf:.3f}, bbox={[round(b, 2) for b in bbox]}")
-                            
-                print(f"Encontradas {len(detections)} detecciones TorchScript")
+                if duplicate_result['is_duplicate']:
+                    print(f"Detección {i}: duplicado detectado (IoU: {duplicate_result['iou']:.3f}), saltando...")
+                    # Agregar a detecciones pero marcar como duplicado
+                    detection['is_duplicate'] = True
+                    detection['existing_annotation_id'] = duplicate_result['existing_annotation']['_id']
+                    detections.append(detection)
+                    continue
                 
-            except Exception as e:
-                print(f"Error procesando resultados TorchScript: {e}")
-                import traceback
-                traceback.print_exc()
-                return jsonify({'error': f'Error procesando resultados: {str(e)}'}), 500
+                # Insertar anotación en MongoDB
+                annotation_result = db.annotations.insert_one(annotation_doc)
+                annotation_doc['_id'] = str(annotation_result.inserted_id)
+                created_annotations.append(serialize_doc(annotation_doc))
                 
-        elif len(results) > 0:
-            result = results[0]  # Tomar el primer resultado
-            print(f"Procesando resultado: {type(result)}")
-            
-            if result.boxes is not None:
-                boxes = result.boxes
-                print(f"Encontradas {len(boxes)} cajas")
+                print(f"Detección {i}: clase={cls} ({category_name}), confianza={conf:.3f}, bbox={[round(b, 2) for b in bbox]}")
+                detection['is_duplicate'] = False
+                detections.append(detection)
                 
-                for i in range(len(boxes)):
-                    try:
-                        # Obtener coordenadas del bounding box (xyxy format)
-                        box = boxes.xyxy[i].cpu().numpy()
-                        conf = boxes.conf[i].cpu().numpy()
-                        cls = int(boxes.cls[i].cpu().numpy())
-                        
-                        # Convertir a formato [x, y, width, height]
-                        x1, y1, x2, y2 = box
-                        bbox = [float(x1), float(y1), float(x2 - x1), float(y2 - y1)]
-                        
-                        # Obtener el ID de categoría correspondiente
-                        category_id = category_mapping.get(cls)
-                        category_name = model_categories[cls] if cls < len(model_categories) else f'Clase {cls}'
-                        
-                        if not category_id:
-                            print(f"No se encontró categoría para clase {cls}, saltando detección")
-                            continue
-                        
-                        detection = {
-                            'bbox': bbox,
-                            'confidence': float(conf),
-                            'class': cls,
-                            'category_id': category_id,
-                            'category_name': category_name
-                        }
-                        
-                        # Crear anotación en la base de datos
-                        annotation_doc = {
-                            'image_id': image_id,
-                            'type': 'bbox',
-                            'category': category_name,
-                            'category_id': category_id,
-                            'bbox': bbox,
-                            'original_bbox': bbox,  # Guardar bbox original para detectar duplicados después de escalado
-                            'area': bbox[2] * bbox[3],  # width * height
-                            'stroke': '#00ff00',  # Color por defecto para predicciones
-                            'strokeWidth': 2,
-                            'fill': 'rgba(0,255,0,0.2)',
-                            'confidence': float(conf),
-                            'source': 'ai_prediction',  # Marcar como predicción de IA
-                            'model_name': model_name,
-                            'created_date': datetime.utcnow(),
-                            'modified_date': datetime.utcnow(),
-                            'user_id': current_user_id  # Asociar anotación al usuario
-                        }
-                        
-                        # Verificar duplicados antes de crear la anotación
-                        duplicate_result = check_annotation_duplicate_advanced(
-                            db, 
-                            image_id, 
-                            category_id, 
-                            category_name, 
-                            bbox,
-                            iou_threshold=0.90  # 90% de solapamiento
-                        )
-                        
-                        if duplicate_result['is_duplicate']:
-                            print(f"Detección {i}: duplicado detectado (IoU: {duplicate_result['iou']:.3f}), saltando...")
-                            # Agregar a detecciones pero marcar como duplicado
-                            detection['is_duplicate'] = True
-                            detection['existing_annotation_id'] = duplicate_result['existing_annotation']['_id']
-                            detections.append(detection)
-                            continue
-                        
-                        # Insertar anotación en MongoDB
-                        annotation_result = db.annotations.insert_one(annotation_doc)
-                        annotation_doc['_id'] = str(annotation_result.inserted_id)
-                        created_annotations.append(serialize_doc(annotation_doc))
-                        
-                        print(f"Detección {i}: clase={cls} ({category_name}), confianza={conf:.3f}, bbox={bbox}, anotación creada con ID={annotation_doc['_id']}")
-                        detection['is_duplicate'] = False
-                        detections.append(detection)
-                        
-                    except Exception as e:
-                        print(f"Error procesando detección {i}: {e}")
-                        continue
-            else:
-                print("No se encontraron boxes en el resultado")
+            except Exception as e:
+                print(f"Error procesando detección {i}: {e}")
+                continue
         
         # Estadísticas de duplicados
         duplicates_count = len([d for d in detections if d.get('is_duplicate', False)])
         created_count = len(created_annotations)
         total_detections = len(detections)
+        if created_count or created_categories:
+            touch_dataset(db, dataset_id)
+        if created_categories:
+            for category in created_categories:
+                publish_dataset_change(dataset_id, 'category_created', category=category)
+        if created_annotations:
+            publish_dataset_change(dataset_id, 'annotations_created', image_id=image_id,
+                                   annotations=created_annotations)
+        publish_progress(current_user_id, job_id, 'prediction', 1, 1, state='done', result={
+            'image_id': image_id,
+            'total_detections': total_detections,
+            'total_annotations_created': created_count,
+            'duplicates_skipped': duplicates_count
+        })
         
         return jsonify({
             'success': True,
+            'job_id': job_id,
             'detections': detections,
             'annotations': created_annotations,
             'model_name': model_name,
+            'variant': prediction.get('variant'),
+            'tiles': prediction.get('tiles', 0),
             'categories': model_categories,
             'created_categories': [serialize_doc(cat) for cat in created_categories],
             'total_detections': total_detections,
@@ -5183,12 +5494,14 @@ def predict_image(current_user_id):
 @token_required
 def get_model_status(current_user_id):
     """Obtener estado actual del modelo"""
-    global loaded_model, model_name, model_categories
-    
+    status = inference.model_status()
     return jsonify({
-        'is_loaded': loaded_model is not None,
-        'model_name': model_name,
-        'categories': model_categories
+        'is_loaded': status['is_loaded'],
+        'model_name': status['model_name'],
+        'categories': status['categories'],
+        'ready': status.get('ready', status['is_loaded']),
+        'runtime': status.get('runtime'),
+        'variants': status.get('variants', [])
     })
 
 @app.route('/api/ai/test-image', methods=['POST'])
@@ -5212,6 +5525,7 @@ def test_image_processing(current_user_id):
         # Información de debug sobre la imagen
         info = {
             'has_data_field': 'data' in image_doc,
+            'blob_id': image_doc.get('blob_id'),
             'has_path_field': 'path' in image_doc,
             'filename': image_doc.get('filename', 'Unknown'),
             'data_type': str(type(image_doc.get('data', None))),
@@ -5233,6 +5547,37 @@ def test_image_processing(current_user_id):
     except Exception as e:
         return jsonify({'error': f'Error al procesar imagen: {str(e)}'}), 500
 
+def sync_watched_dataset(dataset_id):
+    """Sincronizar un dataset cuya carpeta ha cambiado (modo DATASET_WATCH)"""
+    if not ObjectId.is_valid(dataset_id):
+        return
+    db = get_db()
+    dataset = db.datasets.find_one({'_id': ObjectId(dataset_id)}, {'user_id': 1})
+    if not dataset:
+        return
+    stats = sync_dataset_folder(db, dataset_id, dataset.get('user_id'))
+    print(f"Dataset {dataset_id} sincronizado: {stats['successfully_imported']} nuevas, "
+          f"{stats['updated']} actualizadas, {stats['removed']} eliminadas")
+
+# En modo debug el proceso principal del recargador no debe vigilar (lo hace el hijo)
+if DATASET_WATCH and (__name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+    start_dataset_watcher(IMAGE_FOLDER, sync_watched_dataset)
+
+# Índices de las consultas de la aplicación (ver db_indexes)
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    ensure_indexes_in_background(get_db)
+    # Modelo precargado con load_on_start (ver ensure_preloaded_models)
+    try:
+        preload_model_in_background()
+    except Exception as e:
+        print(f"Error al precargar el modelo: {e}")
+
+# Canal Socket.IO para progreso de tareas y cambios en datasets
+socketio = init_realtime(app, socket_user_id, user_owns_dataset)
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    if socketio is not None:
+        socketio.run(app, debug=True, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
+    else:
+        app.run(debug=True, host='0.0.0.0', port=5000)
 
@@ -0,0 +1,455 @@
+"""
+Benchmark de los endpoints más usados de la API.
+
+Siembra datasets sintéticos (imágenes, frames de video, categorías y
+anotaciones) en un MongoDB local o en memoria (mongomock), llama a los
+endpoints con el cliente de pruebas de Flask (sin red, mide el manejador y
+la base de datos) y registra percentiles de latencia, peticiones por segundo
+y memoria (RSS) del proceso. Los resultados se pueden guardar como línea base
+y comparar en ejecuciones posteriores.
+
+Endpoints medidos:
+    get_images          GET  /api/images?dataset_id=
+    get_annotations     GET  /api/annotations?dataset_id=
+    get_categories      GET  /api/categories?dataset_id=
+    export_annotations  GET  /api/annotations/export/<id> (COCO, sin caché)
+    import_annotations  POST /api/annotations/import (COCO sobre un dataset aparte)
+    predict_image       POST /api/ai/predict (modelo TorchScript mínimo en CPU)
+
+Uso (desde backend/):
+    python benchmarks/bench_api.py --images 2000 --annotations 20000
+    python benchmarks/bench_api.py --mongo-uri mongodb://localhost:27017/ --save-baseline benchmarks/baseline_api.json
+    python benchmarks/bench_api.py --mongo-uri mongodb://localhost:27017/ --baseline benchmarks/baseline_api.json
+
+Sin --mongo-uri se usa mongomock (pip install mongomock), que sirve para
+comparar cambios en Python pero no refleja el coste real de las consultas ni
+de los índices. Con --mongo-uri se usa la base de datos --db-name (se borra
+al terminar salvo con --keep). Con --baseline el proceso termina con código 1
+si algún endpoint empeora más de --threshold por ciento.
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+BENCH_USER = 'bench'
+
+# ==================== SIEMBRA ====================
+
+def make_jpeg_base64(index, size=(64, 48)):
+    """JPEG pequeño con un comentario distinto por imagen (hash único)"""
+    from PIL import Image
+    img = Image.new('RGB', size, ((index * 7) % 256, (index * 13) % 256, (index * 29) % 256))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=80, comment=f'bench {index}')
+    return buffer.getvalue()
+
+
+def seed_dataset(db, user_id, name, n_images, n_videos, frames_per_video, n_categories, n_annotations,
+                 seed=0, with_annotations=True):
+    """
+    Crear un dataset con la misma forma de documentos que la aplicación
+
+    Returns:
+        Dict con dataset_id, image_ids y category_ids
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    dataset_oid = db.datasets.insert_one({
+        'name': name, 'description': 'benchmark', 'folder_path': f'/datasets/{name}', 'categories': [],
+        'created_date': now, 'created_by': BENCH_USER, 'image_count': 0, 'user_id': user_id
+    }).inserted_id
+    dataset_id = str(dataset_oid)
+
+    category_ids = [str(_id) for _id in db.categories.insert_many([
+        {'name': f'clase_{i}', 'dataset_id': dataset_id, 'user_id': user_id,
+         'color': f'#{rng.randint(0, 0xFFFFFF):06x}', 'created_date': now}
+        for i in range(n_categories)
+    ]).inserted_ids] if n_categories else []
+
+    def image_doc(index, extra):
+        content = make_jpeg_base64(index)
+        return dict({
+            'filename': f'img_{index:06d}.jpg', 'original_name': f'img_{index:06d}.jpg',
+            'data': base64.b64encode(content).decode('utf-8'), 'content_type': 'image/jpeg',
+            'size': len(content), 'width': 64, 'height': 48, 'format': 'JPEG', 'orientation': 1,
+            'sha256': hashlib.sha256(content).hexdigest(), 'upload_date': now,
+            'dataset_id': dataset_id, 'project_id': 'default', 'user_id': user_id
+        }, **extra)
+
+    image_ids = []
+    batch = []
+    for i in range(n_images):
+        batch.append(image_doc(seed * 10**6 + i, {'type': 'image'}))
+        if len(batch) >= 1000:
+            image_ids += [str(_id) for _id in db.images.insert_many(batch).inserted_ids]
+            batch = []
+    if batch:
+        image_ids += [str(_id) for _id in db.images.insert_many(batch).inserted_ids]
+
+    for v in range(n_videos):
+        video_id = str(db.videos.insert_one({
+            'filename': f'video_{v}.mp4', 'original_name': f'video_{v}.mp4', 'size': 0,
+            'width': 64, 'height': 48, 'fps': 25, 'duration': frames_per_video / 25,
+            'total_frames': frames_per_video, 'upload_date': now, 'dataset_id': dataset_id,
+            'user_id': user_id, 'type': 'video', 'processed': True
+        }).inserted_id)
+        frames = [image_doc(seed * 10**6 + n_images + v * frames_per_video + f,
+                            {'filename': f'video_{v}_frame_{f:06d}.jpg', 'type': 'video_frame',
+                             'video_id': video_id, 'frame_number': f, 'timestamp': f / 25})
+                  for f in range(frames_per_video)]
+        if frames:
+            image_ids += [str(_id) for _id in db.images.insert_many(frames).inserted_ids]
+
+    if with_annotations and image_ids and category_ids:
+        annotations = []
+        for _ in range(n_annotations):
+            category = rng.randrange(n_categories)
+            x, y = rng.random() * 50, rng.random() * 35
+            annotations.append({
+                'image_id': image_ids[rng.randrange(len(image_ids))], 'type': 'bbox',
+                'category': f'clase_{category}', 'category_id': category_ids[category],
+                'bbox': [x, y, 10.0, 8.0], 'area': 80.0, 'source': 'manual',
+                'created_date': now, 'modified_date': now, 'user_id': user_id
+            })
+            if len(annotations) >= 5000:
+                db.annotations.insert_many(annotations)
+                annotations = []
+        if annotations:
+            db.annotations.insert_many(annotations)
+
+    db.datasets.update_one({'_id': dataset_oid}, {'$set': {'image_count': len(image_ids)}})
+    return {'dataset_id': dataset_id, 'image_ids': image_ids, 'category_ids': category_ids}
+
+
+def coco_payload(db, dataset_id, user_id, n_annotations, seed=1):
+    """Archivo COCO con anotaciones para las imágenes de un dataset (por nombre de archivo)"""
+    rng = random.Random(seed)
+    images = list(db.images.find({'dataset_id': dataset_id, 'user_id': user_id}, {'filename': 1}))
+    coco = {
+        'images': [{'id': i + 1, 'file_name': img['filename'], 'width': 64, 'height': 48}
+                   for i, img in enumerate(images)],
+        'categories': [{'id': i + 1, 'name': f'clase_{i}'} for i in range(5)],
+        'annotations': [{'id': i + 1, 'image_id': rng.randrange(len(images)) + 1,
+                         'category_id': rng.randrange(5) + 1,
+                         'bbox': [rng.random() * 50, rng.random() * 35, 10, 8], 'area': 80, 'iscrowd': 0}
+                        for i in range(n_annotations)]
+    }
+    return json.dumps(coco).encode('utf-8')
+
+# ==================== MODELO ====================
+
+def load_tiny_model(appmod, n_classes):
+    """
+    Cargar en la aplicación un modelo TorchScript mínimo con la salida de un
+    YOLOv8 exportado ([1, 4 + clases, anclas]) para medir predict_image sin
+    descargar pesos. Devuelve False si no está instalado torch.
+    """
+    try:
+        import torch
+    except ImportError:
+        return False
+
+    class TinyDetector(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.head = torch.nn.Conv2d(3, 4 + n_classes, kernel_size=32, stride=32)
+
+        def forward(self, x):
+            out = self.head(x).flatten(2)  # [1, 4 + clases, 20 * 20]
+            boxes = torch.sigmoid(out[:, :4]) * 640
+            scores = torch.sigmoid(out[:, 4:])
+            return torch.cat([boxes, scores], dim=1)
+
+    torch.manual_seed(0)
+    model_path = os.path.join(tempfile.mkdtemp(prefix='bench_model_'), 'tiny.torchscript')
+    torch.jit.script(TinyDetector().eval()).save(model_path)
+    # Por la misma ruta que load_saved_model (en el proceso o en el servicio de inferencia)
+    appmod.inference.load_model(model_path, 'bench', 'bench-tiny', [f'clase_{i}' for i in range(n_classes)])
+    return True
+
+# ==================== MEDICIÓN ====================
+
+def current_rss_mb():
+    """RSS actual (Linux) o None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_endpoint(app, name, make_request, iterations, warmup, concurrency, after_each=None, verbose=False):
+    """
+    Ejecutar una petición iterations veces (tras warmup) con concurrency hilos
+
+    Args:
+        make_request: Función (client) -> respuesta
+        after_each: Función sin argumentos que se ejecuta tras cada petición
+            fuera de la medición (p. ej. deshacer una importación)
+    """
+    local = threading.local()
+    errors = []
+    mongo_commands = []
+
+    def call():
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        start = time.perf_counter()
+        response = make_request(client)
+        body = response.get_data()  # consumir también las respuestas en streaming
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            errors.append(f'{response.status_code}: {body[:200]!r}')
+        if response.headers.get('X-Mongo-Commands'):
+            mongo_commands.append(int(response.headers['X-Mongo-Commands']))
+        if after_each:
+            after_each()
+        return elapsed, len(body)
+
+    # Los print() de la aplicación no se muestran salvo con --verbose
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        for _ in range(warmup):
+            call()
+        errors.clear()
+        mongo_commands.clear()
+
+        rss_before = current_rss_mb()
+        start = time.perf_counter()
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                samples = list(pool.map(lambda _: call(), range(iterations)))
+        else:
+            samples = [call() for _ in range(iterations)]
+        wall = time.perf_counter() - start
+        rss_after = current_rss_mb()
+
+    latencies = sorted(elapsed for elapsed, _ in samples)
+    result = {
+        'iterations': iterations,
+        'errors': len(errors),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': statistics.fmean(latencies) * 1000,
+        'rps': iterations / wall if wall else 0.0,
+        'response_kb': statistics.fmean(size for _, size in samples) / 1024,
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_delta_mb': (rss_after - rss_before) if rss_before is not None and rss_after is not None else None,
+        # mongomock no emite eventos de comandos: solo se informa con MongoDB real
+        'mongo_commands': statistics.fmean(mongo_commands) if any(mongo_commands) else None
+    }
+    if errors:
+        print(f"  {name}: {len(errors)} errores, p. ej. {errors[0]}")
+    return result
+
+# ==================== LÍNEA BASE ====================
+
+def compare_with_baseline(results, baseline, threshold):
+    """
+    Imprimir la variación respecto a la línea base
+
+    Returns:
+        Lista de endpoints que empeoran más de threshold por ciento
+    """
+    regressions = []
+    print(f"\nComparación con la línea base ({baseline.get('created', '?')}):")
+    if baseline.get('config') != results['config']:
+        print("  AVISO: la configuración de la línea base es distinta, la comparación es orientativa")
+    for name, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous:
+            print(f"  {name:20s} sin línea base")
+            continue
+        changes = {metric: (current[metric] - previous[metric]) / previous[metric] * 100
+                   for metric in ('p50_ms', 'p99_ms', 'rps') if previous.get(metric)}
+        worse = [metric for metric, change in changes.items()
+                 if (change > threshold if metric != 'rps' else change < -threshold)]
+        line = ', '.join(f'{metric} {change:+.1f}%' for metric, change in changes.items())
+        print(f"  {name:20s} {line}{'  <-- EMPEORA' if worse else ''}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+# ==================== PRINCIPAL ====================
+
+def connect(args):
+    if args.mongo_uri:
+        from pymongo import MongoClient
+        return MongoClient(args.mongo_uri)[args.db_name]
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock no está instalado (pip install mongomock) y no se indicó --mongo-uri")
+    return mongomock.MongoClient()[args.db_name]
+
+
+def import_app(args, db):
+    """Importar app.py apuntando get_db a la base de datos del benchmark"""
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret-key')
+    # La creación de índices en segundo plano del arranque usa MONGO_URI
+    os.environ['MONGO_URI'] = args.mongo_uri or 'mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=100'
+    os.environ.setdefault('REALTIME', 'false')
+    work_dir = tempfile.mkdtemp(prefix='bench_api_')
+    os.chdir(work_dir)  # IMAGE_FOLDER y demás carpetas se crean en el directorio actual
+    import app as appmod
+    from db_indexes import ensure_indexes
+    appmod.get_db = lambda: db
+    ensure_indexes(db)
+    return appmod
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri', help='MongoDB real (por defecto mongomock en memoria)')
+    parser.add_argument('--db-name', default='viewannotator_bench')
+    parser.add_argument('--keep', action='store_true', help='No borrar la base de datos al terminar')
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--videos', type=int, default=2)
+    parser.add_argument('--frames', type=int, default=250, help='Frames por video')
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--annotations', type=int, default=10000)
+    parser.add_argument('--import-annotations', type=int, default=2000,
+                        help='Anotaciones del archivo COCO importado')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--only', help='Endpoints a medir separados por comas')
+    parser.add_argument('--save-baseline', help='Guardar los resultados como línea base en este archivo')
+    parser.add_argument('--baseline', help='Comparar con la línea base de este archivo')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Empeoramiento máximo tolerado en p50/p99/rps (%%)')
+    parser.add_argument('--output', help='Guardar los resultados en JSON')
+    parser.add_argument('--verbose', action='store_true', help='Mostrar los mensajes de la aplicación')
+    args = parser.parse_args()
+    # import_app cambia el directorio de trabajo
+    for option in ('save_baseline', 'baseline', 'output'):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+
+    db = connect(args)
+    appmod = import_app(args, db)
+    import jwt
+
+    user_id = str(db.users.insert_one({'username': f'{BENCH_USER}_{os.getpid()}', 'password': ''}).inserted_id)
+    token = jwt.encode({'user_id': user_id}, appmod.app.config['SECRET_KEY'], algorithm='HS256')
+    # X-Trace hace que la respuesta incluya el número de comandos de Mongo (ver metrics)
+    headers = {'Authorization': f'Bearer {token}', 'X-Trace': '1'}
+
+    start = time.perf_counter()
+    main_ds = seed_dataset(db, user_id, 'bench', args.images, args.videos, args.frames,
+                           args.categories, args.annotations)
+    import_ds = seed_dataset(db, user_id, 'bench_import', min(args.images, 500), 0, 0, 0, 0, seed=1,
+                             with_annotations=False)
+    coco_bytes = coco_payload(db, import_ds['dataset_id'], user_id, args.import_annotations)
+    total_images = args.images + args.videos * args.frames
+    print(f"Datos sembrados en {time.perf_counter() - start:.1f}s: {total_images} imágenes "
+          f"({args.videos}x{args.frames} frames), {args.categories} categorías, {args.annotations} anotaciones "
+          f"[{'MongoDB ' + args.mongo_uri if args.mongo_uri else 'mongomock'}]")
+
+    dataset_id = main_ds['dataset_id']
+    import_dataset_id = import_ds['dataset_id']
+
+    def reset_import():
+        db.annotations.delete_many({'user_id': user_id, 'image_id': {'$in': import_ds['image_ids']}})
+
+    def import_request(client):
+        return client.post('/api/annotations/import', headers=headers, content_type='multipart/form-data',
+                           data={'format': 'coco', 'dataset_id': import_dataset_id,
+                                 'annotations': (io.BytesIO(coco_bytes), 'annotations.json')})
+
+    predict_image_id = main_ds['image_ids'][0] if main_ds['image_ids'] else None
+
+    def reset_predictions():
+        db.annotations.delete_many({'image_id': predict_image_id, 'source': 'ai_prediction'})
+
+    endpoints = {
+        'get_images': (lambda c: c.get(f'/api/images?dataset_id={dataset_id}', headers=headers), None),
+        'get_annotations': (lambda c: c.get(f'/api/annotations?dataset_id={dataset_id}', headers=headers), None),
+        'get_categories': (lambda c: c.get(f'/api/categories?dataset_id={dataset_id}', headers=headers), None),
+        'export_annotations': (lambda c: c.get(f'/api/annotations/export/{dataset_id}?format=coco&cache=false',
+                                               headers=headers), None),
+        'import_annotations': (import_request, reset_import),
+        'predict_image': (lambda c: c.post('/api/ai/predict', headers=headers,
+                                           json={'image_id': predict_image_id, 'confidence': 0.25}),
+                          reset_predictions),
+    }
+    if args.only:
+        selected = [name.strip() for name in args.only.split(',')]
+        endpoints = {name: endpoints[name] for name in selected if name in endpoints}
+    if 'predict_image' in endpoints and not load_tiny_model(appmod, min(args.categories, 5) or 1):
+        print("AVISO: torch no está instalado, se omite predict_image")
+        endpoints.pop('predict_image')
+
+    results = {
+        'created': datetime.utcnow().isoformat(timespec='seconds'),
+        'config': {'backend': 'mongodb' if args.mongo_uri else 'mongomock', 'images': args.images,
+                   'videos': args.videos, 'frames': args.frames, 'categories': args.categories,
+                   'annotations': args.annotations, 'import_annotations': args.import_annotations,
+                   'iterations': args.iterations, 'concurrency': args.concurrency},
+        'endpoints': {}
+    }
+
+    print(f"\n{'endpoint':20s} {'p50':>9s} {'p90':>9s} {'p99':>9s} {'req/s':>8s} {'KB':>9s} "
+          f"{'mongo':>6s} {'RSS pico':>9s} {'ΔRSS':>7s}")
+    for name, (make_request, after_each) in endpoints.items():
+        result = run_endpoint(appmod.app, name, make_request, args.iterations, args.warmup,
+                              args.concurrency, after_each, args.verbose)
+        results['endpoints'][name] = result
+        mongo = f"{result['mongo_commands']:.0f}" if result['mongo_commands'] is not None else '-'
+        delta = f"{result['rss_delta_mb']:+.1f}" if result['rss_delta_mb'] is not None else '-'
+        print(f"{name:20s} {result['p50_ms']:8.1f}ms {result['p90_ms']:8.1f}ms {result['p99_ms']:8.1f}ms "
+              f"{result['rps']:8.1f} {result['response_kb']:9.1f} {mongo:>6s} "
+              f"{result['peak_rss_mb']:7.1f}MB {delta:>7s}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nLínea base guardada en {args.save_baseline}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.threshold)
+
+    if args.mongo_uri and not args.keep:
+        db.client.drop_database(args.db_name)
+
+    if regressions:
+        print(f"\nEndpoints que empeoran más de un {args.threshold:.0f}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark del planificador de exportación.
+
+Compara la búsqueda de anotaciones por imagen del planificador (agrupación
+en diccionario) con el recorrido lineal que hacían los exportadores, sobre
+un dataset sintético de tamaño realista.
+
+Uso (desde backend/):
+    python benchmarks/bench_export_plan.py --images 50000 --annotations 500000
+
+El recorrido lineal es O(imágenes × anotaciones), así que solo se mide sobre
+una muestra de imágenes (--legacy-sample) y se extrapola al total.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from export_engine import build_export_plan, image_annotations, plan_annotations, set_plan_splits
+
+
+def make_synthetic_dataset(n_images, n_annotations, seed=0):
+    """Generar imágenes y anotaciones con la misma forma que los documentos de MongoDB"""
+    rng = random.Random(seed)
+    images = [
+        {'_id': f'{i:024x}', 'filename': f'img_{i}.jpg', 'width': 1920, 'height': 1080}
+        for i in range(n_images)
+    ]
+    annotations = [
+        {
+            'image_id': images[rng.randrange(n_images)]['_id'],
+            'category_id': f'cat_{rng.randrange(20)}',
+            'bbox': [rng.random() * 1800, rng.random() * 1000, 50.0, 40.0]
+        }
+        for _ in range(n_annotations)
+    ]
+    return images, annotations
+
+
+def bench_planner(images, annotations):
+    """Tiempo de construir el plan y recorrer todas las imágenes con y sin división"""
+    start = time.perf_counter()
+    plan = build_export_plan(images, annotations, only_annotated=True)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    total = 0
+    for img in plan['images']:
+        total += len(image_annotations(plan, img))
+    lookup_time = time.perf_counter() - start
+
+    n = len(plan['images'])
+    set_plan_splits(plan, plan['images'][:int(n * 0.8)],
+                    plan['images'][int(n * 0.8):int(n * 0.9)],
+                    plan['images'][int(n * 0.9):])
+    start = time.perf_counter()
+    split_total = sum(len(plan_annotations(plan, split_images))
+                      for _, split_images in plan['splits'])
+    split_time = time.perf_counter() - start
+
+    assert total == split_total == len(annotations)
+    return build_time, lookup_time, split_time
+
+
+def bench_legacy(images, annotations, sample):
+    """Tiempo del recorrido lineal por imagen, medido sobre una muestra"""
+    sample_images = images[:sample]
+    start = time.perf_counter()
+    for img in sample_images:
+        img_id = str(img['_id'])
+        [ann for ann in annotations if ann['image_id'] == img_id]
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed / max(len(sample_images), 1) * len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=50000)
+    parser.add_argument('--annotations', type=int, default=500000)
+    parser.add_argument('--legacy-sample', type=int, default=100)
+    args = parser.parse_args()
+
+    images, annotations = make_synthetic_dataset(args.images, args.annotations)
+    print(f"Dataset sintético: {len(images)} imágenes, {len(annotations)} anotaciones")
+
+    build_time, lookup_time, split_time = bench_planner(images, annotations)
+    print(f"Planificador: construcción {build_time:.3f}s, búsqueda {lookup_time:.3f}s, "
+          f"división train/val/test {split_time:.3f}s")
+
+    if args.legacy_sample > 0:
+        sample_time, projected = bench_legacy(images, annotations, args.legacy_sample)
+        print(f"Recorrido lineal: {sample_time:.3f}s para {args.legacy_sample} imágenes "
+              f"(~{projected:.0f}s extrapolado a {len(images)})")
+
+
+if __name__ == '__main__':
+    main()
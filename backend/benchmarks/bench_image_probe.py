@@ -0,0 +1,164 @@
+"""
+Benchmark de la lectura de metadatos de imágenes durante la ingesta.
+
+Compara el camino anterior de importación/reprocesado (verify() al buscar,
+lectura completa y reapertura con PIL para obtener las dimensiones) con
+image_probe (cabecera al buscar y una única pasada que lee, mide y calcula
+el SHA-256 y el base64) sobre una carpeta de JPEGs, y la memoria pico de
+ambos caminos con una imagen grande.
+
+Uso (desde backend/):
+    python benchmarks/bench_image_probe.py --count 100000
+    python benchmarks/bench_image_probe.py --dir /ruta/a/carpeta/de/jpegs
+
+Sin --dir se genera una carpeta temporal con --count JPEGs sintéticos.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from image_probe import probe_image
+
+
+def make_jpeg_folder(path, count, size, quality=85):
+    """Generar count JPEGs con EXIF de orientación (se reutiliza un mismo contenido base)"""
+    os.makedirs(path, exist_ok=True)
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    for i in range(count):
+        # Variar un píxel para que cada archivo tenga un hash distinto
+        img = Image.new('RGB', size, ((i * 7) % 256, (i * 13) % 256, (i * 29) % 256))
+        img.putpixel((0, 0), (i % 256, (i // 256) % 256, 0))
+        img.save(os.path.join(path, f'img_{i:06d}.jpg'), 'JPEG', quality=quality, exif=exif)
+
+
+def list_images(path):
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.lower().endswith(('.jpg', '.jpeg')))
+
+
+def bench_legacy(paths):
+    """verify() + lectura completa + Image.open para las dimensiones (+ hash y base64 aparte)"""
+    start = time.perf_counter()
+    for path in paths:
+        with Image.open(path) as img:
+            img.verify()
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        hashlib.sha256(data).hexdigest()
+        base64.b64encode(data).decode('utf-8')
+        pil_image = Image.open(path)
+        pil_image.size
+        pil_image.close()
+    ingest_time = time.perf_counter() - start
+    return scan_time, ingest_time
+
+
+def bench_probe(paths):
+    """Cabecera al buscar + una única pasada con hash y base64"""
+    start = time.perf_counter()
+    for path in paths:
+        probe_image(path, compute_hash=False)
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for path in paths:
+        probe_image(path, with_base64=True)
+    ingest_time = time.perf_counter() - start
+    return scan_time, ingest_time
+
+
+def legacy_ingest_one(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    hashlib.sha256(data).hexdigest()
+    image_base64 = base64.b64encode(data).decode('utf-8')
+    with Image.open(io.BytesIO(data)) as pil_image:
+        pil_image.size
+    return image_base64
+
+
+def peak_memory(function, path):
+    """Memoria pico reservada en Python (el mmap de image_probe no cuenta: son páginas del archivo)"""
+    tracemalloc.start()
+    function(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench_peak_memory(folder, size):
+    """Memoria pico al ingerir una imagen grande (ruido, para que el JPEG pese varios MB)"""
+    path = os.path.join(folder, 'large.jpg')
+    Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3)).save(path, 'JPEG', quality=95)
+    file_size = os.path.getsize(path)
+    legacy = peak_memory(legacy_ingest_one, path)
+    probe = peak_memory(lambda p: probe_image(p, with_base64=True), path)
+    os.remove(path)
+    print(f"Memoria pico con una imagen de {file_size / 1024 / 1024:.1f} MB: "
+          f"anterior {legacy / 1024 / 1024:.1f} MB, image_probe {probe / 1024 / 1024:.1f} MB "
+          f"(base64 guardado: {file_size * 4 / 3 / 1024 / 1024:.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--dir', help='Carpeta existente de JPEGs (no se genera ni se borra)')
+    parser.add_argument('--size', type=int, nargs=2, default=[640, 480], metavar=('W', 'H'))
+    parser.add_argument('--large-size', type=int, nargs=2, default=[4000, 3000], metavar=('W', 'H'),
+                        help='Dimensiones de la imagen grande para medir la memoria pico')
+    args = parser.parse_args()
+
+    temp_dir = None
+    folder = args.dir
+    if not folder:
+        temp_dir = tempfile.mkdtemp(prefix='bench_probe_')
+        folder = temp_dir
+        start = time.perf_counter()
+        make_jpeg_folder(folder, args.count, tuple(args.size))
+        print(f"Generados {args.count} JPEGs {args.size[0]}x{args.size[1]} "
+              f"en {time.perf_counter() - start:.1f}s")
+
+    try:
+        paths = list_images(folder)
+        total_bytes = sum(os.path.getsize(p) for p in paths)
+        print(f"Carpeta: {len(paths)} imágenes, {total_bytes / 1024 / 1024:.1f} MB")
+
+        # Los dos caminos leen los mismos archivos; el primero calienta la caché de páginas
+        legacy_scan, legacy_ingest = bench_legacy(paths)
+        probe_scan, probe_ingest = bench_probe(paths)
+
+        n = max(len(paths), 1)
+        print(f"Anterior:    búsqueda {legacy_scan:.2f}s, ingesta {legacy_ingest:.2f}s "
+              f"({(legacy_scan + legacy_ingest) / n * 1e6:.0f} µs/imagen)")
+        print(f"image_probe: búsqueda {probe_scan:.2f}s, ingesta {probe_ingest:.2f}s "
+              f"({(probe_scan + probe_ingest) / n * 1e6:.0f} µs/imagen)")
+        print(f"Aceleración total: {(legacy_scan + legacy_ingest) / max(probe_scan + probe_ingest, 1e-9):.2f}x")
+
+        peak_folder = tempfile.mkdtemp(prefix='bench_probe_peak_')
+        try:
+            bench_peak_memory(peak_folder, tuple(args.large_size))
+        finally:
+            shutil.rmtree(peak_folder, ignore_errors=True)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
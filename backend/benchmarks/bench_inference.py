@@ -0,0 +1,153 @@
+"""
+Benchmark de latencia de inferencia en CPU: PyTorch frente a ONNX Runtime
+(y la variante INT8 si se ha generado, ver quantization).
+
+Carga el mismo modelo guardado con cada motor (ver inference y onnx_backend),
+mide la conversión a ONNX (la primera vez; después se reutiliza el .onnx
+guardado junto al modelo) y la latencia de inference.predict con imágenes
+sintéticas de varios tamaños, una petición cada vez (lotes de 1).
+
+Uso (desde backend/):
+    python benchmarks/bench_inference.py --model ai_models/yolov8n.pt
+    python benchmarks/bench_inference.py --model ai_models/yolov8n.pt --sizes 640x480,3840x2160 --runs 50
+    python benchmarks/bench_inference.py --model ai_models/yolov8n.pt --threads 4 --output cpu.json
+    python benchmarks/bench_inference.py --model ai_models/yolov8n.pt --sizes 8000x6000 --tiled
+
+La GPU se oculta (CUDA_VISIBLE_DEVICES vacío) para comparar ambos motores en CPU.
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+# Antes de importar torch: comparar en CPU
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def make_image(size, seed):
+    """JPEG sintético con rectángulos (el contenido apenas influye en la latencia)"""
+    import random
+    rng = random.Random(seed)
+    img = Image.new('RGB', size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    for _ in range(20):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        img.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+                  (x, y, min(size[0], x + size[0] // 8), min(size[1], y + size[1] // 8)))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def bench_runtime(inference, images, runs, warmup, confidence, tiled=None):
+    """Latencias (ms) de inference.predict por tamaño de imagen con el modelo ya cargado"""
+    results = {}
+    for label, data in images.items():
+        for _ in range(warmup):
+            inference.predict(data, confidence, tiled=tiled)
+        times = []
+        detections = 0
+        for _ in range(runs):
+            start = time.perf_counter()
+            prediction = inference.predict(data, confidence, tiled=tiled)
+            times.append((time.perf_counter() - start) * 1000)
+            detections = len(prediction['detections'])
+        times.sort()
+        results[label] = {'p50_ms': percentile(times, 0.5), 'p90_ms': percentile(times, 0.9),
+                          'mean_ms': statistics.fmean(times), 'detections': detections}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='Modelo guardado (.pt de ultralytics o .torchscript)')
+    parser.add_argument('--sizes', default='640x480,1920x1080', help='Tamaños de imagen separados por comas')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--confidence', type=float, default=0.25)
+    parser.add_argument('--threads', type=int, help='Hilos de ONNX Runtime y de PyTorch (por defecto todas las CPUs)')
+    parser.add_argument('--tiled', action='store_true', help='Predecir por teselas (ver tiling)')
+    parser.add_argument('--reconvert', action='store_true', help='Borrar el .onnx guardado y medir la conversión')
+    parser.add_argument('--output', help='Guardar los resultados en JSON')
+    args = parser.parse_args()
+
+    import inference
+    import onnx_backend
+    from quantization import quantized_path_for
+
+    if args.threads:
+        onnx_backend.ONNX_THREADS = args.threads
+        try:
+            import torch
+            torch.set_num_threads(args.threads)
+        except ImportError:
+            pass
+
+    sizes = [tuple(int(value) for value in size.lower().split('x')) for size in args.sizes.split(',')]
+    images = {f'{w}x{h}': make_image((w, h), seed) for seed, (w, h) in enumerate(sizes)}
+    model_path = os.path.abspath(args.model)
+    onnx_path = onnx_backend.onnx_path_for(model_path)
+    if args.reconvert and os.path.exists(onnx_path):
+        os.remove(onnx_path)
+
+    int8_path = quantized_path_for(model_path)
+    runtimes = [('torch', model_path), ('onnx', model_path)]
+    if os.path.exists(int8_path):
+        runtimes.append(('int8', int8_path))
+
+    results = {'model': model_path, 'threads': args.threads, 'runs': args.runs, 'tiled': args.tiled,
+               'runtimes': {}}
+    for runtime, path in runtimes:
+        onnx_backend.INFERENCE_RUNTIME = 'torch' if runtime == 'torch' else 'onnx'
+        start = time.perf_counter()
+        try:
+            status = inference.load_model(path)
+        except RuntimeError as e:
+            print(f"AVISO: no se pudo cargar el modelo con {runtime}: {e}")
+            continue
+        load_seconds = time.perf_counter() - start
+        if runtime == 'onnx' and status['runtime'] != 'onnx':
+            print("AVISO: la conversión a ONNX falló, se omite onnx")
+            inference.unload_model()
+            continue
+        print(f"{runtime}: cargado en {load_seconds:.2f}s ({status['runtime']})")
+        results['runtimes'][runtime] = {'load_seconds': load_seconds,
+                                        'sizes': bench_runtime(inference, images, args.runs, args.warmup,
+                                                               args.confidence, args.tiled or None)}
+        inference.unload_model()
+
+    print(f"\n{'motor':<8} {'imagen':<12} {'p50 ms':>9} {'p90 ms':>9} {'media ms':>9} {'detecc.':>8}")
+    for runtime, data in results['runtimes'].items():
+        for label, row in data['sizes'].items():
+            print(f"{runtime:<8} {label:<12} {row['p50_ms']:>9.1f} {row['p90_ms']:>9.1f} {row['mean_ms']:>9.1f} "
+                  f"{row['detections']:>8}")
+    if 'torch' in results['runtimes']:
+        print()
+        for runtime in ('onnx', 'int8'):
+            if runtime not in results['runtimes']:
+                continue
+            for label in images:
+                torch_p50 = results['runtimes']['torch']['sizes'][label]['p50_ms']
+                other_p50 = results['runtimes'][runtime]['sizes'][label]['p50_ms']
+                print(f"{label}: {runtime} {torch_p50 / other_p50:.2f}x frente a PyTorch (p50)")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
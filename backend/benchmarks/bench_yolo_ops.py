@@ -0,0 +1,132 @@
+"""
+Benchmark del preprocesado y la decodificación de TorchScript.
+
+Compara el camino anterior (torchvision Resize + ToTensor sin conservar la
+proporción, NMS de torchvision y reescalado de cada detección en Python) con
+yolo_ops (letterbox con OpenCV y decodificación vectorizada en NumPy) sobre
+imágenes sintéticas y una salida sintética de YOLOv8 ([lote, 4 + clases,
+8400 anclas]) con un número dado de candidatas sobre el umbral.
+
+Uso (desde backend/):
+    python benchmarks/bench_yolo_ops.py
+    python benchmarks/bench_yolo_ops.py --sizes 1920x1080,8000x6000 --batch 8 --candidates 2000
+
+El camino anterior necesita torch y torchvision; sin ellos solo se mide yolo_ops.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+import yolo_ops
+
+INPUT_SIZE = 640
+ANCHORS = 8400
+IOU_THRESHOLD = 0.45
+
+
+def synthetic_output(batch, classes, candidates, seed=0):
+    """Salida [lote, 4 + clases, anclas] con candidates anclas por encima de 0.5"""
+    rng = np.random.default_rng(seed)
+    output = np.zeros((batch, 4 + classes, ANCHORS), dtype=np.float32)
+    output[:, 0:2] = rng.uniform(0, INPUT_SIZE, (batch, 2, ANCHORS))
+    output[:, 2:4] = rng.uniform(8, 120, (batch, 2, ANCHORS))
+    output[:, 4:] = rng.uniform(0, 0.3, (batch, classes, ANCHORS))
+    for index in range(batch):
+        chosen = rng.choice(ANCHORS, candidates, replace=False)
+        output[index, 4 + rng.integers(0, classes, candidates), chosen] = rng.uniform(0.5, 1, candidates)
+    return output
+
+
+def timed_runs(function, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def legacy_functions(images, output):
+    """Preprocesado y decodificación anteriores (necesitan torch y torchvision)"""
+    import torch
+    import torchvision.transforms as transforms
+    from torchvision.ops import nms
+
+    def preprocess():
+        transform = transforms.Compose([
+            transforms.Resize((INPUT_SIZE, INPUT_SIZE)),
+            transforms.ToTensor(),
+        ])
+        return torch.stack([transform(image) for image in images])
+
+    predictions = torch.from_numpy(output)
+
+    def decode():
+        results = []
+        for i, image in enumerate(images):
+            pred = predictions[i:i + 1][0].transpose(0, 1)
+            boxes_xywh, class_probs = pred[:, :4], pred[:, 4:]
+            max_probs, class_ids = torch.max(class_probs, dim=1)
+            mask = max_probs >= 0.5
+            boxes, scores, classes = boxes_xywh[mask], max_probs[mask], class_ids[mask]
+            boxes_xyxy = torch.zeros_like(boxes)
+            boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2] / 2
+            boxes_xyxy[:, 1] = boxes[:, 1] - boxes[:, 3] / 2
+            boxes_xyxy[:, 2] = boxes[:, 0] + boxes[:, 2] / 2
+            boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3] / 2
+            keep = nms(boxes_xyxy, scores, iou_threshold=IOU_THRESHOLD)
+            scale_x, scale_y = image.size[0] / INPUT_SIZE, image.size[1] / INPUT_SIZE
+            detections = []
+            for box, score, cls in zip(boxes_xyxy[keep].cpu().tolist(), scores[keep].cpu().tolist(),
+                                       classes[keep].cpu().tolist()):
+                x1, y1, x2, y2 = box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y
+                detections.append({'bbox': [x1, y1, x2 - x1, y2 - y1], 'confidence': float(score),
+                                   'class': int(cls)})
+            results.append(detections)
+        return results
+
+    return preprocess, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='640x480,1920x1080,4000x3000', help='Tamaños de imagen separados por comas')
+    parser.add_argument('--batch', type=int, default=4, help='Imágenes por lote')
+    parser.add_argument('--classes', type=int, default=80)
+    parser.add_argument('--candidates', type=int, default=500, help='Anclas sobre el umbral por imagen')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    output = synthetic_output(args.batch, args.classes, args.candidates)
+    print(f"{'imagen':<12} {'camino':<10} {'preproc. ms':>12} {'decod. ms':>10}")
+    for size in args.sizes.split(','):
+        width, height = (int(value) for value in size.lower().split('x'))
+        images = [Image.new('RGB', (width, height), (i * 30 % 256, 90, 160)) for i in range(args.batch)]
+        size_input = (INPUT_SIZE, INPUT_SIZE)
+        letterboxes = yolo_ops.preprocess(images, size_input)[1]
+
+        def decode_new():
+            return [yolo_ops.decode(output[i], 0.5, letterboxes[i], image.size, IOU_THRESHOLD)
+                    for i, image in enumerate(images)]
+
+        rows = [('yolo_ops', timed_runs(lambda: yolo_ops.preprocess(images, size_input), args.runs),
+                 timed_runs(decode_new, args.runs))]
+        try:
+            legacy_preprocess, legacy_decode = legacy_functions(images, output)
+            rows.insert(0, ('anterior', timed_runs(legacy_preprocess, args.runs), timed_runs(legacy_decode, args.runs)))
+        except ImportError:
+            if size == args.sizes.split(',')[0]:
+                print("AVISO: torch/torchvision no instalados, se omite el camino anterior")
+        for name, preprocess_ms, decode_ms in rows:
+            print(f"{size:<12} {name:<10} {preprocess_ms:>12.1f} {decode_ms:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Subidas por fragmentos reanudables.
+
+Protocolo:
+    1. init: se registra la subida (nombre, tamaño, destino) y se reserva el
+       archivo final con su tamaño completo.
+    2. chunk: cada fragmento se envía con su desplazamiento y su SHA-256 y se
+       escribe directamente en su posición del archivo final; reenviar un
+       fragmento ya recibido lo sobrescribe con los mismos bytes.
+    3. complete: cuando están todos los fragmentos el archivo se entrega a la
+       ruta de importación correspondiente (imagen, video o ZIP).
+
+El estado de cada subida se guarda en la colección 'uploads', así que un
+cliente puede consultar qué fragmentos faltan y continuar tras un corte.
+"""
+import os
+import shutil
+import hashlib
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from werkzeug.datastructures import FileStorage
+
+# Carpeta de las subidas en curso (fuera de la carpeta vigilada de datasets)
+UPLOAD_DIR = os.getenv('UPLOAD_DIR', os.path.join(os.getcwd(), 'uploads'))
+
+# Tamaño de fragmento por defecto y límites aceptados
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Tamaño máximo de un archivo subido por fragmentos
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', 20 * 1024 * 1024 * 1024))  # 20GB
+
+# Bloque de copia desde el cuerpo de la petición al archivo
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Subidas sin actividad que se eliminan
+UPLOAD_EXPIRATION = timedelta(hours=int(os.getenv('UPLOAD_EXPIRATION_HOURS', 24)))
+
+# Destinos admitidos y extensiones esperadas
+UPLOAD_TARGETS = {
+    'image': None,
+    'video': None,
+    'dataset_zip': ('.zip',),
+    'images_zip': ('.zip',)
+}
+
+def upload_path(upload):
+    """Ruta del archivo que se está recibiendo"""
+    return os.path.join(UPLOAD_DIR, str(upload['_id']), os.path.basename(upload['filename']))
+
+def chunk_count(upload):
+    return max(1, -(-upload['size'] // upload['chunk_size']))
+
+def expected_chunk_length(upload, offset):
+    return min(upload['chunk_size'], upload['size'] - offset)
+
+def missing_chunks(upload):
+    """Desplazamientos de los fragmentos que aún no se han recibido"""
+    received = upload.get('chunks', {})
+    return [offset for offset in range(0, max(upload['size'], 1), upload['chunk_size'])
+            if str(offset) not in received]
+
+def upload_status(upload):
+    """Estado serializable de una subida"""
+    missing = missing_chunks(upload)
+    received = upload.get('chunks', {})
+    return {
+        'upload_id': str(upload['_id']),
+        'filename': upload['filename'],
+        'target': upload['target'],
+        'size': upload['size'],
+        'chunk_size': upload['chunk_size'],
+        'total_chunks': chunk_count(upload),
+        'received_chunks': len(received),
+        'received_bytes': sum(chunk['length'] for chunk in received.values()),
+        'missing_offsets': missing[:1000],
+        'complete': not missing,
+        'status': upload['status']
+    }
+
+def create_upload(db, user_id, filename, size, target, chunk_size=None, options=None):
+    """
+    Registrar una subida y reservar el archivo final
+
+    Raises:
+        ValueError si los parámetros no son válidos
+    """
+    if target not in UPLOAD_TARGETS:
+        raise ValueError(f'Destino no soportado: {target}')
+    filename = os.path.basename(filename or '')
+    if not filename:
+        raise ValueError('Nombre de archivo vacío')
+    extensions = UPLOAD_TARGETS[target]
+    if extensions and not filename.lower().endswith(extensions):
+        raise ValueError('Solo se permiten archivos ZIP')
+    size = int(size)
+    if size <= 0 or size > MAX_UPLOAD_SIZE:
+        raise ValueError(f'Tamaño no válido (máximo {MAX_UPLOAD_SIZE} bytes)')
+    chunk_size = int(chunk_size or DEFAULT_CHUNK_SIZE)
+    if chunk_size < MIN_CHUNK_SIZE or chunk_size > MAX_CHUNK_SIZE:
+        raise ValueError(f'chunk_size debe estar entre {MIN_CHUNK_SIZE} y {MAX_CHUNK_SIZE}')
+
+    now = datetime.utcnow()
+    upload = {
+        'user_id': user_id,
+        'filename': filename,
+        'size': size,
+        'chunk_size': chunk_size,
+        'target': target,
+        'options': options or {},
+        'chunks': {},
+        'status': 'uploading',
+        'created_date': now,
+        'updated_date': now
+    }
+    upload['_id'] = db.uploads.insert_one(upload).inserted_id
+
+    path = upload_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    return upload
+
+def get_upload(db, upload_id, user_id):
+    """Subida del usuario (o None)"""
+    if not ObjectId.is_valid(upload_id):
+        return None
+    return db.uploads.find_one({'_id': ObjectId(upload_id), 'user_id': user_id})
+
+def write_chunk(db, upload, offset, stream, checksum=None):
+    """
+    Escribir un fragmento en su posición del archivo final leyendo el cuerpo
+    de la petición por bloques (la memoria no depende del tamaño del fragmento)
+
+    Args:
+        offset: Desplazamiento del fragmento (múltiplo de chunk_size)
+        stream: Flujo con los bytes del fragmento
+        checksum: SHA-256 hexadecimal esperado del fragmento
+
+    Returns:
+        Estado actualizado de la subida
+
+    Raises:
+        ValueError si el desplazamiento, la longitud o el checksum no son válidos
+    """
+    if upload['status'] != 'uploading':
+        raise ValueError('La subida ya no admite fragmentos')
+    if offset < 0 or offset >= upload['size'] or offset % upload['chunk_size'] != 0:
+        raise ValueError('Desplazamiento no válido (debe ser múltiplo de chunk_size)')
+    expected_length = expected_chunk_length(upload, offset)
+
+    hasher = hashlib.sha256()
+    written = 0
+    with open(upload_path(upload), 'r+b') as f:
+        f.seek(offset)
+        while written < expected_length:
+            block = stream.read(min(WRITE_BUFFER_SIZE, expected_length - written))
+            if not block:
+                break
+            hasher.update(block)
+            f.write(block)
+            written += len(block)
+        # Bytes de más: el fragmento no corresponde a este desplazamiento
+        if stream.read(1):
+            db.uploads.update_one({'_id': upload['_id']}, {'$unset': {f'chunks.{offset}': ''}})
+            raise ValueError(f'El fragmento supera la longitud esperada ({expected_length} bytes)')
+
+    digest = hasher.hexdigest()
+    if written != expected_length or (checksum and checksum.lower() != digest):
+        # Si sobrescribió un fragmento ya recibido, ese fragmento vuelve a faltar
+        db.uploads.update_one({'_id': upload['_id']}, {'$unset': {f'chunks.{offset}': ''}})
+        if written != expected_length:
+            raise ValueError(f'Fragmento incompleto: {written} de {expected_length} bytes')
+        raise ValueError('El checksum del fragmento no coincide')
+
+    updated = db.uploads.find_one_and_update(
+        {'_id': upload['_id']},
+        {'$set': {f'chunks.{offset}': {'length': written, 'sha256': digest},
+                  'updated_date': datetime.utcnow()}},
+        return_document=True
+    )
+    return upload_status(updated)
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(WRITE_BUFFER_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def assembled_file(upload, content_type=None):
+    """
+    Archivo completo como FileStorage para las rutas de importación existentes.
+    Su save() mueve el archivo en lugar de copiarlo.
+    """
+    path = upload_path(upload)
+    storage = FileStorage(stream=open(path, 'rb'), filename=upload['filename'],
+                          content_type=content_type)
+
+    def move_to(destination, buffer_size=None):
+        storage.stream.close()
+        shutil.move(path, destination)
+
+    storage.save = move_to
+    return storage
+
+def claim_upload(db, upload):
+    """
+    Pasar la subida a 'processing' si sigue en curso (evita entregarla dos veces)
+
+    Returns:
+        True si esta petición debe procesarla
+    """
+    result = db.uploads.update_one({'_id': upload['_id'], 'status': 'uploading'},
+                                   {'$set': {'status': 'processing', 'updated_date': datetime.utcnow()}})
+    return result.modified_count == 1
+
+def release_upload(db, upload):
+    """Volver a 'uploading' tras un error al procesar (se puede reintentar complete)"""
+    db.uploads.update_one({'_id': upload['_id']}, {'$set': {'status': 'uploading'}})
+
+def finish_upload(db, upload, result):
+    """Marcar la subida como completada y eliminar sus archivos temporales"""
+    db.uploads.update_one({'_id': upload['_id']}, {'$set': {
+        'status': 'completed',
+        'result': result,
+        'updated_date': datetime.utcnow()
+    }})
+    shutil.rmtree(os.path.join(UPLOAD_DIR, str(upload['_id'])), ignore_errors=True)
+
+def abort_upload(db, upload):
+    """Cancelar una subida y eliminar sus archivos"""
+    db.uploads.delete_one({'_id': upload['_id']})
+    shutil.rmtree(os.path.join(UPLOAD_DIR, str(upload['_id'])), ignore_errors=True)
+
+def cleanup_stale_uploads(db):
+    """Eliminar las subidas sin actividad desde hace más de UPLOAD_EXPIRATION"""
+    limit = datetime.utcnow() - UPLOAD_EXPIRATION
+    stale = list(db.uploads.find({'status': {'$in': ['uploading', 'processing']},
+                                 'updated_date': {'$lt': limit}}, {'_id': 1}))
+    for upload in stale:
+        abort_upload(db, upload)
+    return len(stale)
@@ -0,0 +1,136 @@
+"""
+Lectura incremental de archivos COCO JSON.
+
+Los arrays 'categories', 'images' y 'annotations' se recorren como flujos con
+un parser por eventos (ijson), de modo que la memoria depende del objeto que
+se está procesando y no del tamaño del archivo. Cada sección se lee en una
+pasada independiente porque el orden de las claves en el JSON no está
+garantizado (muchos archivos COCO ponen 'categories' al final).
+"""
+import os
+import shutil
+import zipfile
+
+# Secciones de un archivo COCO en el orden en que deben procesarse
+COCO_SECTIONS = ('categories', 'images', 'annotations')
+
+def iter_coco_section(path, section):
+    """
+    Recorrer los elementos de un array de nivel superior de un archivo COCO
+
+    Los números decimales se devuelven como float (no Decimal) para poder
+    guardarlos directamente en MongoDB.
+    """
+    import ijson
+
+    with open(path, 'rb') as f:
+        for item in ijson.items(f, f'{section}.item', use_float=True):
+            yield item
+
+def validate_coco_file(path):
+    """
+    Comprobar que el archivo es un objeto JSON sin construirlo en memoria
+
+    Raises:
+        ValueError si el archivo no es JSON válido o no es un objeto
+    """
+    import ijson
+
+    try:
+        with open(path, 'rb') as f:
+            events = ijson.parse(f)
+            _, first_event, _ = next(events)
+            if first_event != 'start_map':
+                raise ValueError('El JSON no es un objeto COCO')
+            for _ in events:
+                pass
+    except (ijson.JSONError, StopIteration) as e:
+        raise ValueError(f'JSON inválido: {e}')
+
+def extract_coco_json_files(zip_path, dest_dir):
+    """
+    Extraer solo los archivos .json de un ZIP, copiándolos por bloques
+
+    Returns:
+        Lista ordenada de tuplas (nombre dentro del ZIP, ruta extraída)
+    """
+    json_paths = []
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for index, member in enumerate(zip_ref.infolist()):
+            if member.is_dir() or not member.filename.lower().endswith('.json'):
+                continue
+            # Ignorar metadatos de macOS (__MACOSX/._archivo.json)
+            if os.path.basename(member.filename).startswith('._'):
+                continue
+            target = os.path.join(dest_dir, f'{index}_{os.path.basename(member.filename)}')
+            with zip_ref.open(member) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            json_paths.append((member.filename, target))
+
+    return sorted(json_paths)
+
+# ==================== COMBINACIÓN DE ARCHIVOS COCO ====================
+
+def coco_file_source(path):
+    """Fuente de secciones COCO leída por flujo desde un archivo"""
+    return lambda section: iter_coco_section(path, section)
+
+def merge_coco_streams(sources):
+    """
+    Combinar varios archivos COCO en un único flujo con ids consistentes.
+
+    Las categorías se unifican por nombre y las imágenes por file_name usando
+    diccionarios, así que el coste es lineal en el total de elementos. Los ids
+    de cada archivo se remapean a ids globales antes de pasar al siguiente, por
+    lo que dos archivos que reutilizan los mismos ids no colisionan. Solo se
+    mantienen en memoria los mapas nombre → id y file_name → id.
+
+    Los elementos se modifican en su sitio (sin copiarlos).
+
+    Args:
+        sources: Lista de fuentes; cada una es una función sección → iterable
+
+    Yields:
+        Tuplas (sección, elemento) con 'categories' e 'images' nuevas antes
+        que las 'annotations' de cada archivo
+    """
+    category_ids = {}  # nombre -> id global
+    image_ids = {}  # file_name -> id global
+    next_annotation_id = 1
+
+    for file_index, source in enumerate(sources):
+        local_categories = {}  # id del archivo -> id global
+        local_images = {}
+
+        for cat in source('categories'):
+            name = cat.get('name')
+            merged_id = category_ids.get(name)
+            if merged_id is None:
+                merged_id = category_ids[name] = len(category_ids) + 1
+                local_categories[cat.get('id')] = merged_id
+                cat['id'] = merged_id
+                yield 'categories', cat
+            else:
+                local_categories[cat.get('id')] = merged_id
+
+        for img in source('images'):
+            # Imágenes sin file_name: no se pueden unificar entre archivos
+            key = img.get('file_name') or (file_index, img.get('id'))
+            merged_id = image_ids.get(key)
+            if merged_id is None:
+                merged_id = image_ids[key] = len(image_ids) + 1
+                local_images[img.get('id')] = merged_id
+                img['id'] = merged_id
+                yield 'images', img
+            else:
+                local_images[img.get('id')] = merged_id
+
+        for ann in source('annotations'):
+            image_id = local_images.get(ann.get('image_id'))
+            if image_id is None:
+                continue
+            ann['image_id'] = image_id
+            ann['category_id'] = local_categories.get(ann.get('category_id'))
+            ann['id'] = next_annotation_id
+            next_annotation_id += 1
+            yield 'annotations', ann
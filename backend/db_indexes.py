@@ -0,0 +1,276 @@
+"""
+Índices de MongoDB declarados junto a las consultas que los usan.
+
+INDEXES recoge, por colección, los índices que necesitan las consultas de
+app.py y de los módulos de ingesta y exportación. ensure_indexes() los crea al
+arrancar la aplicación (create_index no hace nada si el índice ya existe), así
+que no dependen de scripts/init-mongo.js, que solo se ejecuta al crear el
+volumen de Mongo.
+
+index_report() compara los índices declarados con los existentes y con su uso
+según $indexStats, y explain_queries() comprueba con explain() que las
+consultas más frecuentes (QUERY_SHAPES) usan un índice.
+
+Uso desde backend/:
+    python db_indexes.py            # informe
+    python db_indexes.py --apply    # crear los índices que falten e informar
+
+El mismo informe está en GET /api/health/indexes, solo con METRICS_TOKEN
+(cabecera Authorization: Bearer <METRICS_TOKEN>).
+"""
+import os
+import threading
+import time
+
+from pymongo.errors import ConnectionFailure
+
+# Índices por colección: claves y opciones de create_index
+INDEXES = {
+    'users': [
+        {'keys': [('username', 1)]},  # login y registro
+    ],
+    'datasets': [
+        {'keys': [('user_id', 1), ('name', 1)]},  # listado por usuario y nombre repetido
+    ],
+    'images': [
+        {'keys': [('dataset_id', 1), ('user_id', 1)]},  # imágenes y recuentos de un dataset
+        {'keys': [('user_id', 1), ('project_id', 1)]},  # listado sin dataset
+        {'keys': [('video_id', 1), ('user_id', 1), ('frame_number', 1)]},  # frames de un video
+        {'keys': [('dataset_id', 1), ('file_path', 1)]},  # índice de archivos y reprocesado
+        # Deduplicación por contenido (ver image_dedup)
+        {'keys': [('dataset_id', 1), ('sha256', 1)], 'unique': True,
+         'partialFilterExpression': {'sha256': {'$type': 'string'}},
+         'name': 'dataset_id_1_sha256_1_unique'},
+        # Archivos compartidos entre datasets (IMAGE_BLOB_SHARING)
+        {'keys': [('sha256', 1)], 'partialFilterExpression': {'sha256': {'$type': 'string'}},
+         'name': 'sha256_1_partial'},
+    ],
+    'annotations': [
+        {'keys': [('image_id', 1), ('user_id', 1)]},  # anotaciones de una imagen
+        {'keys': [('video_id', 1), ('user_id', 1)]},  # anotaciones de un video
+        {'keys': [('user_id', 1), ('category_id', 1)]},  # anotaciones del usuario y por categoría
+        {'keys': [('user_id', 1), ('category', 1)]},  # categorías antiguas guardadas por nombre
+        {'keys': [('category_id', 1)]},  # borrado de categorías
+    ],
+    'categories': [
+        {'keys': [('user_id', 1), ('dataset_id', 1)]},  # categorías del usuario y del dataset
+        {'keys': [('dataset_id', 1), ('name', 1)]},  # búsqueda por nombre en un dataset
+    ],
+    'category_visibility': [
+        {'keys': [('dataset_id', 1), ('category_id', 1)]},
+        {'keys': [('category_id', 1)]},
+    ],
+    'videos': [
+        {'keys': [('user_id', 1), ('dataset_id', 1)]},
+    ],
+    'ai_models': [
+        {'keys': [('file_path', 1)]},
+        {'keys': [('user_id', 1)]},
+        {'keys': [('is_preloaded', 1)]},
+    ],
+    'exports': [
+        {'keys': [('dataset_id', 1), ('user_id', 1)]},
+    ],
+    'dataset_splits': [
+        # Un documento por unidad asignada (ver split_engine)
+        {'keys': [('dataset_id', 1), ('config_key', 1), ('unit_key', 1)], 'unique': True},
+    ],
+    'dataset_files': [
+        {'keys': [('dataset_id', 1), ('path', 1)], 'unique': True},  # ver file_index
+        {'keys': [('image_id', 1)]},
+    ],
+    'uploads': [
+        {'keys': [('status', 1), ('updated_date', 1)]},  # limpieza de subidas abandonadas
+    ],
+}
+
+# Consultas representativas para explain(): (colección, filtro, orden)
+QUERY_SHAPES = [
+    ('users', {'username': 'x'}, None),
+    ('datasets', {'user_id': 'x'}, None),
+    ('datasets', {'name': 'x', 'user_id': 'x'}, None),
+    ('images', {'dataset_id': 'x', 'user_id': 'x'}, None),
+    ('images', {'user_id': 'x', 'dataset_id': 'x', 'video_id': {'$exists': False}}, None),
+    ('images', {'video_id': 'x', 'user_id': 'x'}, [('frame_number', 1)]),
+    ('images', {'dataset_id': 'x', 'file_path': {'$in': ['x']}}, None),
+    ('images', {'dataset_id': 'x', 'sha256': {'$in': ['x']}}, None),
+    ('annotations', {'image_id': 'x', 'user_id': 'x'}, None),
+    ('annotations', {'image_id': {'$in': ['x']}}, None),
+    ('annotations', {'video_id': 'x', 'user_id': 'x'}, None),
+    ('annotations', {'user_id': 'x'}, None),
+    ('categories', {'dataset_id': 'x', 'user_id': 'x'}, None),
+    ('categories', {'dataset_id': 'x'}, None),
+    ('categories', {'name': 'x', 'dataset_id': 'x'}, None),
+    ('category_visibility', {'category_id': 'x', 'dataset_id': 'x'}, None),
+    ('videos', {'dataset_id': 'x', 'user_id': 'x'}, None),
+    ('ai_models', {'file_path': 'x'}, None),
+    ('dataset_splits', {'dataset_id': 'x', 'config_key': 'x'}, None),
+    ('dataset_files', {'dataset_id': 'x'}, None),
+]
+
+_ensured = set()
+_collection_locks = {}
+_ensure_guard = threading.Lock()
+
+def index_name(spec):
+    """Nombre del índice (el que asigna MongoDB si no se indica)"""
+    return spec.get('name') or '_'.join(f'{field}_{direction}' for field, direction in spec['keys'])
+
+def ensure_indexes(db, collections=None):
+    """
+    Crear los índices declarados (una vez por proceso y colección)
+
+    Args:
+        collections: Colecciones a preparar (todas por defecto)
+
+    Returns:
+        Dict con los índices comprobados y los que no se han podido crear
+    """
+    checked, failed = [], []
+    start = time.perf_counter()
+    for collection in collections or INDEXES:
+        if failed and failed[-1].get('connection'):
+            break
+        with _ensure_guard:
+            lock = _collection_locks.setdefault(collection, threading.Lock())
+        # Quien llegue mientras otro hilo crea los índices espera a que terminen
+        with lock:
+            if collection in _ensured:
+                continue
+            for spec in INDEXES.get(collection, []):
+                options = {key: value for key, value in spec.items() if key != 'keys'}
+                options['name'] = index_name(spec)
+                try:
+                    db[collection].create_index(spec['keys'], **options)
+                    checked.append(f'{collection}.{options["name"]}')
+                except ConnectionFailure as e:
+                    # Sin conexión: no se sigue y se reintentará en la siguiente llamada
+                    print(f"AVISO: no se pudieron crear los índices de {collection}: {e}")
+                    failed.append({'collection': collection, 'index': options['name'],
+                                   'error': str(e), 'connection': True})
+                    break
+                except Exception as e:
+                    # Datos que incumplen un índice único u opciones distintas de un índice existente
+                    print(f"AVISO: no se pudo crear el índice {collection}.{options['name']}: {e}")
+                    failed.append({'collection': collection, 'index': options['name'], 'error': str(e)})
+            else:
+                _ensured.add(collection)
+    if checked or failed:
+        print(f"Índices comprobados: {len(checked)} ({len(failed)} con error) "
+              f"en {time.perf_counter() - start:.2f}s")
+    return {'checked': checked, 'failed': failed}
+
+def ensure_indexes_in_background(get_db):
+    """Crear los índices sin retrasar el arranque (la creación puede tardar en colecciones grandes)"""
+    def run():
+        try:
+            ensure_indexes(get_db())
+        except Exception as e:
+            print(f"Error creando índices: {e}")
+    threading.Thread(target=run, daemon=True).start()
+
+def _index_usage(db, collection):
+    """Operaciones por índice desde el arranque de mongod ($indexStats) o None si no está disponible"""
+    try:
+        return {row['name']: row['accesses']['ops'] for row in db[collection].aggregate([{'$indexStats': {}}])}
+    except Exception:
+        return None
+
+def index_report(db):
+    """
+    Comparar los índices declarados con los existentes y su uso
+
+    Returns:
+        Dict por colección con missing (declarados sin crear), unused (sin
+        accesos según $indexStats) y undeclared (existentes no declarados)
+    """
+    report = {}
+    existing_collections = set(db.list_collection_names())
+    for collection in sorted(existing_collections | set(INDEXES)):
+        existing = db[collection].index_information() if collection in existing_collections else {}
+        existing_keys = {tuple(tuple(key) for key in info['key']): name for name, info in existing.items()}
+        declared = {tuple(spec['keys']): index_name(spec) for spec in INDEXES.get(collection, [])}
+        usage = _index_usage(db, collection) if existing else None
+
+        missing = [name for keys, name in declared.items() if keys not in existing_keys]
+        undeclared = [name for keys, name in existing_keys.items() if keys not in declared and name != '_id_']
+        unused = []
+        if usage is not None:
+            unused = [name for name in existing
+                      if name != '_id_' and usage.get(name, 0) == 0 and not existing[name].get('unique')]
+        report[collection] = {
+            'indexes': sorted(existing),
+            'missing': missing,
+            'unused': sorted(unused),
+            'undeclared': sorted(undeclared),
+            'usage': usage
+        }
+    return report
+
+def _plan_stages(plan, found=None):
+    """Etapas (y nombres de índice) del plan ganador de explain()"""
+    found = found if found is not None else []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            found.append((plan['stage'], plan.get('indexName')))
+        for value in plan.values():
+            _plan_stages(value, found)
+    elif isinstance(plan, list):
+        for value in plan:
+            _plan_stages(value, found)
+    return found
+
+def explain_queries(db, shapes=QUERY_SHAPES):
+    """
+    Plan de ejecución de las consultas representativas
+
+    Returns:
+        Lista de dicts con collection, filter, sort, index (usado) y
+        collscan (True si recorre la colección entera)
+    """
+    results = []
+    for collection, query, sort in shapes:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            explain = cursor.explain()
+        except Exception as e:
+            results.append({'collection': collection, 'filter': sorted(query), 'error': str(e)})
+            continue
+        winning = explain.get('queryPlanner', {}).get('winningPlan', {})
+        stages = _plan_stages(winning)
+        indexes = [name for _, name in stages if name]
+        results.append({
+            'collection': collection,
+            'filter': sorted(query),
+            'sort': [field for field, _ in sort] if sort else None,
+            'index': indexes[0] if indexes else None,
+            'collscan': any(stage == 'COLLSCAN' for stage, _ in stages),
+            'in_memory_sort': any(stage == 'SORT' for stage, _ in stages)
+        })
+    return results
+
+def main():
+    import argparse
+    import json
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description='Informe de índices de MongoDB')
+    parser.add_argument('--apply', action='store_true', help='Crear los índices declarados que falten')
+    args = parser.parse_args()
+
+    db = MongoClient(os.getenv('MONGO_URI', 'mongodb://mongo:27017/'))['viewannotator']
+    if args.apply:
+        ensure_indexes(db)
+
+    for collection, info in index_report(db).items():
+        if info['missing'] or info['unused'] or info['undeclared']:
+            print(f"{collection}: faltan {info['missing']}, sin uso {info['unused']}, "
+                  f"no declarados {info['undeclared']}")
+    for row in explain_queries(db):
+        if row.get('error') or row['collscan'] or row['in_memory_sort']:
+            print(f"Consulta sin índice adecuado: {json.dumps(row, ensure_ascii=False)}")
+
+if __name__ == '__main__':
+    main()
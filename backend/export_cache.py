@@ -0,0 +1,332 @@
+"""
+Caché de exportaciones y exportación diferencial.
+
+Cada dataset tiene una versión de modificación ('version') que se incrementa
+con cualquier cambio en sus imágenes, anotaciones o categorías. Las
+exportaciones se guardan en disco con una clave derivada de esa versión, el
+formato y las opciones, de modo que repetir una exportación sin cambios no
+vuelve a consultar ni a generar nada.
+
+Cada exportación queda registrada en la colección 'exports' con un manifiesto
+(huella por imagen) que permite generar después un ZIP solo con las imágenes y
+etiquetas que cambiaron desde esa exportación. El manifiesto se guarda en disco
+(EXPORT_MANIFEST_DIR), no en el documento, para no acercarse al límite de 16MB
+de MongoDB con datasets grandes, y solo se conservan los EXPORT_RECORDS_KEEP
+registros más recientes de cada dataset, usuario y opciones.
+"""
+import os
+import io
+import json
+import time
+import zlib
+import zipfile
+import hashlib
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from export_engine import split_prefix
+
+# Directorio de la caché y límites de expulsión (tamaño total y antigüedad)
+EXPORT_CACHE_DIR = os.getenv('EXPORT_CACHE_DIR', os.path.join(os.getcwd(), 'export_cache'))
+EXPORT_CACHE_MAX_BYTES = int(os.getenv('EXPORT_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))  # 2GB
+EXPORT_CACHE_MAX_AGE = int(os.getenv('EXPORT_CACHE_MAX_AGE', 24 * 3600))  # segundos
+
+# Manifiestos de las exportaciones registradas y registros que se conservan
+# por dataset, usuario y opciones (las diferenciales solo parten de ellos)
+EXPORT_MANIFEST_DIR = os.getenv('EXPORT_MANIFEST_DIR', os.path.join(EXPORT_CACHE_DIR, 'manifests'))
+EXPORT_RECORDS_KEEP = max(1, int(os.getenv('EXPORT_RECORDS_KEEP', 5)))
+
+# Opciones que no cambian el contenido de la exportación y pueden diferir
+# entre una exportación diferencial y la exportación base
+DELTA_IGNORED_OPTIONS = {'pretty', 'since'}
+
+# ==================== VERSIÓN DEL DATASET ====================
+
+def touch_dataset(db, dataset_id):
+    """Incrementar la versión de modificación del dataset (invalida sus exportaciones en caché)"""
+    if not dataset_id or not ObjectId.is_valid(str(dataset_id)):
+        return
+    db.datasets.update_one(
+        {'_id': ObjectId(str(dataset_id))},
+        {'$inc': {'version': 1}, '$set': {'modified_date': datetime.utcnow()}}
+    )
+
+def dataset_version(dataset):
+    """Versión de modificación actual del dataset (0 si nunca se ha modificado)"""
+    return dataset.get('version', 0)
+
+# ==================== CACHÉ EN DISCO ====================
+
+def export_cache_key(dataset, options):
+    """Clave de caché a partir del dataset, su versión y las opciones de exportación"""
+    payload = json.dumps({
+        'dataset_id': str(dataset['_id']),
+        'version': dataset_version(dataset),
+        'options': options
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _cache_paths(key):
+    """Rutas del contenido y de los metadatos de una entrada de la caché"""
+    return (os.path.join(EXPORT_CACHE_DIR, f'{key}.bin'),
+            os.path.join(EXPORT_CACHE_DIR, f'{key}.json'))
+
+def _remove_cache_entry(key):
+    for path in _cache_paths(key):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def get_cached_export(key):
+    """
+    Buscar una exportación en la caché
+
+    Returns:
+        Tupla (ruta del archivo, metadatos) o None si no existe o ha caducado
+    """
+    data_path, meta_path = _cache_paths(key)
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if not os.path.exists(data_path):
+            return None
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - meta.get('created_at', 0) > EXPORT_CACHE_MAX_AGE:
+        _remove_cache_entry(key)
+        return None
+
+    # Actualizar la fecha de acceso para la expulsión por tamaño (LRU)
+    try:
+        os.utime(data_path)
+    except OSError:
+        pass
+    return data_path, meta
+
+def store_export(key, data, meta):
+    """Guardar una exportación en la caché y aplicar los límites de tamaño y antigüedad"""
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    data_path, meta_path = _cache_paths(key)
+    meta = dict(meta, created_at=time.time(), size=len(data))
+
+    # Escritura atómica: los metadatos se escriben al final y marcan la entrada como completa
+    tmp_suffix = f'.{os.getpid()}.tmp'
+    with open(data_path + tmp_suffix, 'wb') as f:
+        f.write(data)
+    os.replace(data_path + tmp_suffix, data_path)
+    with open(meta_path + tmp_suffix, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + tmp_suffix, meta_path)
+
+    evict_export_cache()
+
+def evict_export_cache(dataset_id=None):
+    """
+    Expulsar entradas caducadas y, si se supera el tamaño máximo, las menos
+    usadas recientemente. Con dataset_id se eliminan todas las de ese dataset.
+    """
+    if not os.path.isdir(EXPORT_CACHE_DIR):
+        return
+
+    now = time.time()
+    entries = []
+    for name in os.listdir(EXPORT_CACHE_DIR):
+        if not name.endswith('.json'):
+            continue
+        key = name[:-len('.json')]
+        data_path, meta_path = _cache_paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            last_access = os.path.getmtime(data_path)
+        except (OSError, ValueError):
+            _remove_cache_entry(key)
+            continue
+
+        if (dataset_id and meta.get('dataset_id') == str(dataset_id)) or \
+                now - meta.get('created_at', 0) > EXPORT_CACHE_MAX_AGE:
+            _remove_cache_entry(key)
+            continue
+        entries.append((last_access, meta.get('size', 0), key))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total_size <= EXPORT_CACHE_MAX_BYTES:
+            break
+        _remove_cache_entry(key)
+        total_size -= size
+
+# ==================== MANIFIESTOS Y EXPORTACIÓN DIFERENCIAL ====================
+
+def image_fingerprint(img, annotations, split_name):
+    """Huella de todo lo que una imagen aporta a la exportación (datos, anotaciones y conjunto)"""
+    payload = [
+        img.get('filename'), img.get('file_path'), img.get('width'), img.get('height'),
+        img.get('size'), split_name,
+        sorted(json.dumps([ann.get('category_id'), ann.get('bbox'), ann.get('points'),
+                           ann.get('segmentation')], default=str)
+               for ann in annotations)
+    ]
+    return hashlib.sha1(json.dumps(payload, default=str).encode('utf-8')).hexdigest()[:16]
+
+def build_export_manifest(plan, categories):
+    """
+    Manifiesto de una exportación: huella de las categorías y, por imagen,
+    su huella y su ruta dentro del ZIP
+    """
+    category_payload = [[str(cat['_id']), cat.get('name'), cat.get('color')] for cat in categories]
+    images = {}
+    for split_name, split_images in plan['splits']:
+        for img in split_images:
+            annotations = plan['annotations_by_image'].get(str(img['_id']), [])
+            images[str(img['_id'])] = [
+                image_fingerprint(img, annotations, split_name),
+                f"{split_prefix(split_name)}{img['filename']}"
+            ]
+    return {
+        'categories': hashlib.sha1(json.dumps(category_payload).encode('utf-8')).hexdigest()[:16],
+        'images': images
+    }
+
+def _manifest_path(export_id):
+    return os.path.join(EXPORT_MANIFEST_DIR, f'{export_id}.manifest')
+
+def _remove_export_records(db, records):
+    """Eliminar registros de exportación y sus manifiestos en disco"""
+    export_ids = [record['_id'] for record in records]
+    if not export_ids:
+        return
+    for export_id in export_ids:
+        try:
+            os.remove(_manifest_path(export_id))
+        except OSError:
+            pass
+    db.exports.delete_many({'_id': {'$in': export_ids}})
+
+def record_export(db, dataset, user_id, options, manifest, base_export_id=None):
+    """
+    Registrar una exportación (manifiesto comprimido en disco) y devolver su id.
+    Se eliminan los registros anteriores de las mismas opciones que exceden
+    EXPORT_RECORDS_KEEP.
+    """
+    export_id = ObjectId()
+    dataset_id = str(dataset['_id'])
+    try:
+        os.makedirs(EXPORT_MANIFEST_DIR, exist_ok=True)
+        tmp_path = _manifest_path(export_id) + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(json.dumps(manifest).encode('utf-8')))
+        os.replace(tmp_path, _manifest_path(export_id))
+    except OSError as e:
+        # Sin manifiesto la exportación funciona, pero no podrá ser base de una diferencial
+        print(f"AVISO: no se pudo guardar el manifiesto de la exportación: {e}")
+    db.exports.insert_one({
+        '_id': export_id,
+        'dataset_id': dataset_id,
+        'user_id': user_id,
+        'version': dataset_version(dataset),
+        'options': options,
+        'base_export_id': base_export_id,
+        'image_count': len(manifest['images']),
+        'created_at': datetime.utcnow()
+    })
+
+    # Registros de las mismas opciones, del más reciente al más antiguo
+    same_options = [record for record in db.exports.find({'dataset_id': dataset_id, 'user_id': user_id},
+                                                         {'options': 1}).sort('created_at', -1)
+                    if record.get('options') == options]
+    _remove_export_records(db, same_options[EXPORT_RECORDS_KEEP:])
+    return str(export_id)
+
+def delete_export_records(db, dataset_id):
+    """Eliminar todos los registros de exportación de un dataset y sus manifiestos"""
+    _remove_export_records(db, list(db.exports.find({'dataset_id': str(dataset_id)}, {'_id': 1})))
+
+def load_export_record(db, export_id, dataset_id, user_id):
+    """
+    Obtener una exportación previa del mismo dataset y usuario
+
+    Returns:
+        Tupla (registro, manifiesto) o None si no existe
+    """
+    if not ObjectId.is_valid(export_id):
+        return None
+    record = db.exports.find_one({
+        '_id': ObjectId(export_id),
+        'dataset_id': str(dataset_id),
+        'user_id': user_id
+    })
+    if not record:
+        return None
+    try:
+        if 'manifest' in record:
+            # Registros anteriores con el manifiesto dentro del documento
+            compressed = record['manifest']
+        else:
+            with open(_manifest_path(record['_id']), 'rb') as f:
+                compressed = f.read()
+    except OSError:
+        return None
+    manifest = json.loads(zlib.decompress(compressed).decode('utf-8'))
+    return record, manifest
+
+def delta_options_match(base_options, options):
+    """Comprobar que una exportación diferencial usa las mismas opciones que su base"""
+    def relevant(opts):
+        return {k: v for k, v in opts.items() if k not in DELTA_IGNORED_OPTIONS}
+    return relevant(base_options) == relevant(options)
+
+def diff_manifests(base_manifest, manifest):
+    """
+    Comparar dos manifiestos
+
+    Returns:
+        Dict con 'changed_ids' (imágenes nuevas o modificadas), 'changed'
+        y 'deleted' (rutas dentro del ZIP) y 'full_resync' (las categorías
+        cambiaron y todas las etiquetas deben regenerarse)
+    """
+    base_images = base_manifest['images']
+    images = manifest['images']
+    full_resync = base_manifest['categories'] != manifest['categories']
+
+    changed_ids = [image_id for image_id, entry in images.items()
+                   if full_resync or base_images.get(image_id) != entry]
+    # Una imagen que cambia de conjunto se elimina de su ruta anterior
+    deleted = [entry[1] for image_id, entry in base_images.items()
+               if image_id not in images or images[image_id][1] != entry[1]]
+
+    return {
+        'changed_ids': changed_ids,
+        'changed': [images[image_id][1] for image_id in changed_ids],
+        'deleted': deleted,
+        'full_resync': full_resync
+    }
+
+def add_delta_manifest(response, delta_info):
+    """
+    Añadir 'delta.json' a la respuesta de una exportación diferencial.
+    Si la exportación no es un ZIP (COCO sin imágenes) se empaqueta en uno.
+    """
+    manifest_json = json.dumps(delta_info, indent=2)
+    content = response.get_data()
+
+    buffer = io.BytesIO()
+    if response.mimetype == 'application/zip':
+        buffer.write(content)
+        with zipfile.ZipFile(buffer, 'a', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('delta.json', manifest_json)
+    else:
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('annotations.json', content)
+            zf.writestr('delta.json', manifest_json)
+        response.mimetype = 'application/zip'
+        disposition = response.headers.get('Content-Disposition', 'attachment; filename=export.json')
+        if disposition.endswith('.json'):
+            disposition = disposition[:-len('.json')] + '.zip'
+        response.headers['Content-Disposition'] = disposition
+
+    response.set_data(buffer.getvalue())
+    return response
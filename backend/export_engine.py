@@ -0,0 +1,366 @@
+"""
+Motor de exportación de datasets.
+
+Contiene las etapas compartidas por los exportadores COCO, YOLO y Pascal VOC
+definidos en app.py, para que cada formato solo se ocupe de renderizar sus
+propios archivos de anotaciones.
+"""
+import os
+import json
+import base64
+import zipfile
+import threading
+import multiprocessing
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from bson.objectid import ObjectId
+
+# Extensiones cuyo contenido ya está comprimido: deflate no reduce su tamaño
+# y solo consume CPU, así que se guardan tal cual (ZIP_STORED)
+COMPRESSED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+
+# Número de imágenes cuyo contenido se pide a MongoDB en cada consulta
+EXPORT_IMAGE_BATCH_SIZE = 200
+
+# Procesos para renderizar archivos de anotaciones (0 o 1 = sin paralelismo)
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', os.cpu_count() or 1))
+
+# Por debajo de este número de archivos no compensa repartir el trabajo
+PARALLEL_RENDER_MIN_TASKS = 500
+
+# ==================== PLANIFICADOR DE EXPORTACIÓN ====================
+
+def group_annotations_by_image(annotations):
+    """
+    Agrupar anotaciones por image_id en una sola pasada
+
+    Returns:
+        Dict {image_id (str): [anotaciones]} conservando el orden original
+    """
+    annotations_by_image = {}
+    for ann in annotations:
+        annotations_by_image.setdefault(str(ann.get('image_id')), []).append(ann)
+    return annotations_by_image
+
+def build_export_plan(images, annotations, only_annotated=False):
+    """
+    Preparar los datos de una exportación una sola vez para todos los formatos.
+
+    Las anotaciones se agrupan por imagen para que los exportadores hagan
+    búsquedas en diccionario en lugar de recorrer la lista completa de
+    anotaciones por cada imagen.
+
+    Args:
+        images: Lista de documentos de imagen
+        annotations: Lista de anotaciones de esas imágenes
+        only_annotated: Si es True, descarta las imágenes sin anotaciones
+
+    Returns:
+        Dict con 'images', 'annotations_by_image' y 'splits'. Sin división,
+        'splits' contiene un único conjunto con nombre None.
+    """
+    annotations_by_image = group_annotations_by_image(annotations)
+
+    if only_annotated:
+        images = [img for img in images if str(img['_id']) in annotations_by_image]
+
+    return {
+        'images': images,
+        'annotations_by_image': annotations_by_image,
+        'splits': [(None, images)]
+    }
+
+def set_plan_splits(plan, train_images, val_images, test_images):
+    """Asignar al plan la división train/val/test (se omiten conjuntos vacíos)"""
+    plan['splits'] = [
+        (split_name, split_images)
+        for split_name, split_images in [('train', train_images),
+                                         ('val', val_images),
+                                         ('test', test_images)]
+        if split_images
+    ]
+    return plan
+
+def filter_plan_images(plan, image_ids):
+    """Restringir el plan (y sus conjuntos) a las imágenes indicadas, conservando la división"""
+    image_ids = set(image_ids)
+    plan['images'] = [img for img in plan['images'] if str(img['_id']) in image_ids]
+    plan['splits'] = [
+        (split_name, [img for img in split_images if str(img['_id']) in image_ids])
+        for split_name, split_images in plan['splits']
+    ]
+    return plan
+
+def image_annotations(plan, img):
+    """Anotaciones de una imagen según el plan (lista vacía si no tiene)"""
+    return plan['annotations_by_image'].get(str(img['_id']), [])
+
+def plan_annotations(plan, images):
+    """Anotaciones de un conjunto de imágenes, agrupadas en el orden de las imágenes"""
+    annotations = []
+    for img in images:
+        annotations.extend(image_annotations(plan, img))
+    return annotations
+
+def split_prefix(split_name):
+    """Prefijo de ruta dentro del ZIP para un conjunto ('' si no hay división)"""
+    return f'{split_name}/' if split_name else ''
+
+# ==================== RENDERIZADO DE ARCHIVOS ====================
+# Las funciones de renderizado son puras y reciben solo tipos básicos para
+# poder ejecutarse en procesos separados
+
+XML_DECLARATION = '<?xml version="1.0" ?>\n'
+
+def yolo_label_task(img, annotations, category_map):
+    """Datos mínimos para renderizar el .txt YOLO de una imagen"""
+    boxes = []
+    for ann in annotations:
+        cat_idx = category_map.get(ann.get('category_id'))
+        bbox = ann.get('bbox') or []
+        if cat_idx is None or len(bbox) < 4:
+            continue
+        boxes.append((cat_idx, bbox[:4]))
+    return (img.get('width') or 1, img.get('height') or 1, boxes)
+
+def render_yolo_label(task):
+    """Renderizar las líneas YOLO normalizadas de una imagen"""
+    img_width, img_height, boxes = task
+    yolo_lines = []
+    for cat_idx, (x, y, w, h) in boxes:
+        # Convertir bbox COCO [x, y, width, height] a YOLO [center_x, center_y, width, height] normalizado
+        center_x = (x + w / 2) / img_width
+        center_y = (y + h / 2) / img_height
+        width = w / img_width
+        height = h / img_height
+        yolo_lines.append(f"{cat_idx} {center_x:.6f} {center_y:.6f} {width:.6f} {height:.6f}")
+    return '\n'.join(yolo_lines)
+
+def pascal_xml_task(img, annotations, category_names, folder, extended=False, pretty=True):
+    """
+    Datos mínimos para renderizar el XML Pascal VOC de una imagen
+
+    Args:
+        extended: Añadir pose/truncated/difficult a cada objeto
+        pretty: Indentar el XML (con declaración) o generarlo compacto
+    """
+    objects = []
+    for ann in annotations:
+        bbox = ann.get('bbox') or [0, 0, 0, 0]
+        if len(bbox) < 4:
+            continue
+        objects.append((category_names.get(ann.get('category_id'), 'unknown'), bbox[:4]))
+    return {
+        'folder': folder,
+        'filename': img['filename'],
+        'width': img.get('width', 0),
+        'height': img.get('height', 0),
+        'objects': objects,
+        'extended': extended,
+        'pretty': pretty
+    }
+
+def render_pascal_xml(task):
+    """Renderizar el XML Pascal VOC de una imagen"""
+    annotation = ET.Element('annotation')
+    ET.SubElement(annotation, 'folder').text = task['folder']
+    ET.SubElement(annotation, 'filename').text = task['filename']
+
+    size = ET.SubElement(annotation, 'size')
+    ET.SubElement(size, 'width').text = str(task['width'])
+    ET.SubElement(size, 'height').text = str(task['height'])
+    ET.SubElement(size, 'depth').text = '3'
+
+    for name, (x, y, w, h) in task['objects']:
+        obj = ET.SubElement(annotation, 'object')
+        ET.SubElement(obj, 'name').text = name
+        if task['extended']:
+            ET.SubElement(obj, 'pose').text = 'Unspecified'
+            ET.SubElement(obj, 'truncated').text = '0'
+            ET.SubElement(obj, 'difficult').text = '0'
+
+        bndbox = ET.SubElement(obj, 'bndbox')
+        ET.SubElement(bndbox, 'xmin').text = str(int(x))
+        ET.SubElement(bndbox, 'ymin').text = str(int(y))
+        ET.SubElement(bndbox, 'xmax').text = str(int(x + w))
+        ET.SubElement(bndbox, 'ymax').text = str(int(y + h))
+
+    if not task['pretty']:
+        return ET.tostring(annotation, encoding='unicode')
+
+    # Mismo resultado que minidom.toprettyxml pero sin volver a parsear el documento
+    ET.indent(annotation, space='  ')
+    return XML_DECLARATION + ET.tostring(annotation, encoding='unicode') + '\n'
+
+def serialize_json(task):
+    """Serializar un documento JSON (task = (documento, pretty))"""
+    document, pretty = task
+    if pretty:
+        return json.dumps(document, indent=2)
+    # Sin indentación json usa el codificador en C, mucho más rápido
+    return json.dumps(document, separators=(',', ':'))
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def _get_render_pool():
+    """Pool de procesos compartido entre exportaciones (se crea bajo demanda)"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn evita heredar hilos y sockets de MongoDB del proceso web
+            _render_pool = ProcessPoolExecutor(
+                max_workers=EXPORT_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _render_pool
+
+def render_files(render_fn, tasks, min_tasks=PARALLEL_RENDER_MIN_TASKS):
+    """
+    Renderizar archivos en paralelo conservando el orden de las tareas.
+
+    Los resultados se devuelven en el mismo orden que las tareas para que un
+    único escritor los vaya añadiendo al ZIP de forma determinista.
+
+    Args:
+        render_fn: Función de renderizado a nivel de módulo (serializable)
+        tasks: Lista de tareas para render_fn
+        min_tasks: Mínimo de tareas para usar el pool de procesos
+
+    Returns:
+        Iterable con el resultado de cada tarea, en orden
+    """
+    global _render_pool
+    if EXPORT_WORKERS <= 1 or len(tasks) < min_tasks:
+        return map(render_fn, tasks)
+
+    pool = None
+    try:
+        pool = _get_render_pool()
+        chunksize = max(1, len(tasks) // (EXPORT_WORKERS * 4))
+        # Recoger aquí los resultados: los errores de los workers (y BrokenProcessPool)
+        # aparecen al iterar, no al crear el iterador
+        return list(pool.map(render_fn, tasks, chunksize=chunksize))
+    except Exception as e:
+        print(f"AVISO: No se pudo usar el pool de exportación ({e}), renderizando en serie")
+        # Descartar el pool: uno roto haría fallar todas las exportaciones siguientes
+        with _render_pool_lock:
+            if pool is not None and _render_pool is pool:
+                _render_pool = None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        return map(render_fn, tasks)
+
+# ==================== ETAPA DE IMÁGENES ====================
+
+def image_compress_type(filename):
+    """Tipo de compresión ZIP adecuado para una imagen según su extensión"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in COMPRESSED_IMAGE_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def _resolve_image_path(img, image_folder):
+    """Ruta en disco de la copia física de una imagen, o None si no existe"""
+    relative_path = img.get('file_path')
+    if not relative_path or not image_folder:
+        return None
+    file_path = os.path.join(image_folder, relative_path)
+    if os.path.isfile(file_path):
+        return file_path
+    return None
+
+def _decode_image_data(data):
+    """Convertir el campo 'data' de MongoDB (base64 o binario) a bytes"""
+    if isinstance(data, str):
+        return base64.b64decode(data)
+    return bytes(data)
+
+def iter_image_payloads(db, images, image_folder, batch_size=EXPORT_IMAGE_BATCH_SIZE):
+    """
+    Recorrer las imágenes de una exportación obteniendo su contenido real.
+
+    Las imágenes con copia física se leen directamente del disco; el resto
+    se piden a MongoDB por lotes con una sola consulta $in por lote, en lugar
+    de un find_one por imagen.
+
+    Args:
+        db: Conexión a la base de datos
+        images: Lista de documentos de imagen (sin el campo 'data')
+        image_folder: Carpeta base de las copias físicas (IMAGE_FOLDER)
+        batch_size: Número de imágenes por consulta a MongoDB
+
+    Yields:
+        Tuplas (img, file_path, data): file_path es la ruta en disco si existe
+        y data son los bytes decodificados cuando se leyeron de MongoDB
+    """
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+
+        # Resolver primero qué imágenes están en disco
+        paths = [_resolve_image_path(img, image_folder) for img in batch]
+        missing_ids = []
+        for img, file_path in zip(batch, paths):
+            if file_path is None and ObjectId.is_valid(str(img['_id'])):
+                missing_ids.append(ObjectId(str(img['_id'])))
+
+        # Una sola consulta para todas las imágenes del lote sin copia física
+        data_map = {}
+        if missing_ids:
+            cursor = db.images.find({'_id': {'$in': missing_ids}}, {'data': 1, 'blob_id': 1})
+            blob_images = {}
+            for doc in cursor:
+                if doc.get('data'):
+                    data_map[str(doc['_id'])] = doc['data']
+                elif doc.get('blob_id'):
+                    blob_images.setdefault(doc['blob_id'], []).append(str(doc['_id']))
+            # Contenido compartido entre datasets (IMAGE_BLOB_SHARING)
+            if blob_images:
+                for blob in db.image_blobs.find({'_id': {'$in': list(blob_images)}}, {'data': 1}):
+                    for image_id in blob_images[blob['_id']]:
+                        data_map[image_id] = blob['data']
+
+        for img, file_path in zip(batch, paths):
+            if file_path:
+                yield img, file_path, None
+                continue
+
+            raw_data = data_map.get(str(img['_id']))
+            if raw_data is None:
+                print(f"AVISO: Imagen sin contenido disponible para exportar: {img.get('filename')}")
+                continue
+
+            try:
+                yield img, None, _decode_image_data(raw_data)
+            except Exception as e:
+                print(f"Error decodificando imagen {img.get('filename')}: {e}")
+                continue
+
+def write_images_to_zip(zf, db, images, image_folder, prefix=''):
+    """
+    Escribir en el ZIP los bytes reales de las imágenes de una exportación.
+
+    Args:
+        zf: ZipFile abierto en modo escritura
+        db: Conexión a la base de datos
+        images: Lista de documentos de imagen
+        image_folder: Carpeta base de las copias físicas (IMAGE_FOLDER)
+        prefix: Prefijo de ruta dentro del ZIP (ej: 'train/')
+
+    Returns:
+        Número de imágenes escritas
+    """
+    written = 0
+    for img, file_path, data in iter_image_payloads(db, images, image_folder):
+        arcname = f"{prefix}images/{img['filename']}"
+        compress_type = image_compress_type(img['filename'])
+
+        if file_path:
+            # Copiar desde disco en bloques sin cargar el archivo completo
+            zf.write(file_path, arcname, compress_type=compress_type)
+        else:
+            zf.writestr(arcname, data, compress_type=compress_type)
+        written += 1
+
+    return written
@@ -0,0 +1,251 @@
+"""
+Índice persistente de los archivos de la carpeta de cada dataset.
+
+La colección 'dataset_files' guarda un documento por archivo con su ruta
+relativa a la carpeta del dataset, su tamaño, su fecha de modificación y la
+imagen que le corresponde. Reescanear una carpeta es un recorrido de stat():
+solo los archivos nuevos o modificados se vuelven a leer.
+
+Opcionalmente (DATASET_WATCH=1) un observador de watchdog vigila la carpeta de
+datasets y sincroniza el dataset afectado unos segundos después del último
+cambio.
+"""
+import os
+import time
+import threading
+from datetime import datetime
+
+from pymongo import UpdateOne, DeleteOne
+
+# Extensiones que se consideran imágenes al recorrer la carpeta
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp', '.gif'}
+
+# Profundidad máxima de subcarpetas (como find_images_in_directory)
+SCAN_MAX_DEPTH = 5
+
+# Número de rutas por consulta $in
+LOOKUP_CHUNK_SIZE = 5000
+
+# Vigilancia continua de la carpeta de datasets y espera tras el último cambio
+DATASET_WATCH = os.getenv('DATASET_WATCH', 'false').lower() in ('1', 'true', 'yes')
+DATASET_WATCH_DELAY = float(os.getenv('DATASET_WATCH_DELAY', 5))  # segundos
+
+# ==================== RECORRIDO E ÍNDICE ====================
+
+def scan_dataset_folder(dataset_folder, max_depth=SCAN_MAX_DEPTH):
+    """
+    Recorrer la carpeta de un dataset sin abrir ningún archivo
+
+    Returns:
+        Dict {ruta relativa con '/': (tamaño, mtime en ns)}
+    """
+    found = {}
+    pending = [(dataset_folder, '', 0)]
+    while pending:
+        folder, prefix, depth = pending.pop()
+        try:
+            entries = os.scandir(folder)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if depth + 1 < max_depth:
+                            pending.append((entry.path, f'{prefix}{entry.name}/', depth + 1))
+                        continue
+                    if os.path.splitext(entry.name)[1].lower() not in IMAGE_EXTENSIONS:
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                found[prefix + entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return found
+
+def load_file_index(db, dataset_id):
+    """Entradas del índice de un dataset: {ruta: documento}"""
+    return {doc['path']: doc for doc in db.dataset_files.find(
+        {'dataset_id': dataset_id}, {'path': 1, 'size': 1, 'mtime': 1, 'image_id': 1}
+    )}
+
+def diff_file_index(index, scanned):
+    """
+    Comparar el índice guardado con el recorrido actual
+
+    Returns:
+        Dict con listas de rutas 'new', 'changed' y 'removed' y el número
+        de archivos sin cambios en 'unchanged'
+    """
+    new, changed = [], []
+    for path, (size, mtime) in scanned.items():
+        entry = index.get(path)
+        if entry is None:
+            new.append(path)
+        elif entry.get('size') != size or entry.get('mtime') != mtime:
+            # Los archivos que fallaron (sin imagen) también se reintentan solo si cambian
+            changed.append(path)
+    removed = [path for path in index if path not in scanned]
+    return {
+        'new': sorted(new),
+        'changed': sorted(changed),
+        'removed': removed,
+        'unchanged': len(scanned) - len(new) - len(changed)
+    }
+
+def find_registered_images(db, dataset_id, paths):
+    """
+    Imágenes ya registradas (subidas o importadas por otras rutas) para
+    archivos que todavía no están en el índice
+
+    Returns:
+        Dict {ruta: image_id}
+    """
+    registered = {}
+    for start in range(0, len(paths), LOOKUP_CHUNK_SIZE):
+        chunk = paths[start:start + LOOKUP_CHUNK_SIZE]
+        by_file_path = {os.path.join(dataset_id, *path.split('/')): path for path in chunk}
+        for img in db.images.find({'dataset_id': dataset_id, 'file_path': {'$in': list(by_file_path)}},
+                                  {'file_path': 1}):
+            registered[by_file_path[img['file_path']]] = str(img['_id'])
+
+        # Imágenes antiguas sin file_path: se identifican por nombre de archivo
+        by_name = {}
+        for path in chunk:
+            if path not in registered:
+                by_name.setdefault(path.rsplit('/', 1)[-1], []).append(path)
+        if by_name:
+            for img in db.images.find({'dataset_id': dataset_id, 'file_path': {'$exists': False},
+                                       'filename': {'$in': list(by_name)}}, {'filename': 1}):
+                for path in by_name.pop(img['filename'], []):
+                    registered[path] = str(img['_id'])
+    return registered
+
+def update_file_index(db, dataset_id, entries, removed=()):
+    """
+    Guardar entradas del índice y eliminar las de archivos que ya no existen
+
+    Args:
+        entries: Lista de tuplas (ruta, tamaño, mtime, image_id o None, error o None)
+        removed: Rutas a eliminar del índice
+    """
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {'dataset_id': dataset_id, 'path': path},
+            {'$set': {'size': size, 'mtime': mtime, 'image_id': image_id,
+                      'error': error, 'indexed_at': now}},
+            upsert=True
+        )
+        for path, size, mtime, image_id, error in entries
+    ]
+    operations.extend(DeleteOne({'dataset_id': dataset_id, 'path': path}) for path in removed)
+    if operations:
+        db.dataset_files.bulk_write(operations, ordered=False)
+
+# ==================== SINCRONIZACIÓN CONCURRENTE ====================
+
+_sync_locks = {}
+_sync_locks_guard = threading.Lock()
+
+def dataset_sync_lock(dataset_id):
+    """Lock por dataset para que el reprocesado y el observador no se solapen"""
+    with _sync_locks_guard:
+        return _sync_locks.setdefault(str(dataset_id), threading.Lock())
+
+# ==================== VIGILANCIA CON WATCHDOG ====================
+
+_watch_state = {
+    'observer': None,
+    'pending': {},  # dataset_id -> momento del último cambio
+    'paused': {}  # dataset_id -> número de operaciones en curso
+}
+_watch_guard = threading.Lock()
+
+def pause_dataset_watch(dataset_id):
+    """
+    Ignorar los cambios de un dataset mientras otra ruta escribe en su carpeta
+    (importaciones de ZIP, extracción de frames), que registra sus propias imágenes
+    """
+    if not dataset_id:
+        return
+    with _watch_guard:
+        paused = _watch_state['paused']
+        paused[str(dataset_id)] = paused.get(str(dataset_id), 0) + 1
+
+def resume_dataset_watch(dataset_id):
+    """Volver a vigilar el dataset; la siguiente sincronización indexa lo escrito mientras tanto"""
+    if not dataset_id:
+        return
+    with _watch_guard:
+        paused = _watch_state['paused']
+        remaining = paused.get(str(dataset_id), 0) - 1
+        if remaining > 0:
+            paused[str(dataset_id)] = remaining
+        else:
+            paused.pop(str(dataset_id), None)
+        if _watch_state['observer'] is not None:
+            _watch_state['pending'][str(dataset_id)] = time.monotonic()
+
+# Eventos que indican escritura (se ignoran las aperturas, incluidas las de la propia sincronización)
+WATCH_EVENT_TYPES = {'created', 'modified', 'moved', 'deleted', 'closed'}
+
+def _on_filesystem_event(root, event):
+    if event.event_type not in WATCH_EVENT_TYPES:
+        return
+    paths = [event.src_path, getattr(event, 'dest_path', '') or '']
+    with _watch_guard:
+        for path in paths:
+            if not path:
+                continue
+            relative = os.path.relpath(path, root)
+            if relative.startswith('..'):
+                continue
+            dataset_id = relative.split(os.sep, 1)[0]
+            if event.is_directory or os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS:
+                _watch_state['pending'][dataset_id] = time.monotonic()
+
+def _watch_loop(on_change, delay):
+    while True:
+        time.sleep(1)
+        now = time.monotonic()
+        with _watch_guard:
+            ready = [dataset_id for dataset_id, changed_at in _watch_state['pending'].items()
+                     if now - changed_at >= delay and dataset_id not in _watch_state['paused']]
+            for dataset_id in ready:
+                del _watch_state['pending'][dataset_id]
+        for dataset_id in ready:
+            try:
+                on_change(dataset_id)
+            except Exception as e:
+                print(f"Error sincronizando dataset {dataset_id}: {e}")
+
+def start_dataset_watcher(root, on_change, delay=DATASET_WATCH_DELAY):
+    """
+    Vigilar la carpeta de datasets y llamar a on_change(dataset_id) cuando la
+    carpeta de un dataset lleva delay segundos sin cambios
+
+    Returns:
+        True si el observador se ha iniciado
+    """
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        print("AVISO: watchdog no está instalado, vigilancia de datasets desactivada")
+        return False
+
+    with _watch_guard:
+        if _watch_state['observer'] is not None:
+            return True
+        os.makedirs(root, exist_ok=True)
+        handler = FileSystemEventHandler()
+        handler.on_any_event = lambda event: _on_filesystem_event(root, event)
+        observer = Observer()
+        observer.daemon = True
+        observer.schedule(handler, root, recursive=True)
+        observer.start()
+        _watch_state['observer'] = observer
+
+    threading.Thread(target=_watch_loop, args=(on_change, delay), daemon=True).start()
+    print(f"Vigilancia de datasets activa en {root} (espera {delay}s)")
+    return True
@@ -0,0 +1,292 @@
+"""
+Deduplicación de imágenes por contenido.
+
+Cada imagen ingerida guarda el SHA-256 de su contenido (ver image_probe) y un
+índice único parcial sobre (dataset_id, sha256) impide que la misma imagen se
+guarde dos veces en un dataset: las rutas de ingesta consultan los hashes de
+cada lote antes de insertar y las duplicadas se notifican o se enlazan a la
+imagen existente.
+
+Opcionalmente (IMAGE_BLOB_SHARING=1) el contenido se comparte entre datasets:
+el base64 se guarda una sola vez en la colección 'image_blobs' con un contador
+de referencias, las imágenes solo guardan 'blob_id', y los archivos en disco
+se crean como clones (reflink) del archivo existente cuando el sistema de
+archivos lo permite: comparten bloques pero cada dataset tiene su propio
+archivo, así que modificar uno no cambia el otro. Las versiones anteriores
+usaban enlaces duros; la sincronización de la carpeta los separa al detectar
+que uno ha cambiado (ver unshare_changed_file).
+"""
+import os
+import base64
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+from db_indexes import ensure_indexes
+
+# Compartir el contenido de imágenes idénticas entre datasets
+IMAGE_BLOB_SHARING = os.getenv('IMAGE_BLOB_SHARING', 'false').lower() in ('1', 'true', 'yes')
+
+# Código de error de MongoDB para claves duplicadas
+DUPLICATE_KEY_ERROR = 11000
+
+# ioctl de Linux que clona un archivo compartiendo sus bloques (btrfs, XFS con reflink)
+FICLONE = 0x40049409
+
+def find_images_by_hash(db, dataset_id, hashes):
+    """Imágenes del dataset con alguno de esos hashes: {sha256: documento (sin datos)}"""
+    hashes = [h for h in set(hashes) if h]
+    if not hashes:
+        return {}
+    return {img['sha256']: img for img in db.images.find(
+        {'dataset_id': dataset_id, 'sha256': {'$in': hashes}},
+        {'sha256': 1, 'filename': 1, 'file_path': 1}
+    )}
+
+def split_duplicates(db, dataset_id, docs):
+    """
+    Separar los documentos de un lote cuya imagen ya existe en el dataset
+    (o aparece antes en el mismo lote)
+
+    Returns:
+        Tupla (documentos nuevos, lista de (documento duplicado, imagen existente))
+    """
+    existing = find_images_by_hash(db, dataset_id, [doc.get('sha256') for doc in docs])
+    unique_docs = []
+    duplicates = []
+    seen = {}
+    for doc in docs:
+        sha256 = doc.get('sha256')
+        original = existing.get(sha256) or seen.get(sha256)
+        if sha256 and original is not None:
+            duplicates.append((doc, original))
+            continue
+        if sha256:
+            seen[sha256] = doc
+        unique_docs.append(doc)
+    return unique_docs, duplicates
+
+def duplicate_info(doc, original):
+    """Entrada de la respuesta para una imagen omitida por duplicada"""
+    return {
+        'filename': doc.get('filename'),
+        'duplicate_of': original.get('filename'),
+        'duplicate_of_id': str(original['_id']) if original.get('_id') else None
+    }
+
+def remove_duplicate_file(doc, original, image_folder):
+    """Eliminar del disco la copia extraída de una imagen duplicada"""
+    if not doc.get('file_path') or doc.get('file_path') == original.get('file_path'):
+        return
+    try:
+        os.remove(os.path.join(image_folder, doc['file_path']))
+    except OSError:
+        pass
+
+def insert_image_docs(db, docs):
+    """
+    Insertar documentos de imagen sin detener el lote por un error individual.
+    Con IMAGE_BLOB_SHARING el contenido se guarda en 'image_blobs'.
+
+    Returns:
+        Tupla (lista de (documento, id insertado), lista de documentos
+        duplicados, lista de (documento, motivo) fallidos)
+    """
+    if not docs:
+        return [], [], []
+
+    # El índice único sobre (dataset_id, sha256) está declarado en db_indexes
+    ensure_indexes(db, ['images'])
+    if IMAGE_BLOB_SHARING:
+        for doc in docs:
+            if doc.get('sha256') and doc.get('data'):
+                put_blob(db, doc['sha256'], doc.pop('data'))
+                doc['blob_id'] = doc['sha256']
+
+    failed_indexes = {}
+    try:
+        db.images.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            failed_indexes[error['index']] = error
+
+    inserted, duplicates, failed = [], [], []
+    for index, doc in enumerate(docs):
+        error = failed_indexes.get(index)
+        if error is None:
+            inserted.append((doc, doc['_id']))
+        elif error.get('code') == DUPLICATE_KEY_ERROR:
+            duplicates.append(doc)
+        else:
+            failed.append((doc, error.get('errmsg', 'Error de inserción')))
+
+    retain_blobs(db, [doc.get('blob_id') for doc, _ in inserted])
+    return inserted, duplicates, failed
+
+def insert_image_doc(db, doc):
+    """
+    Insertar un único documento de imagen
+
+    Returns:
+        Id insertado o None si ya existe una imagen con el mismo hash en el dataset
+    """
+    inserted, duplicates, failed = insert_image_docs(db, [doc])
+    if failed:
+        raise ValueError(failed[0][1])
+    return inserted[0][1] if inserted else None
+
+# ==================== CONTENIDO COMPARTIDO ENTRE DATASETS ====================
+
+def put_blob(db, sha256, data_base64):
+    """Guardar el contenido de una imagen si no existe todavía (sin referencias)"""
+    db.image_blobs.update_one(
+        {'_id': sha256},
+        {'$setOnInsert': {'data': data_base64, 'refcount': 0, 'created_date': datetime.utcnow()}},
+        upsert=True
+    )
+
+def retain_blobs(db, blob_ids):
+    """Sumar una referencia por cada aparición de blob_id"""
+    counts = {}
+    for blob_id in blob_ids:
+        if blob_id:
+            counts[blob_id] = counts.get(blob_id, 0) + 1
+    for blob_id, count in counts.items():
+        db.image_blobs.update_one({'_id': blob_id}, {'$inc': {'refcount': count}})
+
+def release_image_blobs(db, query):
+    """Restar las referencias de las imágenes que se van a eliminar y borrar los blobs sin uso"""
+    counts = list(db.images.aggregate([
+        {'$match': dict(query, blob_id={'$exists': True})},
+        {'$group': {'_id': '$blob_id', 'count': {'$sum': 1}}}
+    ]))
+    for row in counts:
+        db.image_blobs.update_one({'_id': row['_id']}, {'$inc': {'refcount': -row['count']}})
+    if counts:
+        db.image_blobs.delete_many({'_id': {'$in': [row['_id'] for row in counts]},
+                                    'refcount': {'$lte': 0}})
+
+def update_image_content(db, image_id, sha256, data_base64, fields):
+    """
+    Actualizar el contenido y los metadatos de una imagen existente cuyo
+    archivo cambió (libera el blob anterior si se comparte contenido)
+    """
+    if IMAGE_BLOB_SHARING and sha256:
+        put_blob(db, sha256, data_base64)
+        retain_blobs(db, [sha256])
+        release_image_blobs(db, {'_id': image_id})
+        update = {'$set': dict(fields, blob_id=sha256), '$unset': {'data': ''}}
+    else:
+        release_image_blobs(db, {'_id': image_id})
+        update = {'$set': dict(fields, data=data_base64), '$unset': {'blob_id': ''}}
+    # Los hashes perceptuales del contenido anterior ya no son válidos
+    update['$unset'].update({'phash': '', 'dhash': ''})
+    db.images.update_one({'_id': image_id}, update)
+
+def image_data_base64(db, image_doc):
+    """Contenido en base64 de una imagen, esté en el documento o en un blob compartido"""
+    if image_doc.get('data'):
+        return image_doc['data']
+    if image_doc.get('blob_id'):
+        blob = db.image_blobs.find_one({'_id': image_doc['blob_id']}, {'data': 1})
+        if blob:
+            return blob['data']
+    return None
+
+def clone_file(source, target):
+    """Copiar source en target por reflink (OSError o ImportError si no es posible)"""
+    import fcntl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def link_shared_file(db, sha256, dataset_id, target_path, image_folder):
+    """
+    Crear target_path como clon del archivo de otra imagen con el mismo
+    contenido (solo con IMAGE_BLOB_SHARING). No se usan enlaces duros: una
+    modificación en un dataset cambiaría también el archivo del otro.
+
+    Returns:
+        True si se ha clonado; False si hay que escribir (o conservar) el archivo propio
+    """
+    if not IMAGE_BLOB_SHARING or not sha256:
+        return False
+    for img in db.images.find({'sha256': sha256, 'dataset_id': {'$ne': dataset_id},
+                               'file_path': {'$exists': True}}, {'file_path': 1}).limit(5):
+        source = os.path.join(image_folder, img['file_path'])
+        if not os.path.isfile(source) or os.path.abspath(source) == os.path.abspath(target_path):
+            continue
+        temp_path = f'{target_path}.{os.getpid()}.clone'
+        try:
+            clone_file(source, temp_path)
+            os.replace(temp_path, target_path)
+            return True
+        except (OSError, ImportError):
+            # Sin reflink en este sistema de archivos: una copia normal no ahorra nada
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+    return False
+
+def unshare_changed_file(db, image_id, file_path, image_folder):
+    """
+    Separar un archivo modificado de los enlaces duros creados por versiones
+    anteriores de link_shared_file (copia al escribir)
+
+    El archivo modificado conserva el contenido nuevo; las imágenes de otros
+    datasets enlazadas al mismo archivo recuperan el suyo desde la base de
+    datos en un archivo propio.
+
+    Returns:
+        Número de archivos de otros datasets restaurados
+    """
+    try:
+        if os.stat(file_path).st_nlink < 2:
+            return 0
+        image = db.images.find_one({'_id': ObjectId(image_id)}, {'sha256': 1, 'dataset_id': 1})
+    except Exception:
+        return 0
+    if not image or not image.get('sha256'):
+        return 0
+
+    restored = 0
+    for other in db.images.find({'sha256': image['sha256'], 'dataset_id': {'$ne': image.get('dataset_id')},
+                                 'file_path': {'$exists': True}}, {'file_path': 1, 'data': 1, 'blob_id': 1}):
+        other_path = os.path.join(image_folder, other['file_path'])
+        temp_path = f'{other_path}.{os.getpid()}.unshare'
+        try:
+            if not os.path.samefile(other_path, file_path):
+                continue
+            data = image_data_base64(db, other)
+            if not data:
+                continue
+            with open(temp_path, 'wb') as f:
+                f.write(base64.b64decode(data))
+            os.replace(temp_path, other_path)
+            restored += 1
+        except OSError as e:
+            print(f"AVISO: no se pudo separar {other_path} de {file_path}: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+    if restored:
+        print(f"Archivo {file_path} separado de {restored} imágenes de otros datasets")
+    return restored
+
+# ==================== INFORME ====================
+
+def dataset_duplicate_groups(db, dataset_id, limit=100):
+    """Grupos de imágenes ya guardadas con el mismo contenido en un dataset"""
+    groups = db.images.aggregate([
+        {'$match': {'dataset_id': dataset_id, 'sha256': {'$type': 'string'}}},
+        {'$group': {'_id': '$sha256', 'count': {'$sum': 1},
+                    'images': {'$push': {'id': {'$toString': '$_id'}, 'filename': '$filename'}}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$sort': {'count': -1}},
+        {'$limit': limit}
+    ])
+    return [{'sha256': group['_id'], 'count': group['count'], 'images': group['images']}
+            for group in groups]
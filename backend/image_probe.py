@@ -0,0 +1,273 @@
+"""
+Lectura de metadatos de imágenes desde la cabecera del archivo.
+
+Obtiene ancho, alto, formato y orientación EXIF sin decodificar los píxeles
+y, en la misma pasada de lectura, calcula el SHA-256 del archivo y
+opcionalmente su contenido en base64. Lo usan todas las rutas de ingesta
+(subida individual, importación de ZIP y reprocesado de carpetas) para no
+abrir cada archivo varias veces.
+
+Los archivos se proyectan en memoria (mmap) y se recorren por ventanas: el
+contenido nunca se copia entero al heap y las páginas ya procesadas se
+liberan, así que la memoria usada por imagen queda acotada por el bloque
+(salvo el base64 que se guarda en MongoDB).
+"""
+import io
+import os
+import mmap
+import struct
+import hashlib
+import binascii
+
+from PIL import Image
+
+# Bytes iniciales con los que se intenta leer la cabecera
+PROBE_HEADER_BYTES = 64 * 1024
+
+# Límite de cabecera (JPEG con miniaturas o perfiles ICC grandes antes del SOF)
+PROBE_MAX_HEADER_BYTES = 16 * 1024 * 1024
+
+# Tamaño de bloque para el resto del archivo (hash y contenido); múltiplo de 3
+# para que los fragmentos de base64 se puedan concatenar y de la página de memoria
+PROBE_CHUNK_SIZE = 3 * 1024 * 1024
+
+# Etiqueta EXIF de orientación (1 = normal, 2-8 = espejado/rotado)
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Marcadores JPEG de inicio de frame (SOFn) que contienen las dimensiones
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _exif_orientation(tiff):
+    """Orientación del IFD0 de un bloque EXIF (TIFF) o 1 si no está"""
+    if len(tiff) < 8 or tiff[:2] not in (b'II', b'MM'):
+        return 1
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd_offset = struct.unpack_from(endian + 'I', tiff, 4)[0]
+    if ifd_offset + 2 > len(tiff):
+        return 1
+    entries = struct.unpack_from(endian + 'H', tiff, ifd_offset)[0]
+    for i in range(entries):
+        entry = ifd_offset + 2 + i * 12
+        if entry + 12 > len(tiff):
+            break
+        tag, = struct.unpack_from(endian + 'H', tiff, entry)
+        if tag == EXIF_ORIENTATION_TAG:
+            return struct.unpack_from(endian + 'H', tiff, entry + 8)[0]
+    return 1
+
+def _parse_jpeg(header):
+    """
+    Recorrer los segmentos JPEG hasta el SOF
+
+    Returns:
+        Dict de metadatos o None si falta cabecera por leer
+
+    Raises:
+        ValueError si la estructura no es la esperada
+    """
+    orientation = 1
+    pos = 2
+    size = len(header)
+    while pos + 4 <= size:
+        if header[pos] != 0xFF:
+            raise ValueError('Segmento JPEG inválido')
+        marker = header[pos + 1]
+        if marker == 0xFF:  # Byte de relleno
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # Marcadores sin longitud
+            pos += 2
+            continue
+        length, = struct.unpack_from('>H', header, pos + 2)
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > size:
+                return None
+            height, width = struct.unpack_from('>HH', header, pos + 5)
+            return {'width': width, 'height': height, 'format': 'JPEG', 'orientation': orientation}
+        if marker == 0xDA or marker == 0xD9:  # Inicio de datos sin SOF
+            raise ValueError('JPEG sin SOF')
+        if marker == 0xE1 and header[pos + 4:pos + 10] == b'Exif\x00\x00':
+            if pos + 2 + length > size:
+                return None
+            orientation = _exif_orientation(header[pos + 10:pos + 2 + length])
+        pos += 2 + length
+    return None
+
+def parse_image_header(header):
+    """
+    Leer dimensiones, formato y orientación de los primeros bytes de una imagen
+
+    JPEG, PNG y GIF se leen directamente de la cabecera; el resto de formatos
+    (y los JPEG con estructura inesperada) se delegan en PIL.
+
+    Returns:
+        Dict con width, height, format y orientation, o None si la cabecera
+        está incompleta o no es una imagen reconocible
+    """
+    try:
+        if header[:3] == b'\xff\xd8\xff':
+            return _parse_jpeg(header)
+        # Los PNG con bloque eXIf (poco frecuentes) pasan por PIL para leer su orientación
+        if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR' and b'eXIf' not in header:
+            width, height = struct.unpack_from('>II', header, 16)
+            return {'width': width, 'height': height, 'format': 'PNG', 'orientation': 1}
+        if header[:6] in (b'GIF87a', b'GIF89a') and len(header) >= 10:
+            width, height = struct.unpack_from('<HH', header, 6)
+            return {'width': width, 'height': height, 'format': 'GIF', 'orientation': 1}
+    except (ValueError, struct.error):
+        pass
+
+    try:
+        with Image.open(io.BytesIO(header)) as img:
+            width, height = img.size
+            orientation = 1
+            try:
+                orientation = int(img.getexif().get(EXIF_ORIENTATION_TAG, 1))
+            except Exception:
+                pass
+            return {
+                'width': width,
+                'height': height,
+                'format': img.format,
+                'orientation': orientation
+            }
+    except Exception:
+        return None
+
+def _probe_header(read_prefix, size):
+    """
+    Leer la cabecera ampliando el prefijo solo si hace falta
+
+    Args:
+        read_prefix: Función que devuelve los primeros n bytes
+        size: Tamaño total del archivo
+    """
+    length = PROBE_HEADER_BYTES
+    while True:
+        info = parse_image_header(read_prefix(length))
+        if info is not None or length >= min(size, PROBE_MAX_HEADER_BYTES):
+            return info
+        length *= 4
+
+def _release_pages(mm, start, length):
+    """Descartar del proceso las páginas ya leídas de un archivo proyectado"""
+    try:
+        mm.madvise(mmap.MADV_DONTNEED, start, length)
+    except (AttributeError, OSError, ValueError):
+        # Sin madvise (Windows, macOS antiguos): el sistema las libera bajo presión
+        pass
+
+def _walk_mapped(mm, size, hasher=None, parts=None):
+    """
+    Recorrer un archivo proyectado por ventanas de PROBE_CHUNK_SIZE sin copiarlo:
+    actualiza el hash y añade a parts los fragmentos en base64
+    """
+    view = memoryview(mm)
+    try:
+        for start in range(0, size, PROBE_CHUNK_SIZE):
+            block = view[start:start + PROBE_CHUNK_SIZE]
+            if hasher is not None:
+                hasher.update(block)
+            if parts is not None:
+                parts.append(binascii.b2a_base64(block, newline=False).decode('ascii'))
+            block.release()
+            _release_pages(mm, start, min(PROBE_CHUNK_SIZE, size - start))
+    finally:
+        view.release()
+
+def probe_image(path, compute_hash=True, with_base64=False):
+    """
+    Leer los metadatos de una imagen recorriendo el archivo una sola vez
+
+    Args:
+        path: Ruta del archivo
+        compute_hash: Calcular el SHA-256 del contenido (obliga a leerlo entero)
+        with_base64: Devolver también el contenido en base64 en 'base64'
+
+    Returns:
+        Dict con width, height, format, orientation, size, sha256 y base64
+        (None los que no se han pedido)
+
+    Raises:
+        ValueError si el archivo no es una imagen válida
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            raise ValueError(f'No es una imagen válida: {os.path.basename(path)}')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            info = _probe_header(lambda length: mm[:length], size)
+            if info is None:
+                raise ValueError(f'No es una imagen válida: {os.path.basename(path)}')
+
+            hasher = hashlib.sha256() if compute_hash else None
+            parts = [] if with_base64 else None
+            if hasher is not None or parts is not None:
+                _walk_mapped(mm, size, hasher, parts)
+
+    info.update({
+        'size': size,
+        'sha256': hasher.hexdigest() if hasher is not None else None,
+        'base64': ''.join(parts) if parts is not None else None
+    })
+    return info
+
+def save_image_stream(stream, path, compute_hash=True):
+    """
+    Copiar una imagen recibida (p. ej. el stream de una subida) a disco por
+    bloques, leyendo la cabecera y calculando el hash en la misma pasada
+
+    Returns:
+        Dict como probe_image (sin base64)
+
+    Raises:
+        ValueError si el contenido no es una imagen válida (no deja el archivo)
+    """
+    hasher = hashlib.sha256() if compute_hash else None
+    header = bytearray()
+    info = None
+    size = 0
+    with open(path, 'wb') as f:
+        while True:
+            block = stream.read(PROBE_CHUNK_SIZE)
+            if not block:
+                break
+            f.write(block)
+            size += len(block)
+            if hasher is not None:
+                hasher.update(block)
+            if info is None and len(header) < PROBE_MAX_HEADER_BYTES:
+                header.extend(block)
+                info = _probe_header(lambda length: bytes(header[:length]), len(header))
+                if info is not None:
+                    header = None
+
+    if info is None:
+        os.remove(path)
+        raise ValueError('No es una imagen válida')
+
+    info.update({
+        'size': size,
+        'sha256': hasher.hexdigest() if hasher is not None else None,
+        'base64': None
+    })
+    return info
+
+def file_base64(path):
+    """Contenido de un archivo en base64 leído por ventanas de un mmap"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            parts = []
+            _walk_mapped(mm, size, parts=parts)
+    return ''.join(parts)
+
+def probe_fields(probe):
+    """Campos de metadatos que se guardan en el documento de imagen"""
+    return {
+        'format': probe['format'],
+        'orientation': probe['orientation'],
+        'sha256': probe['sha256']
+    }
@@ -0,0 +1,227 @@
+"""
+Motor de importación de anotaciones.
+
+Etapas compartidas por los importadores COCO, YOLO y Pascal VOC definidos en
+app.py: los mapas nombre de archivo → imagen y nombre → categoría del dataset
+se cargan con una consulta cada uno, los duplicados se comprueban contra un
+índice en memoria por imagen y las anotaciones se escriben por lotes con
+insert_many.
+"""
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+# Anotaciones por cada insert_many
+IMPORT_BATCH_SIZE = 1000
+
+# Número de ids por consulta $in al precargar anotaciones existentes
+PRELOAD_CHUNK_SIZE = 5000
+
+# Extensiones con las que se busca la imagen de cada etiqueta YOLO (en orden)
+YOLO_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG']
+
+def create_import_context(db, dataset_id, user_id):
+    """
+    Preparar una importación: precarga imágenes, categorías y anotaciones
+    existentes del dataset
+
+    Returns:
+        Dict con el estado de la importación (se pasa al resto de funciones)
+    """
+    images_by_filename = {}
+    for img in db.images.find({'dataset_id': dataset_id},
+                              {'filename': 1, 'width': 1, 'height': 1}):
+        images_by_filename.setdefault(img['filename'], img)
+
+    categories_by_name = {}
+    category_names = {}
+    for cat in db.categories.find({'dataset_id': dataset_id}):
+        categories_by_name.setdefault(cat['name'], cat)
+        category_names[str(cat['_id'])] = cat['name']
+
+    ctx = {
+        'db': db,
+        'dataset_id': dataset_id,
+        'user_id': user_id,
+        'images_by_filename': images_by_filename,
+        'categories_by_name': categories_by_name,
+        'category_names': category_names,
+        'existing_boxes': {},
+        'pending': [],
+        'category_counts': {},
+        'stats': {'images': 0, 'annotations': 0, 'categories': 0, 'duplicates': 0, 'errors': []}
+    }
+    _preload_existing_boxes(ctx, [img['_id'] for img in images_by_filename.values()])
+    return ctx
+
+def _preload_existing_boxes(ctx, image_object_ids):
+    """Índice {image_id: [(category_id, nombre de categoría, bbox, original_bbox)]} de las anotaciones existentes"""
+    existing_boxes = ctx['existing_boxes']
+    projection = {'image_id': 1, 'category_id': 1, 'category': 1, 'bbox': 1, 'original_bbox': 1}
+
+    for start in range(0, len(image_object_ids), PRELOAD_CHUNK_SIZE):
+        chunk = image_object_ids[start:start + PRELOAD_CHUNK_SIZE]
+        # Las anotaciones antiguas pueden guardar image_id como ObjectId
+        ids = [str(oid) for oid in chunk] + list(chunk)
+        for ann in ctx['db'].annotations.find({'image_id': {'$in': ids}}, projection):
+            category_id = ann.get('category_id')
+            existing_boxes.setdefault(str(ann['image_id']), []).append((
+                str(category_id) if category_id else None,
+                ann.get('category'),
+                ann.get('bbox'),
+                ann.get('original_bbox')
+            ))
+
+# ==================== IMÁGENES Y CATEGORÍAS ====================
+
+def find_image(ctx, filename):
+    """Imagen del dataset con ese nombre de archivo (o None)"""
+    return ctx['images_by_filename'].get(filename)
+
+def find_image_by_stem(ctx, stem, extensions):
+    """Imagen del dataset cuyo nombre sea stem + alguna de las extensiones (en orden)"""
+    for ext in extensions:
+        img = ctx['images_by_filename'].get(stem + ext)
+        if img:
+            return img
+    return None
+
+def get_or_create_category(ctx, name, color, extra_fields=None):
+    """
+    Id de la categoría del dataset con ese nombre, creándola si no existe
+
+    Returns:
+        Tupla (category_id, creada)
+    """
+    existing = ctx['categories_by_name'].get(name)
+    if existing:
+        return str(existing['_id']), False
+
+    new_cat = {
+        'name': name,
+        'color': color,
+        'dataset_id': ctx['dataset_id'],
+        'created_date': datetime.utcnow(),
+        'user_id': ctx['user_id']  # Asociar categoría al usuario
+    }
+    new_cat.update(extra_fields or {})
+    result = ctx['db'].categories.insert_one(new_cat)
+    new_cat['_id'] = result.inserted_id
+
+    category_id = str(result.inserted_id)
+    ctx['categories_by_name'][name] = new_cat
+    ctx['category_names'][category_id] = name
+    ctx['stats']['categories'] += 1
+    return category_id, True
+
+def category_color(ctx, category_id, default='#00ff00'):
+    """Color de una categoría ya cargada en el contexto"""
+    name = ctx['category_names'].get(category_id)
+    category = ctx['categories_by_name'].get(name) if name else None
+    return category.get('color', default) if category else default
+
+# ==================== DUPLICADOS Y ESCRITURA POR LOTES ====================
+
+def bbox_iou(bbox1, bbox2):
+    """IoU entre dos bounding boxes [x, y, width, height]"""
+    x1, y1, w1, h1 = bbox1[:4]
+    x2, y2, w2, h2 = bbox2[:4]
+
+    x_left = max(x1, x2)
+    y_top = max(y1, y2)
+    x_right = min(x1 + w1, x2 + w2)
+    y_bottom = min(y1 + h1, y2 + h2)
+    if x_right < x_left or y_bottom < y_top:
+        return 0.0
+
+    intersection_area = (x_right - x_left) * (y_bottom - y_top)
+    union_area = w1 * h1 + w2 * h2 - intersection_area
+    if union_area == 0:
+        return 0.0
+    return intersection_area / union_area
+
+def is_duplicate_annotation(ctx, image_id, category_id, bbox, iou_threshold):
+    """
+    Comprobar si la imagen ya tiene una anotación de la misma categoría (por id
+    o por nombre) con IoU >= iou_threshold, incluidas las añadidas en esta importación
+
+    Returns:
+        IoU de la anotación duplicada o None
+    """
+    if not bbox or len(bbox) < 4:
+        return None
+
+    category_name = ctx['category_names'].get(category_id)
+    for existing_category_id, existing_name, existing_bbox, original_bbox in \
+            ctx['existing_boxes'].get(image_id, ()):
+        if existing_category_id != category_id and \
+                not (category_name and existing_name == category_name):
+            continue
+        for candidate in (original_bbox, existing_bbox):
+            if candidate and len(candidate) >= 4:
+                iou = bbox_iou(bbox, candidate)
+                if iou >= iou_threshold:
+                    return iou
+    return None
+
+def add_annotation(ctx, annotation_doc, iou_threshold):
+    """
+    Encolar una anotación si no es duplicada; se escribe al completar el lote
+
+    Returns:
+        True si se añadió, False si era duplicada
+    """
+    image_id = annotation_doc['image_id']
+    category_id = annotation_doc['category_id']
+    bbox = annotation_doc.get('bbox')
+
+    if is_duplicate_annotation(ctx, image_id, category_id, bbox, iou_threshold) is not None:
+        ctx['stats']['duplicates'] += 1
+        return False
+
+    ctx['existing_boxes'].setdefault(image_id, []).append((category_id, None, bbox, None))
+    ctx['pending'].append(annotation_doc)
+    if len(ctx['pending']) >= IMPORT_BATCH_SIZE:
+        flush_annotations(ctx)
+    return True
+
+def flush_annotations(ctx):
+    """Escribir las anotaciones pendientes con un único insert_many ordenado"""
+    pending = ctx['pending']
+    if not pending:
+        return
+    ctx['db'].annotations.insert_many(pending, ordered=True)
+    ctx['stats']['annotations'] += len(pending)
+    for doc in pending:
+        category_id = doc['category_id']
+        ctx['category_counts'][category_id] = ctx['category_counts'].get(category_id, 0) + 1
+    ctx['pending'] = []
+
+def finish_import(ctx):
+    """
+    Escribir el último lote y actualizar el contador de anotaciones de las
+    categorías afectadas con una sola agregación
+
+    Returns:
+        Estadísticas de la importación
+    """
+    flush_annotations(ctx)
+
+    stats = ctx['stats']
+    if stats['duplicates']:
+        print(f"AVISO: {stats['duplicates']} anotaciones duplicadas omitidas")
+
+    category_ids = list(ctx['category_counts'])
+    if category_ids:
+        totals = ctx['db'].annotations.aggregate([
+            {'$match': {'category_id': {'$in': category_ids}}},
+            {'$group': {'_id': '$category_id', 'total': {'$sum': 1}}}
+        ])
+        for row in totals:
+            ctx['db'].categories.update_one(
+                {'_id': ObjectId(row['_id'])},
+                {'$set': {'annotation_count': row['total']}}
+            )
+            print(f"INFO: Categoría {row['_id']}: {row['total']} anotaciones totales")
+
+    return stats
@@ -0,0 +1,490 @@
+"""
+Ejecución de modelos de detección (YOLO de ultralytics, TorchScript u ONNX).
+
+Guarda el modelo activo del proceso y devuelve las detecciones como datos
+simples ({bbox [x, y, ancho, alto] en píxeles de la imagen original,
+confidence, class}), sin tocar la base de datos: la API decide qué
+categorías y anotaciones crea a partir de ellas.
+
+La API usa este módulo directamente (un único proceso con el modelo en
+memoria) o, con INFERENCE_URL, a través de inference_client, que expone las
+mismas funciones contra el servicio de inferencia (inference_server), que
+es quien importa este módulo.
+
+Las predicciones se agrupan en lotes (micro-batching): cada petición decodifica
+su imagen en su propio hilo y la deja en una cola, y un único hilo ejecuta el
+modelo con hasta INFERENCE_MAX_BATCH imágenes, esperando como mucho
+INFERENCE_MAX_WAIT_MS desde la primera para completar el lote. Varias
+peticiones simultáneas (varios anotadores) comparten así una pasada del
+modelo, y el modelo nunca se ejecuta desde dos hilos a la vez.
+
+Con INFERENCE_RUNTIME=onnx (o auto sin GPU) los modelos se convierten a ONNX y
+se ejecutan con ONNX Runtime en CPU (ver onnx_backend). Las variantes de un
+modelo (p. ej. la cuantizada en INT8, ver quantization) se cargan con él y cada
+predicción puede elegir cuál usar. Las imágenes muy grandes se pueden procesar
+por teselas (ver tiling).
+
+Al cargar un modelo se ejecutan predicciones de calentamiento con imágenes
+vacías de INFERENCE_WARMUP_SIZES (con el modelo y sus variantes): la
+inicialización perezosa (kernels de CUDA o de CPU, preparación del predictor
+de ultralytics, memoria de ONNX Runtime, hilo del planificador) se paga en la
+carga y la primera petición tarda lo mismo que las siguientes. model_status()
+indica con ready cuándo ha terminado.
+"""
+import io
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import onnx_backend
+import tiling
+import yolo_ops
+from metrics import timed, observe, BATCH_SIZE_BUCKETS
+
+# Tamaño de entrada de los modelos TorchScript exportados de YOLO
+TORCHSCRIPT_INPUT_SIZE = 640
+
+# Umbral de IoU para la supresión de no máximos de TorchScript
+NMS_IOU_THRESHOLD = 0.45
+
+# Tamaño máximo de un lote y espera máxima para completarlo
+INFERENCE_MAX_BATCH = max(1, int(os.getenv('INFERENCE_MAX_BATCH', 8)))
+INFERENCE_MAX_WAIT_MS = float(os.getenv('INFERENCE_MAX_WAIT_MS', 10))
+
+# Predicciones en espera antes de rechazar nuevas (servicio saturado)
+INFERENCE_QUEUE_SIZE = int(os.getenv('INFERENCE_QUEUE_SIZE', 256))
+
+# Tiempo máximo que una petición espera su resultado
+INFERENCE_RESULT_TIMEOUT = float(os.getenv('INFERENCE_RESULT_TIMEOUT', 300))  # segundos
+
+# Tamaños (ancho x alto) de las imágenes de calentamiento al cargar un modelo (vacío: sin calentamiento)
+INFERENCE_WARMUP_SIZES = os.getenv('INFERENCE_WARMUP_SIZES', '640x480,1920x1080')
+
+# Imágenes de calentamiento por tamaño; se envían juntas para calentar también los lotes
+INFERENCE_WARMUP_RUNS = max(1, int(os.getenv('INFERENCE_WARMUP_RUNS', 2)))
+
+def _parse_sizes(value):
+    sizes = []
+    for size in value.split(','):
+        if not size.strip():
+            continue
+        try:
+            width, height = (int(side) for side in size.lower().split('x'))
+        except ValueError:
+            print(f"AVISO: tamaño de calentamiento no válido: {size}")
+            continue
+        if width > 0 and height > 0:
+            sizes.append((width, height))
+    return sizes
+
+WARMUP_SIZES = _parse_sizes(INFERENCE_WARMUP_SIZES)
+
+_EMPTY_STATE = {'model': None, 'kind': None, 'model_id': None, 'name': None, 'path': None, 'categories': [],
+                'variants': {}, 'variant_states': {}, 'warmup': None}
+_state = dict(_EMPTY_STATE)
+# Reentrante: el calentamiento carga las variantes sin soltarlo
+_load_guard = threading.RLock()
+
+_queue = queue.Queue(maxsize=INFERENCE_QUEUE_SIZE)
+_worker = {'thread': None}
+_worker_guard = threading.Lock()
+_stats = {'requests': 0, 'batches': 0, 'largest_batch': 0}
+
+def model_status():
+    """Modelo activo: is_loaded, ready (cargado y calentado), model_id, model_name y categories"""
+    state = _state
+    warmup = state['warmup']
+    return {
+        'is_loaded': state['model'] is not None,
+        'ready': state['model'] is not None and (warmup is None or warmup['status'] not in ('pending', 'warming')),
+        'model_id': state['model_id'],
+        'model_name': state['name'],
+        'categories': list(state['categories']),
+        'runtime': state['kind'],
+        'variants': sorted(state['variants']),
+        'warmup': dict(warmup) if warmup else None
+    }
+
+def _class_names(model):
+    """Nombres de clase que trae un modelo de ultralytics (o lista vacía)"""
+    try:
+        if hasattr(model, 'names'):
+            return list(model.names.values()) if isinstance(model.names, dict) else list(model.names)
+        num_classes = getattr(model.model, 'nc', None) if hasattr(model, 'model') else None
+        if num_classes:
+            return [f'Clase_{i}' for i in range(num_classes)]
+    except Exception as e:
+        print(f"Error al obtener categorías del modelo: {e}")
+    return []
+
+def load_model(model_path, model_id=None, name=None, categories=None, variants=None, reuse_loaded=False):
+    """
+    Cargar un modelo, calentarlo (ver warmup) y hacerlo el activo del proceso
+
+    Args:
+        model_path: Archivo .pt (ultralytics), .torchscript u .onnx
+        categories: Nombres de las clases; si no se indican se usan los del modelo
+        variants: {nombre: ruta .onnx} de las variantes del modelo (se cargan al usarlas)
+        reuse_loaded: No volver a cargarlo si ya es el activo (mismo archivo, id y
+            variantes), p. ej. en la precarga al arrancar cada worker de la API
+
+    Returns:
+        model_status() del nuevo modelo
+
+    Raises:
+        RuntimeError si el modelo no se puede cargar
+    """
+    global _state
+    with _load_guard:
+        if reuse_loaded and _state['model'] is not None and _state['path'] == model_path and \
+                _state['model_id'] == model_id and _state['variants'] == dict(variants or {}):
+            return model_status()
+
+        model, kind = _load_onnx(model_path), 'onnx'
+        if model is None:
+            model, kind = _load_torch(model_path)
+
+        categories = list(categories or [])
+        if not categories:
+            if kind == 'ultralytics':
+                categories = _class_names(model)
+            elif kind == 'onnx':
+                categories = onnx_backend.class_names(model)
+            categories = categories or ['Objeto_detectado']
+
+        # Se sustituye el estado completo: las predicciones en cola terminan con el modelo anterior
+        state = dict(model=model, kind=kind, model_id=model_id, name=name, path=model_path,
+                     categories=categories, variants=dict(variants or {}), variant_states={},
+                     warmup={'status': 'pending'} if WARMUP_SIZES else None)
+        if kind == 'onnx':
+            # Número de clases de la salida según el propio modelo (las categorías pueden no coincidir)
+            state['num_classes'] = len(onnx_backend.class_names(model)) or None
+            state['batchable'] = onnx_backend.supports_batches(model)
+        _state = state
+        # Con el bloqueo: otra carga espera a que termine el calentamiento
+        warmup(state)
+    return model_status()
+
+def _load_torch(model_path):
+    try:
+        if model_path.endswith('.torchscript'):
+            import torch
+            # Cargar en GPU si está disponible, sino en CPU
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            model = torch.jit.load(model_path, map_location=device)
+            model.eval()  # Poner en modo evaluación
+            print(f"Modelo TorchScript cargado en: {device}")
+            return model, 'torchscript'
+        # Importar YOLO solo cuando sea necesario
+        from ultralytics import YOLO
+        return YOLO(model_path), 'ultralytics'
+    except Exception as e:
+        raise RuntimeError(f'Error al cargar el modelo: {str(e)}')
+
+def _load_onnx(model_path):
+    """Sesión de ONNX Runtime para el modelo, o None para usar PyTorch"""
+    if not model_path.endswith('.onnx') and not onnx_backend.use_onnx():
+        return None
+    try:
+        return onnx_backend.load_session(onnx_backend.export_onnx(model_path))
+    except ImportError as e:
+        print(f"AVISO: ONNX Runtime no disponible ({e}), se usa PyTorch")
+    except Exception as e:
+        print(f"AVISO: no se pudo usar ONNX Runtime con {model_path} ({e}), se usa PyTorch")
+    if model_path.endswith('.onnx'):
+        raise RuntimeError('Error al cargar el modelo: no se pudo abrir el modelo ONNX')
+    return None
+
+def unload_model(model_id=None):
+    """Descargar el modelo activo (o solo si es model_id)"""
+    global _state
+    with _load_guard:
+        if model_id is None or _state['model_id'] == model_id:
+            _state = dict(_EMPTY_STATE)
+    return model_status()
+
+def _variant_state(state, variant):
+    """Estado con el que ejecutar una variante del modelo (se carga la primera vez)"""
+    path = state['variants'].get(variant)
+    if not path:
+        raise ValueError(f'Variante no disponible para el modelo activo: {variant}')
+    with _load_guard:
+        variant_state = state['variant_states'].get(variant)
+        if variant_state is None:
+            try:
+                session = onnx_backend.load_session(path)
+            except Exception as e:
+                raise RuntimeError(f'Error al cargar la variante {variant}: {str(e)}')
+            variant_state = dict(state, model=session, kind='onnx',
+                                 num_classes=len(onnx_backend.class_names(session)) or None,
+                                 batchable=onnx_backend.supports_batches(session))
+            state['variant_states'][variant] = variant_state
+    return variant_state
+
+def warmup(state=None):
+    """
+    Predicciones de calentamiento con un modelo (por defecto el activo) y sus
+    variantes: INFERENCE_WARMUP_RUNS imágenes vacías de cada tamaño de
+    INFERENCE_WARMUP_SIZES por el mismo camino que las peticiones (cola y lotes)
+
+    Returns:
+        Estado del calentamiento (status ready o failed, sizes, seconds, error)
+        o None si está desactivado
+    """
+    state = state or _state
+    if state['model'] is None or not WARMUP_SIZES:
+        return None
+    from PIL import Image
+
+    info = {'status': 'warming', 'sizes': [f'{width}x{height}' for width, height in WARMUP_SIZES],
+            'seconds': None, 'error': None}
+    state['warmup'] = info
+    start = time.perf_counter()
+    try:
+        with _load_guard:
+            run_states = [state] + [_variant_state(state, variant) for variant in sorted(state['variants'])]
+        for run_state in run_states:
+            for size in WARMUP_SIZES:
+                # Gris del relleno del letterbox: sin detecciones que decodificar
+                image = Image.new('RGB', size, (yolo_ops.LETTERBOX_FILL,) * 3)
+                futures = [_submit(run_state, image, 0.5) for _ in range(INFERENCE_WARMUP_RUNS)]
+                for future in futures:
+                    future.result(timeout=INFERENCE_RESULT_TIMEOUT)
+        info['status'] = 'ready'
+    except Exception as e:
+        # El modelo queda cargado: la primera petición pagará la inicialización o mostrará el error
+        print(f"AVISO: error en el calentamiento del modelo {state['name'] or state['path']}: {e}")
+        info['status'] = 'failed'
+        info['error'] = str(e)
+    info['seconds'] = round(time.perf_counter() - start, 2)
+    if info['status'] == 'ready':
+        print(f"Modelo {state['name'] or state['path']} calentado en {info['seconds']}s "
+              f"({', '.join(info['sizes'])}; {len(run_states) - 1} variante(s))")
+    return dict(info)
+
+def batcher_status():
+    """Estado de la cola de predicciones y de los lotes ejecutados"""
+    batches = _stats['batches']
+    return {
+        'queued': _queue.qsize(),
+        'requests': _stats['requests'],
+        'batches': batches,
+        'mean_batch_size': round(_stats['requests'] / batches, 2) if batches else None,
+        'largest_batch': _stats['largest_batch'],
+        'max_batch': INFERENCE_MAX_BATCH,
+        'max_wait_ms': INFERENCE_MAX_WAIT_MS
+    }
+
+def _run_torchscript(model, images, confidences):
+    import torch
+
+    # Letterbox del lote para TorchScript (ver yolo_ops)
+    batch, letterboxes = yolo_ops.preprocess(images, (TORCHSCRIPT_INPUT_SIZE, TORCHSCRIPT_INPUT_SIZE))
+
+    # Mover tensor al mismo dispositivo que el modelo
+    parameter = next(model.parameters(), None) if hasattr(model, 'parameters') else None
+    device = parameter.device if parameter is not None else \
+        torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    with torch.no_grad():
+        predictions = model(torch.from_numpy(batch).to(device))
+    if not isinstance(predictions, torch.Tensor):
+        raise RuntimeError(f'Salida de TorchScript no soportada: {type(predictions)}')
+    # Una sola copia a memoria para todo el lote; la decodificación es vectorizada en NumPy
+    predictions = predictions.float().cpu().numpy()
+    return [yolo_ops.decode(predictions[i], confidence, letterbox, image.size, NMS_IOU_THRESHOLD)
+            for i, (image, confidence, letterbox) in enumerate(zip(images, confidences, letterboxes))]
+
+def _run_ultralytics(model, images, confidences):
+    # Un único umbral para el lote (el menor); cada petición filtra después con el suyo
+    results = model(images, conf=min(confidences), verbose=False)
+    all_detections = []
+    for result, confidence in zip(results, confidences):
+        detections = []
+        if result.boxes is not None:
+            boxes = result.boxes
+            for box, conf, cls in zip(boxes.xyxy.cpu().tolist(), boxes.conf.cpu().tolist(),
+                                      boxes.cls.cpu().tolist()):
+                if conf < confidence:
+                    continue
+                x1, y1, x2, y2 = box
+                detections.append({'bbox': [x1, y1, x2 - x1, y2 - y1], 'confidence': float(conf),
+                                   'class': int(cls)})
+        all_detections.append(detections)
+    return all_detections
+
+def _run_batch(state, images, confidences):
+    """Detecciones de cada imagen de un lote con el modelo del estado dado"""
+    if state['kind'] == 'onnx':
+        return onnx_backend.run(state['model'], images, confidences, NMS_IOU_THRESHOLD,
+                                state.get('num_classes'))
+    if state['kind'] == 'torchscript':
+        return _run_torchscript(state['model'], images, confidences)
+    return _run_ultralytics(state['model'], images, confidences)
+
+# ==================== MICRO-BATCHING ====================
+
+def _collect_batch():
+    """Esperar una petición y completar el lote con las que lleguen hasta el tiempo máximo"""
+    batch = [_queue.get()]
+    deadline = time.monotonic() + INFERENCE_MAX_WAIT_MS / 1000
+    while len(batch) < INFERENCE_MAX_BATCH:
+        remaining = deadline - time.monotonic()
+        try:
+            batch.append(_queue.get(timeout=remaining) if remaining > 0 else _queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def _process_batch(batch):
+    # Las peticiones encoladas antes de un cambio de modelo usan el modelo con el que llegaron
+    groups = {}
+    for item in batch:
+        groups.setdefault(id(item['state']['model']), []).append(item)
+
+    now = time.monotonic()
+    for items in groups.values():
+        for item in items:
+            observe('inference_queue_seconds', now - item['queued_at'])
+        observe('inference_batch_size', len(items), buckets=BATCH_SIZE_BUCKETS)
+        _stats['requests'] += len(items)
+        _stats['batches'] += 1
+        _stats['largest_batch'] = max(_stats['largest_batch'], len(items))
+        state = items[0]['state']
+        try:
+            if len(items) > 1 and not state.get('batchable', True):
+                raise RuntimeError('modelo sin soporte de lotes')
+            with timed('inference_batch'):
+                results = _run_batch(state, [item['image'] for item in items],
+                                     [item['confidence'] for item in items])
+        except Exception as e:
+            if len(items) == 1:
+                items[0]['future'].set_exception(e)
+                continue
+            # Repetir una a una para que un error no falle las demás peticiones del lote
+            # (p. ej. TorchScript exportado con tamaño de lote fijo 1: no se vuelve a intentar)
+            if state.get('batchable', True):
+                print(f"Error en un lote de {len(items)} imágenes: {e}, se ejecutan imagen a imagen")
+                state['batchable'] = False
+            results = []
+            for item in items:
+                try:
+                    with timed('inference_batch'):
+                        results.append(_run_batch(state, [item['image']], [item['confidence']])[0])
+                except Exception as single_error:
+                    results.append(single_error)
+        for item, result in zip(items, results):
+            if isinstance(result, Exception):
+                item['future'].set_exception(result)
+            else:
+                item['future'].set_result(result)
+
+def _worker_loop():
+    while True:
+        batch = _collect_batch()
+        try:
+            _process_batch(batch)
+        except Exception as e:
+            print(f"Error en el planificador de inferencia: {e}")
+            for item in batch:
+                if not item['future'].done():
+                    item['future'].set_exception(e)
+
+def _ensure_worker():
+    with _worker_guard:
+        if _worker['thread'] is None or not _worker['thread'].is_alive():
+            _worker['thread'] = threading.Thread(target=_worker_loop, name='inference-batcher', daemon=True)
+            _worker['thread'].start()
+
+def _submit(state, image, confidence):
+    """Encolar una imagen ya decodificada y devolver el Future de sus detecciones"""
+    _ensure_worker()
+    item = {'state': state, 'image': image, 'confidence': confidence, 'future': Future(),
+            'queued_at': time.monotonic()}
+    try:
+        _queue.put_nowait(item)
+    except queue.Full:
+        raise RuntimeError('Servicio de inferencia saturado, inténtelo de nuevo más tarde')
+    return item['future']
+
+def _predict_tiled(state, image, confidence, tile_size, overlap):
+    """Detecciones de una imagen por teselas, unidas en coordenadas de la imagen"""
+    windows = tiling.tile_windows(image.size[0], image.size[1], tile_size, overlap)
+    pending = deque()  # (Future, x, y)
+    detections = []
+
+    def collect():
+        future, x, y = pending.popleft()
+        detections.extend(tiling.offset_detections(future.result(timeout=INFERENCE_RESULT_TIMEOUT), x, y))
+
+    if tiling.TILE_INCLUDE_FULL:
+        pending.append((_submit(state, image, confidence), 0, 0))
+    for x0, y0, x1, y1 in windows:
+        if len(pending) >= tiling.TILE_MAX_PENDING:
+            collect()
+        pending.append((_submit(state, image.crop((x0, y0, x1, y1)), confidence), x0, y0))
+    while pending:
+        collect()
+    return tiling.merge_detections(detections, NMS_IOU_THRESHOLD), len(windows)
+
+def predict(image_data, confidence=0.5, variant=None, tiled=None, tile_size=None, tile_overlap=None):
+    """
+    Detectar objetos en una imagen con el modelo activo
+
+    Args:
+        image_data: Bytes de la imagen (cualquier formato que abra PIL)
+        confidence: Confianza mínima
+        variant: Variante del modelo activo (p. ej. 'int8'); None para el original
+        tiled: Procesar por teselas (True/False); None decide por el tamaño de la imagen
+        tile_size, tile_overlap: Lado y solapamiento de las teselas (por defecto los de tiling)
+
+    Returns:
+        Dict con detections, width, height, tiles (0 sin teselas) y el modelo
+        usado (model_id, model_name, categories, variant)
+
+    Raises:
+        ValueError si no hay modelo cargado o la imagen no es válida
+        RuntimeError si falla la inferencia
+    """
+    state = _state
+    if state['model'] is None:
+        raise ValueError('No hay modelo cargado')
+    tile_size, tile_overlap = tiling.tile_options(tile_size, tile_overlap)
+    run_state = _variant_state(state, variant) if variant else state
+
+    from PIL import Image
+    try:
+        with timed('image_decode'):
+            image = Image.open(io.BytesIO(image_data))
+            image.load()  # decodificar aquí y no en el hilo del modelo
+            # Asegurar que la imagen esté en modo RGB
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+    except Exception as e:
+        raise ValueError(f'Error al procesar la imagen: {str(e)}')
+
+    confidence = float(confidence)
+    tiles = 0
+    try:
+        with timed('inference'):
+            if tiling.should_tile(image.size, tiled, tile_size):
+                detections, tiles = _predict_tiled(run_state, image, confidence, tile_size, tile_overlap)
+            else:
+                detections = _submit(run_state, image, confidence).result(timeout=INFERENCE_RESULT_TIMEOUT)
+    except Exception as e:
+        print(f"Error durante la predicción: {e}")
+        raise RuntimeError(f'Error durante la predicción: {str(e)}')
+
+    return {
+        'detections': detections,
+        'width': image.size[0],
+        'height': image.size[1],
+        'tiles': tiles,
+        'model_id': state['model_id'],
+        'model_name': state['name'],
+        'categories': list(state['categories']),
+        'variant': variant
+    }
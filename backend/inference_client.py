@@ -0,0 +1,121 @@
+"""
+Cliente del servicio de inferencia (inference_server).
+
+Expone las mismas funciones que inference (model_status, load_model,
+unload_model, predict) para que la API use indistintamente el modelo en su
+propio proceso o el servicio remoto:
+
+    inference = inference_backend()
+
+Con INFERENCE_URL (p. ej. http://inference:5001) las llamadas van al
+servicio por HTTP con una conexión persistente por hilo (INFERENCE_TOKEN es
+obligatorio); sin ella se devuelve el módulo inference (modelo en el proceso
+de la API).
+"""
+import os
+import json
+import threading
+import http.client
+from urllib.parse import urlsplit, urlencode
+
+from metrics import timed
+
+INFERENCE_URL = os.getenv('INFERENCE_URL')
+INFERENCE_TOKEN = os.getenv('INFERENCE_TOKEN')
+
+# Tiempo máximo de una llamada al servicio (la carga de un modelo puede tardar)
+INFERENCE_TIMEOUT = float(os.getenv('INFERENCE_TIMEOUT', 300))  # segundos
+
+_local = threading.local()
+
+def inference_backend():
+    """Módulo con las funciones de inferencia: este cliente o inference"""
+    if INFERENCE_URL:
+        if not INFERENCE_TOKEN:
+            raise RuntimeError('INFERENCE_TOKEN es obligatorio con INFERENCE_URL')
+        import inference_client
+        print(f"Inferencia en el servicio {INFERENCE_URL}")
+        return inference_client
+    import inference
+    return inference
+
+def _connection():
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        url = urlsplit(INFERENCE_URL)
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        connection = connection_class(url.hostname, url.port, timeout=INFERENCE_TIMEOUT)
+        _local.connection = connection
+    return connection
+
+def _request(method, path, body=None, params=None, content_type='application/json'):
+    """
+    Llamar al servicio y devolver el JSON de la respuesta
+
+    Raises:
+        ValueError para errores 4xx del servicio (petición no válida)
+        RuntimeError si el servicio no responde o falla
+    """
+    prefix = urlsplit(INFERENCE_URL).path.rstrip('/')
+    url = prefix + path + (f'?{urlencode(params)}' if params else '')
+    headers = {'Content-Type': content_type}
+    if INFERENCE_TOKEN:
+        headers['X-Inference-Token'] = INFERENCE_TOKEN
+    if body is not None and content_type == 'application/json':
+        body = json.dumps(body)
+
+    for attempt in range(2):
+        connection = _connection()
+        try:
+            connection.request(method, url, body=body, headers=headers)
+            response = connection.getresponse()
+            payload = response.read()
+            break
+        except (http.client.HTTPException, OSError) as e:
+            # Conexión persistente cerrada por el servicio: reintentar una vez con otra
+            connection.close()
+            _local.connection = None
+            if attempt == 1:
+                raise RuntimeError(f'Servicio de inferencia no disponible: {e}')
+
+    try:
+        data = json.loads(payload or b'{}')
+    except ValueError:
+        data = {'error': payload[:200].decode('utf-8', 'replace')}
+    if response.status >= 500:
+        raise RuntimeError(data.get('error') or f'Error {response.status} del servicio de inferencia')
+    if response.status >= 400:
+        raise ValueError(data.get('error') or f'Error {response.status} del servicio de inferencia')
+    return data
+
+def model_status():
+    try:
+        return _request('GET', '/models/status')
+    except (RuntimeError, ValueError) as e:
+        print(f"Error consultando el servicio de inferencia: {e}")
+        return {'is_loaded': False, 'ready': False, 'model_id': None, 'model_name': None, 'categories': [],
+                'runtime': None, 'variants': [], 'warmup': None, 'error': str(e)}
+
+def load_model(model_path, model_id=None, name=None, categories=None, variants=None, reuse_loaded=False):
+    try:
+        return _request('POST', '/models/load', {'model_path': model_path, 'model_id': model_id,
+                                                 'name': name, 'categories': categories,
+                                                 'variants': variants, 'reuse_loaded': reuse_loaded})
+    except ValueError as e:
+        raise RuntimeError(str(e))
+
+def unload_model(model_id=None):
+    return _request('POST', '/models/unload', {'model_id': model_id})
+
+def predict(image_data, confidence=0.5, variant=None, tiled=None, tile_size=None, tile_overlap=None):
+    params = {'confidence': confidence}
+    if variant:
+        params['variant'] = variant
+    if tiled is not None:
+        params['tiled'] = 'true' if tiled else 'false'
+    if tile_size is not None:
+        params['tile_size'] = tile_size
+    if tile_overlap is not None:
+        params['tile_overlap'] = tile_overlap
+    with timed('inference_rpc'):
+        return _request('POST', '/predict', image_data, params=params, content_type='application/octet-stream')
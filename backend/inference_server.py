@@ -0,0 +1,126 @@
+"""
+Servicio de inferencia.
+
+Proceso aparte que mantiene los modelos en memoria y atiende las
+predicciones de la API (ver inference_client). Así la API no guarda estado
+del modelo y puede ejecutarse con varios workers, mientras que este servicio
+se ejecuta con un único proceso (el que tiene el modelo) y varios hilos.
+
+No accede a MongoDB: la API comprueba permisos, resuelve el archivo del
+modelo y guarda las anotaciones. Las predicciones de las peticiones
+simultáneas se agrupan en lotes (ver inference: INFERENCE_MAX_BATCH e
+INFERENCE_MAX_WAIT_MS).
+
+Endpoints (JSON):
+    GET  /health            Estado del servicio, del modelo (ready: cargado y calentado)
+                            y de la cola de lotes
+    GET  /models/status     Modelo activo
+    POST /models/load       {model_path, model_id, name, categories, variants, reuse_loaded}
+                            (responde cuando el modelo está calentado)
+    POST /models/unload     {model_id} (opcional: solo si es el activo)
+    POST /predict           Cuerpo: bytes de la imagen; ?confidence=0.5&variant=int8
+                            &tiled=true&tile_size=640&tile_overlap=0.2
+    GET  /metrics           Métricas en formato Prometheus
+
+El servicio no arranca sin INFERENCE_TOKEN: las peticiones (salvo /health)
+deben enviarlo en la cabecera X-Inference-Token. Solo se cargan modelos que
+estén dentro de INFERENCE_MODELS_DIR (los .pt se deserializan con pickle).
+
+Uso:
+    gunicorn --workers=1 --threads=8 --bind=0.0.0.0:5001 inference_server:app
+"""
+import os
+import hmac
+
+from flask import Flask, request, jsonify
+
+import inference
+from metrics import init_metrics, render_metrics
+
+INFERENCE_TOKEN = os.getenv('INFERENCE_TOKEN')
+if not INFERENCE_TOKEN:
+    raise RuntimeError('INFERENCE_TOKEN es obligatorio para el servicio de inferencia')
+
+# Directorio de los modelos (misma ruta que en la API); no se carga nada fuera de él
+MODELS_DIR = os.path.realpath(os.getenv('INFERENCE_MODELS_DIR', os.path.join(os.getcwd(), 'ai_models')))
+
+# Tamaño máximo de una imagen enviada a /predict
+MAX_IMAGE_SIZE = int(os.getenv('INFERENCE_MAX_IMAGE_SIZE', 200 * 1024 * 1024))  # 200MB
+
+app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_IMAGE_SIZE
+init_metrics(app)
+
+@app.before_request
+def check_token():
+    if request.path != '/health' and \
+            not hmac.compare_digest(request.headers.get('X-Inference-Token', ''), INFERENCE_TOKEN):
+        return jsonify({'error': 'No autorizado'}), 401
+
+def resolve_model_path(model_path):
+    """Ruta real de un modelo (relativa a MODELS_DIR o absoluta) o None si queda fuera de MODELS_DIR"""
+    resolved = os.path.realpath(os.path.join(MODELS_DIR, model_path))
+    if os.path.commonpath([resolved, MODELS_DIR]) != MODELS_DIR:
+        return None
+    return resolved
+
+@app.route('/health', methods=['GET'])
+def health():
+    model = inference.model_status()
+    return jsonify({'status': 'healthy', 'ready': model['ready'], 'model': model,
+                    'batching': inference.batcher_status()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/models/status', methods=['GET'])
+def status():
+    return jsonify(inference.model_status())
+
+@app.route('/models/load', methods=['POST'])
+def load():
+    data = request.get_json() or {}
+    if not data.get('model_path'):
+        return jsonify({'error': 'model_path requerido'}), 400
+    model_path = resolve_model_path(data['model_path'])
+    variants = {name: resolve_model_path(path) for name, path in (data.get('variants') or {}).items()}
+    if model_path is None or None in variants.values():
+        return jsonify({'error': 'El modelo debe estar en el directorio de modelos'}), 403
+    if not os.path.exists(model_path):
+        return jsonify({'error': 'Archivo de modelo no encontrado'}), 404
+    try:
+        return jsonify(inference.load_model(model_path, data.get('model_id'), data.get('name'),
+                                            data.get('categories'), variants, bool(data.get('reuse_loaded'))))
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/models/unload', methods=['POST'])
+def unload():
+    data = request.get_json(silent=True) or {}
+    return jsonify(inference.unload_model(data.get('model_id')))
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    try:
+        confidence = float(request.args.get('confidence', 0.5))
+    except ValueError:
+        return jsonify({'error': 'confidence no válido'}), 400
+    tile_size = request.args.get('tile_size', type=int)
+    tile_overlap = request.args.get('tile_overlap', type=float)
+    tiled = request.args.get('tiled')
+    if tiled is not None:
+        tiled = tiled.lower() in ('1', 'true', 'yes')
+    image_data = request.get_data()
+    if not image_data:
+        return jsonify({'error': 'Imagen vacía'}), 400
+    try:
+        return jsonify(inference.predict(image_data, confidence, request.args.get('variant'), tiled,
+                                         tile_size, tile_overlap))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 500
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=int(os.getenv('INFERENCE_PORT', 5001)), threaded=True)
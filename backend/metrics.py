@@ -0,0 +1,264 @@
+"""
+Métricas de la aplicación en formato Prometheus.
+
+Registra, por endpoint de Flask:
+    http_requests_total                 Peticiones por endpoint, método y código
+    http_request_duration_seconds       Histograma de latencia
+    http_request_mongo_commands         Histograma de comandos de Mongo por
+                                        petición (deja ver patrones N+1)
+    http_request_bytes_total            Bytes recibidos
+    http_response_bytes_total           Bytes enviados
+
+y para toda la aplicación:
+    mongo_commands_total                Comandos de Mongo por comando y colección
+    mongo_command_duration_seconds      Histograma de duración por comando
+    mongo_command_failures_total        Comandos fallidos
+    stage_duration_seconds              Tiempo en etapas costosas (decodificar
+                                        imágenes, inferencia, construir ZIPs)
+                                        medidas con timed()
+    inference_batch_size                Histograma de imágenes por lote de inferencia
+    inference_queue_seconds             Espera en la cola de inferencia
+
+Los comandos de Mongo se cuentan con un CommandListener de pymongo registrado
+globalmente (afecta a los MongoClient creados después de init_metrics).
+
+Con la cabecera X-Trace: 1 en la petición (o METRICS_TRACE=1) la respuesta
+incluye Server-Timing con el tiempo total, el de Mongo y el de cada etapa, y
+X-Mongo-Commands con el número de comandos. Las peticiones más lentas que
+SLOW_REQUEST_SECONDS se registran en el log con el mismo desglose.
+"""
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from flask import request, has_request_context
+
+# Métricas activas
+METRICS_ENABLED = os.getenv('METRICS', 'true').lower() in ('1', 'true', 'yes')
+
+# Añadir Server-Timing a todas las respuestas (sin necesidad de X-Trace)
+METRICS_TRACE = os.getenv('METRICS_TRACE', 'false').lower() in ('1', 'true', 'yes')
+
+# Token opcional para leer /metrics (Authorization: Bearer <token>)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Umbral para registrar una petición lenta en el log
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 1.0))
+
+# Límites de los histogramas
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+_HELP = {
+    'http_requests_total': ('counter', 'Peticiones HTTP por endpoint, método y código'),
+    'http_request_duration_seconds': ('histogram', 'Latencia de las peticiones HTTP'),
+    'http_request_mongo_commands': ('histogram', 'Comandos de MongoDB por petición'),
+    'http_request_bytes_total': ('counter', 'Bytes recibidos en el cuerpo de las peticiones'),
+    'http_response_bytes_total': ('counter', 'Bytes enviados en las respuestas'),
+    'mongo_commands_total': ('counter', 'Comandos de MongoDB por comando y colección'),
+    'mongo_command_duration_seconds': ('histogram', 'Duración de los comandos de MongoDB'),
+    'mongo_command_failures_total': ('counter', 'Comandos de MongoDB fallidos'),
+    'stage_duration_seconds': ('histogram', 'Tiempo en etapas costosas (decodificación, inferencia, ZIP)'),
+    'inference_batch_size': ('histogram', 'Imágenes por lote de inferencia'),
+    'inference_queue_seconds': ('histogram', 'Espera de una predicción en la cola hasta formar su lote'),
+}
+
+_counters = {}    # (nombre, etiquetas) -> valor
+_histograms = {}  # (nombre, etiquetas) -> {'buckets', 'counts', 'sum', 'count'}
+_guard = threading.Lock()
+
+# Desglose de la petición en curso (por hilo)
+_local = threading.local()
+
+def _labels(**labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name, value=1, **labels):
+    """Sumar a un contador"""
+    key = (name, _labels(**labels))
+    with _guard:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """Añadir una observación a un histograma"""
+    key = (name, _labels(**labels))
+    with _guard:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets),
+                                            'sum': 0.0, 'count': 0}
+        index = bisect.bisect_left(histogram['buckets'], value)
+        if index < len(histogram['counts']):
+            histogram['counts'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def _current_trace():
+    return getattr(_local, 'trace', None)
+
+@contextmanager
+def timed(stage):
+    """Medir una etapa costosa (image_decode, inference, zip_build...)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe('stage_duration_seconds', elapsed, stage=stage)
+        trace = _current_trace()
+        if trace is not None:
+            trace['stages'][stage] = trace['stages'].get(stage, 0.0) + elapsed
+
+# ==================== MONGO ====================
+
+def _command_listener():
+    from pymongo import monitoring
+
+    started = {}  # request_id -> (comando, colección)
+
+    def record(event, failed=False):
+        command, collection = started.pop((event.connection_id, event.request_id), (event.command_name, ''))
+        elapsed = event.duration_micros / 1e6
+        inc('mongo_commands_total', command=command, collection=collection)
+        observe('mongo_command_duration_seconds', elapsed, command=command)
+        if failed:
+            inc('mongo_command_failures_total', command=command)
+        trace = _current_trace()
+        if trace is not None:
+            trace['mongo_commands'] += 1
+            trace['mongo_seconds'] += elapsed
+
+    class Listener(monitoring.CommandListener):
+        def started(self, event):
+            # El nombre de la colección es el valor del propio comando (find: 'images', ...)
+            collection = event.command.get(event.command_name)
+            if not isinstance(collection, str):
+                collection = ''
+            started[(event.connection_id, event.request_id)] = (event.command_name, collection)
+
+        def succeeded(self, event):
+            record(event)
+
+        def failed(self, event):
+            record(event, failed=True)
+
+    return Listener()
+
+# ==================== FLASK ====================
+
+def _endpoint():
+    return request.endpoint or 'not_found'
+
+def _before_request():
+    _local.trace = {'start': time.perf_counter(), 'mongo_commands': 0, 'mongo_seconds': 0.0,
+                    'stages': {}}
+
+def _counting_iterable(iterable, endpoint):
+    # Respuestas en streaming: contar los bytes según se envían
+    sent = 0
+    try:
+        for chunk in iterable:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        inc('http_response_bytes_total', sent, endpoint=endpoint)
+        close = getattr(iterable, 'close', None)
+        if close:
+            close()
+
+def _after_request(response):
+    trace = _current_trace()
+    _local.trace = None
+    if trace is None:
+        return response
+    endpoint = _endpoint()
+    elapsed = time.perf_counter() - trace['start']
+    status = response.status_code
+
+    inc('http_requests_total', endpoint=endpoint, method=request.method, status=status)
+    observe('http_request_duration_seconds', elapsed, endpoint=endpoint, method=request.method)
+    observe('http_request_mongo_commands', trace['mongo_commands'], buckets=COMMAND_COUNT_BUCKETS,
+            endpoint=endpoint)
+    inc('http_request_bytes_total', request.content_length or 0, endpoint=endpoint)
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = _counting_iterable(response.response, endpoint)
+    else:
+        inc('http_response_bytes_total', response.calculate_content_length() or 0, endpoint=endpoint)
+
+    timings = [f'total;dur={elapsed * 1000:.1f}',
+               f'mongo;dur={trace["mongo_seconds"] * 1000:.1f};desc="{trace["mongo_commands"]} comandos"']
+    timings += [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in trace['stages'].items()]
+    if METRICS_TRACE or request.headers.get('X-Trace', '').lower() in ('1', 'true', 'yes'):
+        response.headers['Server-Timing'] = ', '.join(timings)
+        response.headers['X-Mongo-Commands'] = str(trace['mongo_commands'])
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        print(f"Petición lenta: {request.method} {request.path} ({endpoint}) {status} - {', '.join(timings)}")
+    return response
+
+def init_metrics(app):
+    """Registrar el CommandListener de Mongo y los hooks de Flask"""
+    if not METRICS_ENABLED:
+        return
+    from pymongo import monitoring
+
+    monitoring.register(_command_listener())
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+# ==================== EXPOSICIÓN ====================
+
+def metrics_authorized(required=False):
+    """
+    Comprobar METRICS_TOKEN si está configurado
+
+    Args:
+        required: Sin METRICS_TOKEN no se autoriza (endpoints con detalles internos)
+    """
+    if not METRICS_TOKEN:
+        return not required
+    if not has_request_context():
+        return True
+    return request.headers.get('Authorization', '') == f'Bearer {METRICS_TOKEN}'
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_metrics():
+    """Texto en el formato de exposición de Prometheus (text/plain; version=0.0.4)"""
+    with _guard:
+        counters = dict(_counters)
+        histograms = {key: dict(value, counts=list(value['counts'])) for key, value in _histograms.items()}
+
+    lines = []
+    for name, (metric_type, help_text) in _HELP.items():
+        if metric_type == 'counter':
+            series = sorted((labels, value) for (metric, labels), value in counters.items() if metric == name)
+        else:
+            series = sorted((labels, value) for (metric, labels), value in histograms.items()
+                            if metric == name)
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in series:
+            if metric_type == 'counter':
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(value['buckets'], value['counts']):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", str(bound))])} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {value["count"]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value["sum"])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,362 @@
+"""
+Detección de imágenes casi duplicadas por hash perceptual.
+
+Para cada imagen se calculan dos hashes de 64 bits a partir de una miniatura
+en escala de grises: pHash (signo de los coeficientes de baja frecuencia de
+la DCT respecto a su mediana) y dHash (gradiente horizontal). Las miniaturas
+de un lote se procesan juntas con NumPy: la DCT de todo el lote es un único
+producto de matrices.
+
+Los hashes se guardan en los documentos de imagen ('phash', 'dhash') y los
+grupos se obtienen con un índice multi-hash sobre pHash (búsqueda por
+distancia de Hamming sin comparar todos los pares); cada candidato se
+confirma con dHash.
+"""
+import io
+import os
+import base64
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+from pymongo import UpdateOne
+
+from image_dedup import image_data_base64
+
+# Lado del hash (8x8 = 64 bits) y de la miniatura sobre la que se calcula la DCT
+HASH_SIZE = 8
+PHASH_IMAGE_SIZE = 32
+
+# Imágenes por lote (miniaturas en memoria y escrituras en MongoDB)
+HASH_BATCH_SIZE = 256
+
+# Distancia de Hamming máxima (en bits) para considerar dos imágenes casi iguales
+DEFAULT_NEAR_DUPLICATE_THRESHOLD = 6
+
+# ==================== HASHES PERCEPTUALES ====================
+
+def _dct_matrix(n):
+    """Matriz de la DCT-II ortonormal de tamaño n"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+_DCT = _dct_matrix(PHASH_IMAGE_SIZE)
+
+def load_thumbnails(source):
+    """
+    Miniaturas en escala de grises para pHash (32x32) y dHash (9x8)
+
+    Args:
+        source: Ruta del archivo o bytes de la imagen
+    """
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+        # En JPEG el decodificador reduce la imagen al leerla (mucho más rápido)
+        img.draft('L', (PHASH_IMAGE_SIZE * 2, PHASH_IMAGE_SIZE * 2))
+        gray = img.convert('L')
+    phash_thumb = gray.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.BILINEAR)
+    dhash_thumb = gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    return np.asarray(phash_thumb, dtype=np.float32), np.asarray(dhash_thumb, dtype=np.float32)
+
+def _pack_hashes(bits):
+    """Matriz (N, 64) de booleanos a lista de enteros de 64 bits"""
+    packed = np.packbits(bits.astype(np.uint8), axis=1)
+    return [int(value) for value in packed.view('>u8').ravel()]
+
+def phash_batch(thumbnails):
+    """pHash de un lote de miniaturas (N, 32, 32)"""
+    coefficients = _DCT @ thumbnails @ _DCT.T
+    low = coefficients[:, :HASH_SIZE, :HASH_SIZE].reshape(len(thumbnails), -1)
+    # La mediana excluye el término de continua (brillo medio)
+    median = np.median(low[:, 1:], axis=1)
+    return _pack_hashes(low > median[:, None])
+
+def dhash_batch(thumbnails):
+    """dHash de un lote de miniaturas (N, 8, 9)"""
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    return _pack_hashes(bits.reshape(len(thumbnails), -1))
+
+def compute_hashes(sources):
+    """
+    Calcular pHash y dHash de un lote de imágenes
+
+    Returns:
+        Lista alineada con sources de tuplas (phash, dhash) o None si la
+        imagen no se pudo leer
+    """
+    phash_thumbs, dhash_thumbs, positions = [], [], []
+    for position, source in enumerate(sources):
+        try:
+            phash_thumb, dhash_thumb = load_thumbnails(source)
+        except Exception:
+            continue
+        phash_thumbs.append(phash_thumb)
+        dhash_thumbs.append(dhash_thumb)
+        positions.append(position)
+
+    results = [None] * len(sources)
+    if positions:
+        phashes = phash_batch(np.stack(phash_thumbs))
+        dhashes = dhash_batch(np.stack(dhash_thumbs))
+        for position, phash, dhash in zip(positions, phashes, dhashes):
+            results[position] = (phash, dhash)
+    return results
+
+def hash_to_hex(value):
+    return f'{value:016x}'
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+# ==================== ÍNDICE MULTI-HASH ====================
+
+def _chunk_ranges(radius, bits=HASH_SIZE * HASH_SIZE):
+    """Rangos de bits de los radius + 1 fragmentos en que se divide el hash"""
+    chunks = min(radius + 1, bits)
+    edges = [round(bits * i / chunks) for i in range(chunks + 1)]
+    return [(edges[i], edges[i + 1] - edges[i]) for i in range(chunks)]
+
+def build_hash_index(items, radius):
+    """
+    Índice multi-hash para búsquedas por distancia de Hamming <= radius.
+
+    El hash se divide en radius + 1 fragmentos: si dos hashes difieren en
+    radius bits o menos, por el principio del palomar al menos un fragmento
+    coincide exactamente, así que basta con buscar en una tabla por fragmento
+    y verificar los candidatos.
+
+    Args:
+        items: Iterable de (hash, id)
+
+    Returns:
+        Dict con los rangos de fragmentos, una tabla por fragmento y los hashes
+    """
+    ranges = _chunk_ranges(radius)
+    tables = [{} for _ in ranges]
+    values = {}
+    for value, item_id in items:
+        values[item_id] = value
+        for table, (shift, width) in zip(tables, ranges):
+            table.setdefault((value >> shift) & ((1 << width) - 1), []).append(item_id)
+    return {'radius': radius, 'ranges': ranges, 'tables': tables, 'values': values}
+
+def search_hash_index(index, value, radius=None):
+    """Elementos a distancia <= radius (por defecto el del índice): lista de (id, distancia)"""
+    radius = index['radius'] if radius is None else min(radius, index['radius'])
+    values = index['values']
+    candidates = set()
+    for table, (shift, width) in zip(index['tables'], index['ranges']):
+        candidates.update(table.get((value >> shift) & ((1 << width) - 1), ()))
+    found = []
+    for item_id in candidates:
+        distance = hamming_distance(value, values[item_id])
+        if distance <= radius:
+            found.append((item_id, distance))
+    return found
+
+# ==================== GRUPOS ====================
+
+def near_duplicate_clusters(images, threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD):
+    """
+    Agrupar imágenes casi iguales (componentes conexas de pares con pHash y
+    dHash a distancia <= threshold)
+
+    Args:
+        images: Documentos de imagen con 'phash' y 'dhash' en hexadecimal
+
+    Returns:
+        Lista de grupos (listas de documentos) con más de una imagen, del más
+        grande al más pequeño, cada uno en el orden de images
+    """
+    hashed = [(index, int(img['phash'], 16), int(img['dhash'], 16))
+              for index, img in enumerate(images) if img.get('phash') and img.get('dhash')]
+    dhashes = {index: dhash for index, _, dhash in hashed}
+    hash_index = build_hash_index(((phash, index) for index, phash, _ in hashed), threshold)
+
+    parent = {index: index for index, _, _ in hashed}
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for index, phash, dhash in hashed:
+        for other, _ in search_hash_index(hash_index, phash):
+            if other != index and hamming_distance(dhash, dhashes[other]) <= threshold:
+                root_a, root_b = find(index), find(other)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    groups = {}
+    for index, _, _ in hashed:
+        groups.setdefault(find(index), []).append(images[index])
+    clusters = [group for group in groups.values() if len(group) > 1]
+    clusters.sort(key=len, reverse=True)
+    return clusters
+
+def cluster_representative(cluster, annotation_counts=None):
+    """Imagen que se conserva de un grupo: la más anotada y, a igualdad, la primera"""
+    annotation_counts = annotation_counts or {}
+    return max(cluster, key=lambda img: annotation_counts.get(str(img['_id']), 0))
+
+def near_duplicate_exclusions(images, threshold, annotation_counts=None):
+    """Ids de las imágenes redundantes (todas menos el representante de cada grupo)"""
+    excluded = set()
+    for cluster in near_duplicate_clusters(images, threshold):
+        keep = cluster_representative(cluster, annotation_counts)
+        excluded.update(str(img['_id']) for img in cluster if img is not keep)
+    return excluded
+
+# ==================== CÁLCULO POR DATASET ====================
+
+def _image_source(db, img, image_folder):
+    """Archivo en disco o, si no existe, el contenido guardado en MongoDB"""
+    if img.get('file_path'):
+        path = os.path.join(image_folder, img['file_path'])
+        if os.path.isfile(path):
+            return path
+    full_doc = db.images.find_one({'_id': img['_id']}, {'data': 1, 'blob_id': 1})
+    data = image_data_base64(db, full_doc or {})
+    return base64.b64decode(data) if data else None
+
+def compute_dataset_hashes(db, dataset_id, image_folder, progress=None):
+    """
+    Calcular los hashes perceptuales de las imágenes del dataset que aún no los tienen
+
+    Args:
+        progress: Función opcional (procesadas, total) llamada tras cada lote
+
+    Returns:
+        Dict con 'hashed' y 'failed'
+    """
+    query = {'dataset_id': dataset_id, 'phash': {'$exists': False}}
+    pending = list(db.images.find(query, {'file_path': 1}))
+    total = len(pending)
+    hashed = failed = 0
+
+    for start in range(0, total, HASH_BATCH_SIZE):
+        batch = pending[start:start + HASH_BATCH_SIZE]
+        sources = [_image_source(db, img, image_folder) for img in batch]
+        results = compute_hashes([source for source in sources if source is not None])
+        results_iter = iter(results)
+
+        operations = []
+        for img, source in zip(batch, sources):
+            result = next(results_iter) if source is not None else None
+            if result is None:
+                # No se reintenta en cada cálculo: se marca como fallida
+                operations.append(UpdateOne({'_id': img['_id']}, {'$set': {'phash': None, 'dhash': None}}))
+                failed += 1
+                continue
+            operations.append(UpdateOne({'_id': img['_id']}, {'$set': {
+                'phash': hash_to_hex(result[0]),
+                'dhash': hash_to_hex(result[1])
+            }}))
+            hashed += 1
+        if operations:
+            db.images.bulk_write(operations, ordered=False)
+        if progress:
+            progress(min(start + HASH_BATCH_SIZE, total), total)
+
+    return {'hashed': hashed, 'failed': failed}
+
+def find_dataset_clusters(db, dataset_id, threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD):
+    """
+    Grupos de imágenes casi duplicadas de un dataset con los hashes ya calculados
+
+    Returns:
+        Tupla (grupos serializables, imágenes con hash, imágenes sin hash)
+    """
+    images = list(db.images.find(
+        {'dataset_id': dataset_id},
+        {'filename': 1, 'phash': 1, 'dhash': 1, 'video_id': 1, 'frame_number': 1}
+    ).sort('_id', 1))
+    hashed = [img for img in images if img.get('phash')]
+    missing = sum(1 for img in images if 'phash' not in img)
+
+    annotation_counts = {row['_id']: row['count'] for row in db.annotations.aggregate([
+        {'$match': {'image_id': {'$in': [str(img['_id']) for img in hashed]}}},
+        {'$group': {'_id': '$image_id', 'count': {'$sum': 1}}}
+    ])} if hashed else {}
+
+    clusters = []
+    for cluster in near_duplicate_clusters(hashed, threshold):
+        keep = cluster_representative(cluster, annotation_counts)
+        keep_phash = int(keep['phash'], 16)
+        clusters.append({
+            'representative': str(keep['_id']),
+            'size': len(cluster),
+            'images': [{
+                'id': str(img['_id']),
+                'filename': img.get('filename'),
+                'video_id': img.get('video_id'),
+                'frame_number': img.get('frame_number'),
+                'distance': hamming_distance(keep_phash, int(img['phash'], 16)),
+                'annotations': annotation_counts.get(str(img['_id']), 0)
+            } for img in cluster]
+        })
+    return clusters, len(hashed), missing
+
+# ==================== TRABAJO EN SEGUNDO PLANO ====================
+
+_hash_jobs = {}
+_hash_jobs_guard = threading.Lock()
+
+def hash_job_status(dataset_id):
+    """Estado del último cálculo de hashes del dataset (None si no se ha lanzado)"""
+    with _hash_jobs_guard:
+        job = _hash_jobs.get(str(dataset_id))
+        return dict(job) if job else None
+
+def start_hash_job(get_db, dataset_id, image_folder, on_finish=None, on_update=None):
+    """
+    Lanzar el cálculo de hashes de un dataset en un hilo (uno por dataset)
+
+    Args:
+        get_db: Función que devuelve una conexión a la base de datos
+        on_finish: Función opcional (db, dataset_id, resultado) al terminar
+        on_update: Función opcional (estado del trabajo) tras cada lote y al terminar
+
+    Returns:
+        Estado del trabajo
+    """
+    dataset_id = str(dataset_id)
+    with _hash_jobs_guard:
+        job = _hash_jobs.get(dataset_id)
+        if job and job['state'] == 'running':
+            return dict(job)
+        job = {'state': 'running', 'processed': 0, 'total': None,
+               'started_at': time.time(), 'finished_at': None, 'result': None, 'error': None}
+        _hash_jobs[dataset_id] = job
+
+    def notify():
+        if on_update:
+            on_update(hash_job_status(dataset_id))
+
+    def progress(processed, total):
+        with _hash_jobs_guard:
+            job['processed'], job['total'] = processed, total
+        notify()
+
+    def run():
+        try:
+            db = get_db()
+            result = compute_dataset_hashes(db, dataset_id, image_folder, progress)
+            if on_finish:
+                on_finish(db, dataset_id, result)
+            with _hash_jobs_guard:
+                job.update(state='done', result=result, finished_at=time.time())
+            print(f"Hashes perceptuales del dataset {dataset_id}: {result['hashed']} calculados, "
+                  f"{result['failed']} fallidos")
+        except Exception as e:
+            print(f"Error calculando hashes perceptuales del dataset {dataset_id}: {e}")
+            with _hash_jobs_guard:
+                job.update(state='error', error=str(e), finished_at=time.time())
+        notify()
+
+    threading.Thread(target=run, daemon=True).start()
+    return hash_job_status(dataset_id)
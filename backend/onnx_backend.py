@@ -0,0 +1,160 @@
+"""
+Ejecución de modelos con ONNX Runtime en CPU.
+
+En nodos sin GPU, ONNX Runtime ejecuta los modelos YOLO bastante más rápido
+que PyTorch. El modelo guardado (.pt de ultralytics o .torchscript) se
+convierte una sola vez a ONNX y el resultado se guarda junto al original
+(modelo.pt -> modelo.onnx); las cargas siguientes lo reutilizan mientras sea
+más reciente que el original.
+
+INFERENCE_RUNTIME elige el motor al cargar un modelo (ver inference):
+    torch   PyTorch / ultralytics (por defecto)
+    onnx    ONNX Runtime; si la conversión o la carga fallan, PyTorch
+    auto    ONNX Runtime si no hay GPU disponible para PyTorch
+
+La salida de los modelos exportados es la de YOLOv8/11 ([lote, 4 + clases,
+anclas], cajas en la escala de entrada); el preprocesado y la decodificación
+son los mismos que en TorchScript (ver yolo_ops).
+"""
+import os
+import ast
+import threading
+
+from yolo_ops import preprocess, decode
+
+INFERENCE_RUNTIME = os.getenv('INFERENCE_RUNTIME', 'torch').lower()
+
+# Hilos de ONNX Runtime por inferencia (0: tantos como CPUs disponibles)
+ONNX_THREADS = int(os.getenv('ONNX_THREADS', 0))
+
+# Mantener los hilos en espera activa entre inferencias: menos latencia a
+# costa de ocupar CPU mientras el servicio está ocioso
+ONNX_SPIN = os.getenv('ONNX_SPIN', 'false').lower() in ('1', 'true', 'yes')
+
+# Tamaño de entrada con el que se exportan los modelos
+ONNX_INPUT_SIZE = 640
+
+# Opset de la exportación de modelos TorchScript
+ONNX_OPSET = 17
+
+_export_guard = threading.Lock()
+
+def use_onnx():
+    """Si los modelos se deben cargar con ONNX Runtime según INFERENCE_RUNTIME"""
+    if INFERENCE_RUNTIME == 'onnx':
+        return True
+    if INFERENCE_RUNTIME == 'auto':
+        try:
+            import torch
+            return not torch.cuda.is_available()
+        except ImportError:
+            return True
+    return False
+
+def onnx_path_for(model_path):
+    """Ruta del modelo convertido, junto al original"""
+    return os.path.splitext(model_path)[0] + '.onnx'
+
+def _cpu_count():
+    try:
+        # CPUs asignadas al proceso (límites del contenedor), no las de la máquina
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _export_torchscript(model_path, target):
+    import torch
+
+    model = torch.jit.load(model_path, map_location='cpu')
+    model.eval()
+    dummy = torch.zeros(1, 3, ONNX_INPUT_SIZE, ONNX_INPUT_SIZE)
+    torch.onnx.export(model, dummy, target, input_names=['images'], output_names=['output0'],
+                      dynamic_axes={'images': {0: 'batch'}, 'output0': {0: 'batch'}},
+                      opset_version=ONNX_OPSET)
+
+def _export_ultralytics(model_path, target):
+    from ultralytics import YOLO
+
+    # ultralytics escribe el .onnx junto al .pt; lote dinámico para el micro-batching y
+    # sin simplify (necesita onnxslim; ONNX Runtime ya optimiza el grafo al cargarlo)
+    exported = YOLO(model_path).export(format='onnx', imgsz=ONNX_INPUT_SIZE, dynamic=True, simplify=False,
+                                       verbose=False)
+    if os.path.abspath(str(exported)) != os.path.abspath(target):
+        os.replace(str(exported), target)
+
+def export_onnx(model_path):
+    """
+    Convertir un modelo a ONNX, o reutilizar la conversión guardada
+
+    Returns:
+        Ruta del archivo .onnx
+
+    Raises:
+        RuntimeError si no se puede convertir
+    """
+    if model_path.endswith('.onnx'):
+        return model_path
+    target = onnx_path_for(model_path)
+    with _export_guard:
+        if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(model_path):
+            return target
+        if not os.access(os.path.dirname(target) or '.', os.W_OK):
+            raise RuntimeError(f'Sin permiso de escritura para guardar {target}')
+        print(f"Convirtiendo {model_path} a ONNX...")
+        try:
+            if model_path.endswith('.torchscript'):
+                _export_torchscript(model_path, target)
+            else:
+                _export_ultralytics(model_path, target)
+        except Exception as e:
+            # No dejar una conversión a medias que parezca válida en la próxima carga
+            if os.path.exists(target):
+                os.remove(target)
+            raise RuntimeError(f'Error al convertir a ONNX: {str(e)}')
+        print(f"Modelo ONNX guardado en: {target}")
+    return target
+
+def load_session(onnx_path):
+    """Sesión de ONNX Runtime en CPU con los hilos ajustados"""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # Un solo hilo del planificador ejecuta el modelo (ver inference): todos los
+    # hilos para las operaciones y ninguno extra entre operaciones
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = ONNX_THREADS or _cpu_count()
+    options.inter_op_num_threads = 1
+    options.add_session_config_entry('session.intra_op.allow_spinning', '1' if ONNX_SPIN else '0')
+    session = ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+    print(f"Modelo ONNX cargado en CPU con {options.intra_op_num_threads} hilos: {onnx_path}")
+    return session
+
+def class_names(session):
+    """Nombres de clase guardados por ultralytics en los metadatos del modelo (o lista vacía)"""
+    try:
+        names = session.get_modelmeta().custom_metadata_map.get('names')
+        if names:
+            names = ast.literal_eval(names)
+            return list(names.values()) if isinstance(names, dict) else list(names)
+    except Exception as e:
+        print(f"Error al obtener categorías del modelo ONNX: {e}")
+    return []
+
+def supports_batches(session):
+    """Falso si el modelo se exportó con un tamaño de lote fijo de 1"""
+    return session.get_inputs()[0].shape[0] != 1
+
+def input_size(session):
+    """(ancho, alto) de entrada del modelo"""
+    shape = session.get_inputs()[0].shape  # [lote, 3, alto, ancho], con dimensiones dinámicas como texto
+    height = shape[2] if isinstance(shape[2], int) else ONNX_INPUT_SIZE
+    width = shape[3] if isinstance(shape[3], int) else ONNX_INPUT_SIZE
+    return width, height
+
+def run(session, images, confidences, iou_threshold, num_classes=None):
+    """Detecciones de cada imagen (PIL en RGB) de un lote"""
+    batch, letterboxes = preprocess(images, input_size(session))
+    predictions = session.run(None, {session.get_inputs()[0].name: batch})[0]
+    return [decode(predictions[i], confidence, letterbox, image.size, iou_threshold, num_classes)
+            for i, (image, confidence, letterbox) in enumerate(zip(images, confidences, letterboxes))]
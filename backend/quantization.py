@@ -0,0 +1,232 @@
+"""
+Variantes cuantizadas (INT8) de los modelos guardados.
+
+A partir del modelo convertido a ONNX (ver onnx_backend) genera con ONNX
+Runtime una variante INT8 que se guarda junto al original
+(modelo.pt -> modelo.int8.onnx):
+
+    dynamic   Pesos en INT8 y activaciones cuantizadas al vuelo; no necesita
+              imágenes de calibración
+    static    Pesos y activaciones en INT8 (formato QDQ) con los rangos de las
+              activaciones calibrados sobre imágenes de un dataset; suele ser
+              la más rápida en CPU
+
+La cuantización cambia las detecciones, así que evaluate() mide la
+precisión del modelo original (el ONNX en FP32) y de la variante frente a las
+anotaciones manuales de un dataset: precisión y exhaustividad con la
+confianza indicada, y mAP@0.5 emparejando por nombre de categoría.
+"""
+import os
+import time
+
+import onnx_backend
+from inference import NMS_IOU_THRESHOLD
+from yolo_ops import preprocess
+
+QUANTIZATION_METHODS = ('dynamic', 'static')
+
+# Nombre de la variante en el registro de modelos (ai_models.variants)
+INT8_VARIANT = 'int8'
+
+# Imágenes del dataset que se usan por defecto para calibrar y para evaluar
+CALIBRATION_IMAGES = int(os.getenv('QUANTIZATION_CALIBRATION_IMAGES', 64))
+EVALUATION_IMAGES = int(os.getenv('QUANTIZATION_EVALUATION_IMAGES', 100))
+
+# IoU mínimo para que una detección cuente como acierto
+EVALUATION_IOU = 0.5
+
+# Confianza mínima de las detecciones para calcular el mAP
+EVALUATION_MIN_CONFIDENCE = 0.01
+
+def quantized_path_for(model_path):
+    """Ruta de la variante INT8, junto al original"""
+    return os.path.splitext(model_path)[0] + '.int8.onnx'
+
+def _calibration_reader(session, images):
+    from onnxruntime.quantization import CalibrationDataReader
+
+    input_name = session.get_inputs()[0].name
+    input_size = onnx_backend.input_size(session)
+
+    class Reader(CalibrationDataReader):
+        """Una imagen por lote, preprocesada igual que en las predicciones"""
+        def __init__(self):
+            self.pending = iter(images)
+
+        def get_next(self):
+            image = next(self.pending, None)
+            if image is None:
+                return None
+            return {input_name: preprocess([image], input_size)[0]}
+
+    return Reader()
+
+def _head_nodes(onnx_path):
+    """
+    Nodos entre la última convolución y las salidas (decodificación de cajas
+    y clases). En YOLO la salida concatena coordenadas en píxeles y
+    probabilidades: con una sola escala INT8 las probabilidades se pierden,
+    así que estos nodos se dejan en FP32.
+    """
+    import onnx
+
+    graph = onnx.load(onnx_path, load_external_data=False).graph
+    producers = {output: node for node in graph.node for output in node.output}
+    pending = [output.name for output in graph.output]
+    seen, head = set(), []
+    while pending:
+        node = producers.get(pending.pop())
+        if node is None or id(node) in seen or node.op_type == 'Conv':
+            continue
+        seen.add(id(node))
+        if node.name:
+            head.append(node.name)
+        pending.extend(node.input)
+    return head
+
+def quantize(model_path, method='dynamic', calibration_images=None):
+    """
+    Generar la variante INT8 de un modelo guardado
+
+    Args:
+        model_path: Modelo guardado (.pt, .torchscript u .onnx)
+        method: 'dynamic' o 'static'
+        calibration_images: Iterable de imágenes PIL en RGB para calibrar (solo static;
+            se recorre una vez, así que puede ser un generador)
+
+    Returns:
+        Ruta de la variante
+
+    Raises:
+        ValueError si el método o la calibración no son válidos
+        RuntimeError si la conversión o la cuantización fallan
+    """
+    if method not in QUANTIZATION_METHODS:
+        raise ValueError(f'Método de cuantización no válido: {method}')
+    if method == 'static' and calibration_images is None:
+        raise ValueError('La cuantización estática necesita imágenes de calibración')
+
+    source = onnx_backend.export_onnx(model_path)
+    target = quantized_path_for(model_path)
+    print(f"Cuantizando {source} ({method})...")
+    try:
+        from onnxruntime.quantization import quantize_dynamic, quantize_static, QuantFormat, QuantType
+
+        if method == 'static':
+            reader = _calibration_reader(onnx_backend.load_session(source), calibration_images)
+            quantize_static(source, target, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                            nodes_to_exclude=_head_nodes(source))
+        else:
+            # ConvInteger (las convoluciones cuantizadas al vuelo) solo admite pesos sin signo
+            quantize_dynamic(source, target, weight_type=QuantType.QUInt8)
+    except Exception as e:
+        if os.path.exists(target):
+            os.remove(target)
+        raise RuntimeError(f'Error al cuantizar el modelo: {str(e)}')
+    print(f"Variante INT8 guardada en: {target}")
+    return target
+
+# ==================== EVALUACIÓN ====================
+
+def _iou(box, other):
+    """IoU de dos cajas [x, y, ancho, alto]"""
+    inter_w = min(box[0] + box[2], other[0] + other[2]) - max(box[0], other[0])
+    inter_h = min(box[1] + box[3], other[1] + other[3]) - max(box[1], other[1])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    return inter / (box[2] * box[3] + other[2] * other[3] - inter)
+
+def _match(detections, ground_truth):
+    """
+    Emparejar las detecciones de una imagen con sus anotaciones por categoría
+
+    Returns:
+        Lista de (categoría, confianza, acierto) de cada detección
+    """
+    matched = set()
+    scored = []
+    for detection in sorted(detections, key=lambda d: d['confidence'], reverse=True):
+        best, best_iou = None, EVALUATION_IOU
+        for index, (category, bbox) in enumerate(ground_truth):
+            if index in matched or category != detection['category']:
+                continue
+            iou = _iou(detection['bbox'], bbox)
+            if iou >= best_iou:
+                best, best_iou = index, iou
+        if best is not None:
+            matched.add(best)
+        scored.append((detection['category'], detection['confidence'], best is not None))
+    return scored
+
+def _average_precision(scored, total_ground_truth):
+    """Área bajo la curva de precisión-exhaustividad (interpolada en todos los puntos)"""
+    if not total_ground_truth:
+        return None
+    hits = [hit for _, hit in sorted(scored, key=lambda item: item[0], reverse=True)]
+    precisions, recalls = [], []
+    true_positives = 0
+    for rank, hit in enumerate(hits, start=1):
+        true_positives += hit
+        precisions.append(true_positives / rank)
+        recalls.append(true_positives / total_ground_truth)
+    # Envolvente de la precisión de derecha a izquierda
+    for index in range(len(precisions) - 2, -1, -1):
+        precisions[index] = max(precisions[index], precisions[index + 1])
+    area, previous_recall = 0.0, 0.0
+    for precision, recall in zip(precisions, recalls):
+        area += (recall - previous_recall) * precision
+        previous_recall = recall
+    return area
+
+def evaluate(session, samples, categories, confidence=0.25):
+    """
+    Precisión de un modelo ONNX frente a las anotaciones de unas imágenes
+
+    Args:
+        session: Sesión de onnx_backend.load_session
+        samples: Iterable de (imagen PIL en RGB, [(categoría, [x, y, ancho, alto]), ...])
+        categories: Nombres de las clases del modelo, por índice
+        confidence: Confianza para la precisión y la exhaustividad
+
+    Returns:
+        Dict con precision, recall, map50, images, detections y mean_latency_ms
+    """
+    num_classes = len(onnx_backend.class_names(session)) or None
+    scored_by_category = {}
+    ground_truth_by_category = {}
+    images = 0
+    elapsed = 0.0
+    for image, ground_truth in samples:
+        start = time.perf_counter()
+        raw = onnx_backend.run(session, [image], [EVALUATION_MIN_CONFIDENCE], NMS_IOU_THRESHOLD,
+                               num_classes)[0]
+        elapsed += time.perf_counter() - start
+        images += 1
+        detections = [dict(detection, category=categories[detection['class']]) for detection in raw
+                      if detection['class'] < len(categories)]
+        for category, _ in ground_truth:
+            ground_truth_by_category[category] = ground_truth_by_category.get(category, 0) + 1
+        for category, score, hit in _match(detections, ground_truth):
+            scored_by_category.setdefault(category, []).append((score, hit))
+
+    total_ground_truth = sum(ground_truth_by_category.values())
+    above = [hit for scored in scored_by_category.values() for score, hit in scored if score >= confidence]
+    true_positives = sum(above)
+    average_precisions = [_average_precision(scored_by_category.get(category, []), count)
+                          for category, count in ground_truth_by_category.items()]
+    return {
+        'precision': round(true_positives / len(above), 4) if above else None,
+        'recall': round(true_positives / total_ground_truth, 4) if total_ground_truth else None,
+        'map50': round(sum(average_precisions) / len(average_precisions), 4) if average_precisions else None,
+        'images': images,
+        'detections': len(above),
+        'mean_latency_ms': round(elapsed * 1000 / images, 2) if images else None
+    }
+
+def accuracy_delta(original, quantized):
+    """Diferencia (variante - original) de cada métrica de evaluate()"""
+    return {key: round(quantized[key] - original[key], 4)
+            for key in ('precision', 'recall', 'map50', 'mean_latency_ms')
+            if original.get(key) is not None and quantized.get(key) is not None}
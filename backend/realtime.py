@@ -0,0 +1,186 @@
+"""
+Notificaciones en tiempo real con Socket.IO (flask-socketio).
+
+Los clientes se conectan a /api/socket.io con su token JWT (auth={'token': ...}
+o ?token=...) y reciben dos tipos de eventos:
+
+    job_progress    Progreso de las tareas largas del usuario (importación de
+                    ZIP, extracción de frames, reprocesado de carpetas, hashes
+                    perceptuales, predicciones):
+                    {job_id, type, state, processed, total, message, result}
+                    con state 'running', 'done' o 'error'.
+
+    dataset_change  Cambios en los datasets a los que el cliente se ha
+                    suscrito con el evento 'subscribe_dataset' ({dataset_id}):
+                    {dataset_id, type, ...} con type annotation_created,
+                    annotation_updated, annotation_deleted, annotations_deleted,
+                    category_created, category_updated, category_deleted,
+                    annotations_created, images_added, image_deleted,
+                    video_added, video_deleted, dataset_synced o
+                    annotations_imported, y los datos del elemento afectado.
+
+Las peticiones HTTP pueden enviar X-Job-Id (o el campo job_id del formulario)
+para reconocer el progreso de su tarea, y X-Socket-Id (el socket.id del
+cliente) para no recibir el eco de los cambios que acaba de hacer.
+
+Con varios workers de la API (ver inference_server) los eventos se reparten
+entre procesos con SOCKETIO_MESSAGE_QUEUE (p. ej. redis://redis:6379/0) y
+los clientes deben conectarse solo por WebSocket (transports: ['websocket']),
+ya que el sondeo HTTP necesita que todas sus peticiones lleguen al mismo worker.
+
+Sin flask-socketio (o con REALTIME=0) las funciones de publicación no hacen nada.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from datetime import date
+
+from flask import request, has_request_context
+from werkzeug.http import http_date
+
+# Canal de notificaciones activo
+REALTIME_ENABLED = os.getenv('REALTIME', 'true').lower() in ('1', 'true', 'yes')
+
+# Ruta del servidor Socket.IO (bajo /api para pasar por el mismo proxy)
+SOCKETIO_PATH = 'api/socket.io'
+
+# Cola de mensajes para emitir desde cualquier worker (Redis, Kafka... ver flask-socketio)
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+
+# Intervalo mínimo entre dos eventos de progreso de una misma tarea
+PROGRESS_INTERVAL = float(os.getenv('REALTIME_PROGRESS_INTERVAL', 0.5))  # segundos
+
+_state = {'socketio': None}
+_connections = {}  # sid -> user_id
+_last_progress = {}  # job_id -> momento del último evento
+_guard = threading.Lock()
+
+def init_realtime(app, authenticate, can_access_dataset):
+    """
+    Crear el servidor Socket.IO sobre la aplicación
+
+    Args:
+        authenticate: Función (token) -> user_id o None
+        can_access_dataset: Función (user_id, dataset_id) -> bool
+
+    Returns:
+        Instancia de SocketIO o None si está desactivado
+    """
+    if not REALTIME_ENABLED:
+        return None
+    try:
+        from flask_socketio import SocketIO, join_room, leave_room
+    except ImportError:
+        print("AVISO: flask-socketio no está instalado, notificaciones en tiempo real desactivadas")
+        return None
+
+    try:
+        socketio = SocketIO(app, path=SOCKETIO_PATH, async_mode='threading', cors_allowed_origins='*',
+                            message_queue=SOCKETIO_MESSAGE_QUEUE)
+    except Exception as e:
+        # Cola configurada sin su cliente instalado (p. ej. redis) o no accesible
+        print(f"AVISO: no se pudo usar la cola {SOCKETIO_MESSAGE_QUEUE}: {e}, notificaciones desactivadas")
+        return None
+
+    def on_connect(auth=None):
+        token = (auth or {}).get('token') or request.args.get('token')
+        user_id = authenticate(token) if token else None
+        if not user_id:
+            # Rechazar la conexión
+            return False
+        with _guard:
+            _connections[request.sid] = str(user_id)
+        join_room(f'user:{user_id}')
+        return True
+
+    def on_disconnect(*args):
+        with _guard:
+            _connections.pop(request.sid, None)
+
+    def on_subscribe_dataset(data):
+        dataset_id = str((data or {}).get('dataset_id') or '')
+        user_id = _connections.get(request.sid)
+        if not user_id or not dataset_id or not can_access_dataset(user_id, dataset_id):
+            return {'ok': False, 'error': 'Dataset no encontrado o no autorizado'}
+        join_room(f'dataset:{dataset_id}')
+        return {'ok': True, 'dataset_id': dataset_id}
+
+    def on_unsubscribe_dataset(data):
+        dataset_id = str((data or {}).get('dataset_id') or '')
+        if dataset_id:
+            leave_room(f'dataset:{dataset_id}')
+        return {'ok': True, 'dataset_id': dataset_id}
+
+    socketio.on_event('connect', on_connect)
+    socketio.on_event('disconnect', on_disconnect)
+    socketio.on_event('subscribe_dataset', on_subscribe_dataset)
+    socketio.on_event('unsubscribe_dataset', on_unsubscribe_dataset)
+
+    _state['socketio'] = socketio
+    print(f"Notificaciones en tiempo real activas en /{SOCKETIO_PATH}")
+    return socketio
+
+def _json_default(value):
+    # Fechas como en las respuestas de Flask; ObjectId y demás como texto
+    if isinstance(value, date):
+        return http_date(value)
+    return str(value)
+
+def _emit(event, payload, room, skip_origin=False):
+    socketio = _state['socketio']
+    if socketio is None:
+        return
+    skip_sid = None
+    if skip_origin and has_request_context():
+        skip_sid = request.headers.get('X-Socket-Id') or None
+    try:
+        payload = json.loads(json.dumps(payload, default=_json_default))
+        socketio.emit(event, payload, to=room, skip_sid=skip_sid)
+    except Exception as e:
+        print(f"Error publicando {event}: {e}")
+
+def request_job_id(form=None):
+    """Identificador de la tarea de la petición actual (lo elige el cliente o se genera)"""
+    job_id = form.get('job_id') if form is not None else None
+    if not job_id and has_request_context():
+        job_id = request.headers.get('X-Job-Id')
+    return job_id or uuid.uuid4().hex
+
+def progress_callback(user_id, job_id, job_type):
+    """Función (procesados, total) que publica el progreso de una tarea"""
+    return lambda processed, total: publish_progress(user_id, job_id, job_type, processed, total)
+
+def publish_progress(user_id, job_id, job_type, processed=None, total=None, state='running',
+                     message=None, result=None):
+    """
+    Publicar el progreso de una tarea al usuario que la lanzó.
+    Los eventos 'running' se limitan a uno cada PROGRESS_INTERVAL segundos.
+    """
+    if _state['socketio'] is None or not user_id or not job_id:
+        return
+    now = time.monotonic()
+    with _guard:
+        if state == 'running':
+            if now - _last_progress.get(job_id, 0) < PROGRESS_INTERVAL:
+                return
+            _last_progress[job_id] = now
+        else:
+            _last_progress.pop(job_id, None)
+    _emit('job_progress', {
+        'job_id': job_id,
+        'type': job_type,
+        'state': state,
+        'processed': processed,
+        'total': total,
+        'message': message,
+        'result': result
+    }, room=f'user:{user_id}')
+
+def publish_dataset_change(dataset_id, change_type, **data):
+    """Publicar un cambio a los clientes suscritos al dataset (salvo al que lo originó)"""
+    if _state['socketio'] is None or not dataset_id:
+        return
+    _emit('dataset_change', dict(data, dataset_id=str(dataset_id), type=change_type),
+          room=f'dataset:{dataset_id}', skip_origin=True)
@@ -0,0 +1,245 @@
+"""
+Motor de división train/val/test.
+
+La asignación de cada imagen se calcula con un hash de su id (o del video al
+que pertenece) y una semilla, de modo que es reproducible y una imagen no
+cambia de conjunto cuando el dataset crece. Opcionalmente se estratifica por
+la categoría menos frecuente de cada imagen y la asignación se guarda en la
+colección 'dataset_splits' para que las siguientes exportaciones la reutilicen:
+un documento por unidad {dataset_id, config_key, unit_key, split}, con índice
+único sobre los tres campos (ver db_indexes), de modo que el tamaño de cada
+documento no crece con el dataset.
+"""
+import json
+import hashlib
+from datetime import datetime
+
+import numpy as np
+from pymongo.errors import BulkWriteError
+
+from db_indexes import ensure_indexes
+
+SPLIT_NAMES = ('train', 'val', 'test')
+
+# Unidades por cada insert_many al guardar la asignación
+SPLIT_WRITE_BATCH = 1000
+
+DUPLICATE_KEY_ERROR = 11000
+
+# Estrato de las unidades sin anotaciones
+UNANNOTATED_STRATUM = -1
+
+def split_unit_key(img, group_by_video=True):
+    """Unidad de asignación: el video completo para sus frames, la propia imagen en otro caso"""
+    if group_by_video and img.get('video_id'):
+        return f"video:{img['video_id']}"
+    return f"image:{img['_id']}"
+
+def hash_fraction(seed, unit_key):
+    """Número estable en [0, 1) derivado de la semilla y la unidad"""
+    digest = hashlib.sha1(f'{seed}:{unit_key}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+def split_targets(train_pct, val_pct, test_pct):
+    """Fracciones objetivo de cada conjunto (test recibe el resto, como en la división original)"""
+    train = train_pct / 100
+    val = val_pct / 100
+    return train, val, max(1 - train - val, 0)
+
+def split_config_key(seed, train_pct, val_pct, test_pct, stratify, group_by_video):
+    """Identificador de una configuración de división (una asignación persistida por configuración)"""
+    payload = json.dumps([seed, train_pct, val_pct, test_pct, stratify, group_by_video])
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+def _assign_by_hash(seed, unit_key, targets):
+    fraction = hash_fraction(seed, unit_key)
+    if fraction < targets[0]:
+        return 'train'
+    if fraction < targets[0] + targets[1]:
+        return 'val'
+    return 'test'
+
+def unit_strata(unit_keys, unit_of_image, annotations_by_image):
+    """
+    Estrato de cada unidad: su categoría menos frecuente en el dataset.
+
+    Las frecuencias se calculan de forma vectorizada con NumPy sobre los
+    pares (unidad, categoría) de todas las anotaciones.
+
+    Returns:
+        Lista con el índice de categoría del estrato de cada unidad
+        (UNANNOTATED_STRATUM si la unidad no tiene anotaciones)
+    """
+    unit_index = {key: idx for idx, key in enumerate(unit_keys)}
+    category_index = {}
+    pair_units = []
+    pair_categories = []
+    for image_id, annotations in annotations_by_image.items():
+        unit = unit_of_image.get(image_id)
+        if unit is None:
+            continue
+        for ann in annotations:
+            category = str(ann.get('category_id'))
+            pair_units.append(unit_index[unit])
+            pair_categories.append(category_index.setdefault(category, len(category_index)))
+
+    strata = np.full(len(unit_keys), UNANNOTATED_STRATUM, dtype=np.int64)
+    if not pair_units:
+        return strata.tolist()
+
+    pair_units = np.asarray(pair_units, dtype=np.int64)
+    pair_categories = np.asarray(pair_categories, dtype=np.int64)
+    n_categories = len(category_index)
+
+    # Frecuencia de cada categoría (número de anotaciones)
+    frequency = np.bincount(pair_categories, minlength=n_categories)
+
+    # Mínimo por unidad de (frecuencia, categoría) codificado en un solo entero
+    encoded = frequency[pair_categories] * n_categories + pair_categories
+    best = np.full(len(unit_keys), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(best, pair_units, encoded)
+
+    annotated = best != np.iinfo(np.int64).max
+    strata[annotated] = best[annotated] % n_categories
+    return strata.tolist()
+
+def assign_splits(images, annotations_by_image, train_pct, val_pct, test_pct,
+                  seed=0, stratify=False, group_by_video=True, existing=None):
+    """
+    Asignar cada unidad (imagen o video) a train/val/test
+
+    Args:
+        images: Lista de documentos de imagen
+        annotations_by_image: Dict {image_id: [anotaciones]} (del plan de exportación)
+        train_pct, val_pct, test_pct: Porcentajes de cada conjunto
+        seed: Semilla del hash
+        stratify: Equilibrar los conjuntos por la categoría menos frecuente de cada unidad
+        group_by_video: Mantener todos los frames de un video en el mismo conjunto
+        existing: Asignación previa {unit_key: split}; se respeta para las unidades ya asignadas
+
+    Returns:
+        Dict {unit_key: split} con las unidades presentes en images
+    """
+    targets = split_targets(train_pct, val_pct, test_pct)
+    existing = existing or {}
+
+    # Agrupar imágenes en unidades conservando el orden
+    unit_of_image = {}
+    unit_sizes = {}
+    for img in images:
+        key = split_unit_key(img, group_by_video)
+        unit_of_image[str(img['_id'])] = key
+        unit_sizes[key] = unit_sizes.get(key, 0) + 1
+    unit_keys = list(unit_sizes)
+
+    assignments = {key: existing[key] for key in unit_keys if existing.get(key) in SPLIT_NAMES}
+    pending = [key for key in unit_keys if key not in assignments]
+
+    if not stratify:
+        for key in pending:
+            assignments[key] = _assign_by_hash(seed, key, targets)
+        return assignments
+
+    strata = dict(zip(unit_keys, unit_strata(unit_keys, unit_of_image, annotations_by_image)))
+
+    # Imágenes ya asignadas por estrato y conjunto
+    counts = {}
+    for key, split in assignments.items():
+        stratum_counts = counts.setdefault(strata[key], dict.fromkeys(SPLIT_NAMES, 0))
+        stratum_counts[split] += unit_sizes[key]
+
+    # Las unidades nuevas, en orden de hash, van al conjunto con más déficit de su estrato
+    pending.sort(key=lambda key: hash_fraction(seed, key))
+    for key in pending:
+        stratum_counts = counts.setdefault(strata[key], dict.fromkeys(SPLIT_NAMES, 0))
+        total = sum(stratum_counts.values()) + unit_sizes[key]
+        split = max(SPLIT_NAMES, key=lambda name: targets[SPLIT_NAMES.index(name)] * total
+                    - stratum_counts[name])
+        assignments[key] = split
+        stratum_counts[split] += unit_sizes[key]
+
+    return assignments
+
+def split_images(images, assignments, group_by_video=True):
+    """Repartir las imágenes según la asignación, conservando su orden"""
+    splits = {name: [] for name in SPLIT_NAMES}
+    for img in images:
+        splits[assignments[split_unit_key(img, group_by_video)]].append(img)
+    return splits['train'], splits['val'], splits['test']
+
+def load_assignments(db, dataset_id, config_key):
+    """
+    Asignación guardada de una configuración
+
+    Returns:
+        Tupla ({unit_key: split}, claves guardadas como documento propio,
+        ids de documentos antiguos con el mapa 'assignments' completo)
+    """
+    assignments, stored_units, legacy_ids = {}, set(), []
+    for doc in db.dataset_splits.find({'dataset_id': dataset_id, 'config_key': config_key}):
+        if 'unit_key' in doc:
+            assignments[doc['unit_key']] = doc['split']
+            stored_units.add(doc['unit_key'])
+        else:
+            # Formato anterior: todas las unidades en un mismo documento
+            for key, split in (doc.get('assignments') or {}).items():
+                assignments.setdefault(key, split)
+            legacy_ids.append(doc['_id'])
+    return assignments, stored_units, legacy_ids
+
+def save_assignments(db, dataset_id, config_key, units):
+    """
+    Guardar la asignación de unidades nuevas, un documento por unidad
+
+    Returns:
+        Claves que otra exportación ya había guardado (índice único)
+    """
+    ensure_indexes(db, ['dataset_splits'])
+    now = datetime.utcnow()
+    items = list(units.items())
+    duplicates = []
+    for start in range(0, len(items), SPLIT_WRITE_BATCH):
+        batch = items[start:start + SPLIT_WRITE_BATCH]
+        try:
+            db.dataset_splits.insert_many([
+                {'dataset_id': dataset_id, 'config_key': config_key, 'unit_key': key,
+                 'split': split, 'created_at': now}
+                for key, split in batch
+            ], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') != DUPLICATE_KEY_ERROR:
+                    raise
+                duplicates.append(batch[error['index']][0])
+    return duplicates
+
+def split_dataset(db, dataset_id, images, annotations_by_image, train_pct, val_pct, test_pct,
+                  seed=0, stratify=False, group_by_video=True):
+    """
+    Dividir las imágenes de un dataset reutilizando y ampliando la asignación
+    guardada para esta configuración
+
+    Returns:
+        Tupla (train_images, val_images, test_images)
+    """
+    config_key = split_config_key(seed, train_pct, val_pct, test_pct, stratify, group_by_video)
+    existing, stored_units, legacy_ids = load_assignments(db, dataset_id, config_key)
+
+    assignments = assign_splits(images, annotations_by_image, train_pct, val_pct, test_pct,
+                                seed=seed, stratify=stratify, group_by_video=group_by_video,
+                                existing=existing)
+
+    # Guardar las unidades nuevas y las del formato anterior (las eliminadas se conservan por si vuelven)
+    pending = {key: split for key, split in {**existing, **assignments}.items() if key not in stored_units}
+    if pending:
+        duplicates = save_assignments(db, dataset_id, config_key, pending)
+        if duplicates:
+            # Otra exportación simultánea guardó antes estas unidades: se usa su asignación
+            for doc in db.dataset_splits.find({'dataset_id': dataset_id, 'config_key': config_key,
+                                               'unit_key': {'$in': duplicates}}, {'unit_key': 1, 'split': 1}):
+                if doc['unit_key'] in assignments:
+                    assignments[doc['unit_key']] = doc['split']
+    if legacy_ids:
+        db.dataset_splits.delete_many({'_id': {'$in': legacy_ids}})
+
+    return split_images(images, assignments, group_by_video)
@@ -0,0 +1,61 @@
+"""
+POST /api/datasets/import-images: errores antes de importar (sin archivo,
+dataset desconocido) sin pausar el observador de carpetas.
+
+Usa mongomock en lugar de MongoDB:
+    pip install pytest mongomock
+    cd backend && python -m pytest tests
+"""
+import datetime
+import io
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='module')
+def api(tmp_path_factory):
+    # app crea carpetas relativas al directorio de trabajo y conecta con Mongo al importarse
+    previous_cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    os.environ.setdefault('SECRET_KEY', 'clave-de-pruebas-de-la-api-de-imagenes')
+    os.environ.setdefault('MONGO_URI', 'mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=200')
+    import jwt
+    import app as app_module
+
+    db = mongomock.MongoClient()['viewannotator']
+    app_module.get_db = lambda: db
+    user_id = str(db.users.insert_one({'username': 'test', 'password': 'x'}).inserted_id)
+    token = jwt.encode({'user_id': user_id, 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+                       app_module.app.config['SECRET_KEY'], algorithm='HS256')
+    yield app_module.app.test_client(), {'Authorization': f'Bearer {token}'}
+    os.chdir(previous_cwd)
+
+
+def paused_datasets():
+    import file_index
+    return dict(file_index._watch_state['paused'])
+
+
+def test_missing_file(api):
+    client, headers = api
+    response = client.post('/api/datasets/import-images', data={'dataset_id': '0' * 24}, headers=headers)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'No se encontró ningún archivo'
+    assert paused_datasets() == {}
+
+
+@pytest.mark.parametrize('dataset_id', ['0' * 24, 'no-es-un-id'])
+def test_unknown_dataset(api, dataset_id):
+    client, headers = api
+    response = client.post('/api/datasets/import-images',
+                           data={'dataset_id': dataset_id, 'file': (io.BytesIO(b'PK'), 'imagenes.zip')},
+                           headers=headers, content_type='multipart/form-data')
+    assert response.status_code == 404
+    assert response.get_json()['error'] == 'Dataset no encontrado'
+    assert paused_datasets() == {}
@@ -0,0 +1,98 @@
+"""
+Inferencia por teselas para imágenes muy grandes.
+
+Con imágenes de microscopía o aéreas (8000x6000 y más) el modelo ve la imagen
+reducida a su tamaño de entrada y los objetos pequeños desaparecen. En modo
+por teselas la imagen se corta en ventanas de INFERENCE_TILE_SIZE píxeles que
+se solapan INFERENCE_TILE_OVERLAP, cada ventana pasa por el modelo a su
+resolución original (en los mismos lotes que el resto de predicciones, ver
+inference) y las detecciones, llevadas a coordenadas de la imagen, se unen
+con una supresión de no máximos por clase que elimina los duplicados de las
+zonas solapadas.
+
+También se pasa la imagen completa (INFERENCE_TILE_INCLUDE_FULL) para no
+partir los objetos más grandes que una tesela.
+
+Como mucho hay INFERENCE_TILE_MAX_PENDING teselas recortadas a la vez en
+memoria por petición, sea cual sea el tamaño de la imagen.
+"""
+import os
+
+from yolo_ops import batched_nms
+
+# Lado de las teselas y solapamiento entre teselas vecinas (fracción del lado)
+TILE_SIZE = int(os.getenv('INFERENCE_TILE_SIZE', 640))
+TILE_OVERLAP = float(os.getenv('INFERENCE_TILE_OVERLAP', 0.2))
+
+# Usar teselas automáticamente si el lado mayor de la imagen llega a este tamaño (0: nunca)
+TILE_AUTO_MIN_SIDE = int(os.getenv('INFERENCE_TILE_AUTO_MIN_SIDE', 0))
+
+# Añadir una pasada con la imagen completa para los objetos grandes
+TILE_INCLUDE_FULL = os.getenv('INFERENCE_TILE_INCLUDE_FULL', 'true').lower() in ('1', 'true', 'yes')
+
+# Teselas en cola o en ejecución por petición (limita la memoria)
+TILE_MAX_PENDING = int(os.getenv('INFERENCE_TILE_MAX_PENDING', 16))
+
+# Lado mínimo de una tesela
+MIN_TILE_SIZE = 64
+
+def tile_options(tile_size=None, overlap=None):
+    """
+    Tamaño y solapamiento de las teselas, con los valores por defecto
+
+    Raises:
+        ValueError si no son válidos
+    """
+    tile_size = TILE_SIZE if tile_size is None else int(tile_size)
+    overlap = TILE_OVERLAP if overlap is None else float(overlap)
+    if tile_size < MIN_TILE_SIZE:
+        raise ValueError(f'El tamaño de tesela debe ser de al menos {MIN_TILE_SIZE} píxeles')
+    if not 0 <= overlap < 1:
+        raise ValueError('El solapamiento de las teselas debe estar entre 0 y 1')
+    return tile_size, overlap
+
+def should_tile(image_size, tiled=None, tile_size=TILE_SIZE):
+    """
+    Si una imagen se procesa por teselas
+
+    Args:
+        tiled: True o False para forzarlo; None para decidir por el tamaño
+            (INFERENCE_TILE_AUTO_MIN_SIDE)
+    """
+    if tiled is None:
+        tiled = bool(TILE_AUTO_MIN_SIDE) and max(image_size) >= TILE_AUTO_MIN_SIDE
+    # Una imagen que cabe en una tesela no gana nada
+    return bool(tiled) and max(image_size) > tile_size
+
+def _starts(length, tile_size, stride):
+    if length <= tile_size:
+        return [0]
+    # La última tesela se alinea con el borde para no salirse de la imagen
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+def tile_windows(width, height, tile_size, overlap):
+    """Ventanas (x0, y0, x1, y1) que cubren la imagen"""
+    stride = max(1, int(tile_size * (1 - overlap)))
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in _starts(height, tile_size, stride) for x in _starts(width, tile_size, stride)]
+
+def offset_detections(detections, x, y):
+    """Detecciones de una tesela en coordenadas de la imagen completa"""
+    if not x and not y:
+        return detections
+    return [dict(detection, bbox=[detection['bbox'][0] + x, detection['bbox'][1] + y,
+                                  detection['bbox'][2], detection['bbox'][3]])
+            for detection in detections]
+
+def merge_detections(detections, iou_threshold):
+    """Supresión de no máximos por clase sobre las detecciones de todas las teselas"""
+    if len(detections) < 2:
+        return detections
+    import numpy as np
+
+    boxes = np.array([detection['bbox'] for detection in detections], dtype=np.float32)
+    boxes[:, 2:] += boxes[:, :2]  # [x, y, ancho, alto] -> esquinas
+    scores = np.array([detection['confidence'] for detection in detections], dtype=np.float32)
+    classes = np.array([detection['class'] for detection in detections])
+    keep = batched_nms(boxes, scores, classes, iou_threshold)
+    return [detections[index] for index in keep.tolist()]
@@ -0,0 +1,127 @@
+"""
+Preprocesado y decodificación de los modelos YOLO exportados (TorchScript y ONNX).
+
+    preprocess()  Letterbox de un lote: cada imagen se escala conservando la
+                  proporción (OpenCV) y se rellena hasta el tamaño de entrada
+                  con gris 114, como en el entrenamiento de YOLO
+    decode()      Salida [4 + clases, anclas] de una imagen -> detecciones en
+                  píxeles de la imagen original: filtro por confianza, NMS y
+                  deshacer el letterbox con operaciones vectorizadas
+    nms()         Supresión de no máximos en NumPy; batched_nms() por clase
+
+Todo trabaja con arrays de NumPy: la salida del modelo se copia una vez a
+memoria para todo el lote y no hay operaciones por detección.
+"""
+from functools import lru_cache
+
+# Color del relleno del letterbox
+LETTERBOX_FILL = 114
+
+@lru_cache(maxsize=256)
+def letterbox_params(width, height, input_width, input_height):
+    """(escala, ancho escalado, alto escalado, relleno izquierdo, relleno superior)"""
+    ratio = min(input_width / width, input_height / height)
+    new_width = max(1, round(width * ratio))
+    new_height = max(1, round(height * ratio))
+    return ratio, new_width, new_height, (input_width - new_width) // 2, (input_height - new_height) // 2
+
+def letterbox(image, size):
+    """
+    Imagen PIL en RGB escalada y centrada en un lienzo de size (ancho, alto)
+
+    Returns:
+        (array [alto, ancho, 3] uint8, (escala, relleno izquierdo, relleno superior))
+    """
+    import cv2
+    import numpy as np
+
+    ratio, new_width, new_height, left, top = letterbox_params(image.size[0], image.size[1], size[0], size[1])
+    pixels = np.asarray(image)
+    if (new_width, new_height) != image.size:
+        pixels = cv2.resize(pixels, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    canvas = np.full((size[1], size[0], 3), LETTERBOX_FILL, dtype=np.uint8)
+    canvas[top:top + new_height, left:left + new_width] = pixels
+    return canvas, (ratio, left, top)
+
+def preprocess(images, size):
+    """
+    Lote para el modelo a partir de imágenes PIL en RGB
+
+    Returns:
+        (array [N, 3, alto, ancho] float32 en [0, 1], letterbox de cada imagen para decode())
+    """
+    import numpy as np
+
+    batch = np.empty((len(images), 3, size[1], size[0]), dtype=np.float32)
+    letterboxes = []
+    for index, image in enumerate(images):
+        canvas, params = letterbox(image, size)
+        batch[index] = canvas.transpose(2, 0, 1)  # HWC -> CHW
+        letterboxes.append(params)
+    batch *= 1 / 255.0
+    return batch, letterboxes
+
+def nms(boxes, scores, iou_threshold):
+    """Índices que sobreviven a la supresión de no máximos (cajas xyxy), por confianza descendente"""
+    import numpy as np
+
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1).clip(0) * (y2 - y1).clip(0)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        inter_w = (np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest])).clip(0)
+        inter_h = (np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest])).clip(0)
+        inter = inter_w * inter_h
+        iou = inter / np.maximum(areas[best] + areas[rest] - inter, 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+def batched_nms(boxes, scores, classes, iou_threshold):
+    """
+    nms() por clase, como ultralytics: cajas de clases distintas no se suprimen
+    entre sí. Cada clase se desplaza a una zona distinta para hacerlo en una pasada.
+    """
+    if len(boxes) < 2:
+        return nms(boxes, scores, iou_threshold)
+    # Más que la extensión de todas las cajas (las esquinas pueden ser negativas)
+    offsets = classes.astype(boxes.dtype) * (boxes.max() - boxes.min() + 1)
+    return nms(boxes + offsets[:, None], scores, iou_threshold)
+
+def decode(prediction, confidence, letterbox_info, image_size, iou_threshold, num_classes=None):
+    """
+    Detecciones de una imagen a partir de su salida [4 + clases, anclas]
+
+    Args:
+        letterbox_info: (escala, relleno izquierdo, relleno superior) de preprocess()
+        image_size: (ancho, alto) de la imagen original
+        num_classes: Clases de la salida (si tiene canales extra tras las clases)
+    """
+    import numpy as np
+
+    pred = prediction.T.astype(np.float32, copy=False)  # [anclas, 4 + clases]
+    class_probs = pred[:, 4:4 + num_classes] if num_classes else pred[:, 4:]
+    class_ids = class_probs.argmax(axis=1)
+    scores = class_probs[np.arange(len(class_ids)), class_ids]
+    mask = scores >= confidence
+    if not mask.any():
+        return []
+    boxes, scores, class_ids = pred[mask, :4], scores[mask], class_ids[mask]
+
+    # De (x centro, y centro, ancho, alto) a esquinas
+    boxes_xyxy = np.concatenate([boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2], axis=1)
+    keep = batched_nms(boxes_xyxy, scores, class_ids, iou_threshold)
+
+    # Deshacer el letterbox y recortar a la imagen
+    ratio, left, top = letterbox_info
+    boxes_xyxy = (boxes_xyxy[keep] - np.array([left, top, left, top], dtype=np.float32)) / ratio
+    boxes_xyxy[:, 0::2] = boxes_xyxy[:, 0::2].clip(0, image_size[0])
+    boxes_xyxy[:, 1::2] = boxes_xyxy[:, 1::2].clip(0, image_size[1])
+    boxes_xywh = np.concatenate([boxes_xyxy[:, :2], boxes_xyxy[:, 2:] - boxes_xyxy[:, :2]], axis=1)
+    # Cajas que quedan enteras en el relleno
+    visible = (boxes_xywh[:, 2] > 0) & (boxes_xywh[:, 3] > 0)
+    return [{'bbox': bbox, 'confidence': score, 'class': cls}
+            for bbox, score, cls in zip(boxes_xywh[visible].tolist(), scores[keep][visible].tolist(),
+                                        class_ids[keep][visible].tolist())]
@@ -14,7 +14,8 @@ export default defineConfig({
       '/api': {
         target: 'http://backend:5000',
         changeOrigin: true,
-        secure: false
+        secure: false,
+        ws: true
       }
     }
   }, 
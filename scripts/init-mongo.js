@@ -5,6 +5,7 @@
 db = db.getSiblingDB('viewannotator');
 
 // Crear índices para mejorar el rendimiento
+// (la aplicación crea al arrancar los índices de sus consultas: ver backend/db_indexes.py)
 db.images.createIndex({ "dataset_id": 1 });
 db.images.createIndex({ "filename": 1 });
 db.images.createIndex({ "upload_date": -1 });